@@ -0,0 +1,32 @@
+"""
+WSGI config for serving microsite_backend from gevent workers.
+
+Django 1.x has neither async views nor ASGI, so the I/O-bound views (the
+autocompletes waiting on OS_API and KPI_API) get their concurrency from green
+threads instead: with
+
+    gunicorn -k gevent --worker-connections 500 microsite_backend.gevent_wsgi
+
+every worker multiplexes hundreds of requests, switching to another one
+whenever a request waits on the network. The standard library, and with it
+the upstream client, is made cooperative before anything else is imported,
+and psycopg2 is made cooperative so that database queries don't block the
+other green threads either.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+patch_psycopg()
+
+import os  # noqa: E402
+
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from whitenoise.django import DjangoWhiteNoise  # noqa: E402
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE",
+                      "microsite_backend.heroku_settings")
+
+application = get_wsgi_application()
+application = DjangoWhiteNoise(application)
@@ -0,0 +1,70 @@
+"""
+gunicorn configuration for production, see the Procfile:
+
+    gunicorn -c microsite_backend/gunicorn_config.py \
+        microsite_backend.heroku_wsgi
+
+Every setting can be overridden from the environment:
+
+GUNICORN_WORKER_CLASS  gthread (default): each worker serves GUNICORN_THREADS
+                       requests at a time, enough for the autocompletes
+                       waiting on OS_API and KPI_API.
+                       gevent: each worker serves GUNICORN_WORKER_CONNECTIONS
+                       requests at a time; serve microsite_backend.gevent_wsgi
+                       (WSGI_MODULE in the Procfile) so that the standard
+                       library and psycopg2 are patched first.
+                       sync: one request at a time per worker.
+WEB_CONCURRENCY        number of worker processes, 2 per core plus one by
+                       default (Heroku sets it from the dyno size).
+"""
+import multiprocessing
+import os
+
+# gunicorn puts the working directory on the path before reading this file
+from microsite_backend import settings as microsite_settings
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8000'))
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY',
+                             multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 500))
+
+# load Django once in the master, workers are forked with it already imported,
+# which starts them faster and shares memory between them. gevent workers must
+# import the application themselves, after monkey patching.
+preload_app = worker_class != 'gevent'
+
+# recycle workers now and then, at different times, so that slowly growing
+# memory (e.g. per process caches) never builds up
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# a request waiting on a failing upstream API must give up before its worker
+# is killed, see UPSTREAM_DEADLINE
+if microsite_settings.UPSTREAM_DEADLINE >= timeout:
+    raise ValueError('GUNICORN_TIMEOUT ({}s) must be longer than '
+                     'UPSTREAM_DEADLINE ({}s)'
+                     .format(timeout, microsite_settings.UPSTREAM_DEADLINE))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # connections opened while loading the application in the master must not
+    # be shared by the workers
+    if preload_app:
+        from django.db import connections
+        connections.close_all()
+
+
+def when_ready(server):
+    # the HTTP client is only imported on first use (see vizmanager.upstream);
+    # import it once in the master, rather than in every preloaded worker
+    if preload_app:
+        import requests  # noqa: F401
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 import dj_database_url
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -42,11 +43,14 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'colorfield',
-    'django_extensions',
+    # no development only apps (e.g. django_extensions) here, every worker
+    # would import them on start
     'vizmanager',
 ]
 
 MIDDLEWARE_CLASSES = [
+    # first, to time everything else
+    'vizmanager.performance.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +61,28 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# One line of JSON per request with its timings, see vizmanager.performance
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'performance': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'vizmanager.performance': {
+            'handlers': ['performance'],
+            'level': os.environ.get('PERFORMANCE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 ROOT_URLCONF = 'microsite_backend.urls'
 
 TEMPLATES = [
@@ -96,6 +122,39 @@ DATABASES = {
 db_from_env = dj_database_url.config(conn_max_age=500)
 DATABASES['default'].update(db_from_env)
 
+# Set PGBOUNCER when connecting through pgbouncer in transaction pooling mode
+# (e.g. Heroku's pgbouncer buildpack), which doesn't support server side
+# cursors
+if os.environ.get('PGBOUNCER'):
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+# Caching
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# The workers share the microsite versions and rendered pages through files
+# by default, point CACHE_BACKEND/CACHE_LOCATION at memcached or similar when
+# they run on several machines.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get(
+            'CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'microsite_cache')),
+    },
+    # OpenSpending models are shared between processes through files unless
+    # configured otherwise
+    'os_models': {
+        'BACKEND': os.environ.get(
+            'OS_MODEL_CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get(
+            'OS_MODEL_CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'microsite_os_models')),
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
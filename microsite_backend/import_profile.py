@@ -0,0 +1,102 @@
+"""
+Import time profile of the application start, i.e. what a gunicorn worker or
+a manage.py command pays before serving anything:
+
+    python -m microsite_backend.import_profile
+    python -m microsite_backend.import_profile \
+        --wsgi microsite_backend.heroku_wsgi --limit 40
+
+Every module imported while loading the WSGI application (which sets Django
+up and imports the URLconf, hence the views and models) is timed, like
+`python -X importtime` does from Python 3.7 on. Modules are listed by
+cumulative time (including the modules they import), with their self time.
+"""
+import argparse
+import importlib
+import sys
+import time
+
+
+class ImportTimer(object):
+    """
+    Meta path hook timing the execution of every module imported after it is
+    installed
+    """
+    def __init__(self):
+        self.stack = []
+        # module name: [cumulative seconds, self seconds]
+        self.times = {}
+
+    def find_spec(self, name, path, target=None):
+        # let the other finders find the module, then wrap its loader
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and \
+                        hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader, self)
+                return spec
+        return None
+
+    def timed(self, name, execute):
+        self.stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            execute()
+        finally:
+            elapsed = time.perf_counter() - started
+            children = self.stack.pop()
+            self.times[name] = [elapsed, elapsed - children]
+            if self.stack:
+                self.stack[-1] += elapsed
+
+
+class TimedLoader(object):
+
+    def __init__(self, loader, timer):
+        self.loader = loader
+        self.timer = timer
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # the module's own loader must remain visible to it (e.g. for
+        # pkgutil or importlib.resources)
+        module.__spec__.loader = self.loader
+        module.__loader__ = self.loader
+        self.timer.timed(module.__name__,
+                         lambda: self.loader.exec_module(module))
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--wsgi', default='microsite_backend.wsgi',
+                        help='WSGI module to load')
+    parser.add_argument('--limit', type=int, default=30,
+                        help='Number of modules to list')
+    options = parser.parse_args()
+
+    timer = ImportTimer()
+    sys.meta_path.insert(0, timer)
+    started = time.perf_counter()
+    importlib.import_module(options.wsgi)
+    total = time.perf_counter() - started
+    sys.meta_path.remove(timer)
+
+    print('{:>10} {:>10}  {}'.format('cumul ms', 'self ms', 'module'))
+    ranked = sorted(timer.times.items(), key=lambda item: -item[1][0])
+    for name, (cumulative, own) in ranked[:options.limit]:
+        print('{:>10.1f} {:>10.1f}  {}'.format(cumulative * 1000, own * 1000,
+                                               name))
+    print('{} modules imported, application loaded in {:.1f} ms'
+          .format(len(timer.times), total * 1000))
+
+
+if __name__ == '__main__':
+    main()
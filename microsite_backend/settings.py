@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -46,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    # first, to time everything else
+    'vizmanager.performance.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,6 +59,28 @@ MIDDLEWARE_CLASSES = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# One line of JSON per request with its timings, see vizmanager.performance
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'performance': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'loggers': {
+        'vizmanager.performance': {
+            'handlers': ['performance'],
+            'level': os.environ.get('PERFORMANCE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 ROOT_URLCONF = 'microsite_backend.urls'
 
 TEMPLATES = [
@@ -89,6 +114,30 @@ DATABASES = {
 }
 
 
+# Caching
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# Point CACHE_BACKEND/CACHE_LOCATION at a shared backend (memcached, file
+# based, ...) when running several worker processes, so that every worker sees
+# the same microsite versions and rendered pages.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    },
+    # OpenSpending models are shared between processes through files unless
+    # configured otherwise
+    'os_models': {
+        'BACKEND': os.environ.get(
+            'OS_MODEL_CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get(
+            'OS_MODEL_CACHE_LOCATION',
+            os.path.join(tempfile.gettempdir(), 'microsite_os_models')),
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -143,3 +192,88 @@ except KeyError:  # not using Docker
     OS_API = 'http://apps.openbudgets.eu/api/3'
     KPI_API = 'http://apps.openbudgets.eu/kpi/api/v1'
     KPI_HOST = "http://apps.openbudgets.eu/kpi"
+
+# Rendered microsite pages are cached per microsite version. The version itself
+# is cached for a short while only, which bounds how stale a page can get when
+# the cache backend is not shared between processes.
+MICROSITE_PAGE_CACHE_TIMEOUT = 60 * 60 * 24
+MICROSITE_VERSION_CACHE_TIMEOUT = 10
+
+# OpenSpending models are fresh for OS_MODEL_CACHE_TIMEOUT, then served while
+# being refreshed in the background for OS_MODEL_CACHE_STALE_TIMEOUT. Codes
+# OS_API fails on are not asked for again for OS_MODEL_CACHE_ERROR_TIMEOUT.
+OS_MODEL_CACHE_TIMEOUT = 60 * 60
+OS_MODEL_CACHE_STALE_TIMEOUT = 60 * 60 * 24 * 7
+OS_MODEL_CACHE_ERROR_TIMEOUT = 60 * 5
+
+# Calls to OS_API and KPI_API share a pool of keep-alive connections per host.
+# Raise UPSTREAM_POOL_MAXSIZE to the number of concurrent requests per worker
+# when serving from gevent workers (see gevent_wsgi.py).
+# Timeouts are in seconds; a host failing UPSTREAM_CIRCUIT_FAILURES times in a
+# row is not called for UPSTREAM_CIRCUIT_RESET_TIMEOUT seconds.
+# Connection failures and 502/503/504 answers are retried, read timeouts are
+# not. With the retries and their backoff, a call never takes longer than
+# UPSTREAM_DEADLINE, which gunicorn_config.py keeps below the worker timeout
+# so that a failing upstream frees workers instead of getting them killed.
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 5
+UPSTREAM_RETRIES = 2
+UPSTREAM_RETRY_BACKOFF = 0.2
+UPSTREAM_DEADLINE = 25
+UPSTREAM_POOL_CONNECTIONS = 4
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 10))
+UPSTREAM_CIRCUIT_FAILURES = 5
+UPSTREAM_CIRCUIT_RESET_TIMEOUT = 30
+
+# Autocomplete results from the upstream APIs are kept per process
+AUTOCOMPLETE_CACHE_SIZE = 1000
+AUTOCOMPLETE_CACHE_TIMEOUT = 60 * 10
+
+# Dataset.objects.prefetch_os_models downloads this many models at a time
+OS_MODEL_PREFETCH_WORKERS = 8
+
+# Theme files are written by a background thread, coalescing the saves of a
+# theme made within THEME_FILES_WRITE_DELAY seconds
+THEME_FILES_WRITE_BEHIND = True
+THEME_FILES_WRITE_DELAY = 0.5
+
+# Precompressed theme JSON is kept by content digest; the digest of the current
+# version of each theme is cached for a short while only, like microsite
+# versions
+THEME_ASSET_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+THEME_DIGEST_CACHE_TIMEOUT = 10
+
+# build_static_microsites renders the microsites into this folder, to be served
+# as <pk>/index.html by the web server
+STATIC_MICROSITES_ROOT = os.environ.get('STATIC_MICROSITES_ROOT',
+                                        'static_microsites')
+
+# Base URLs of caching proxies in front of this site (e.g.
+# 'http://localhost:6081'), sent a PURGE request for the URLs of every
+# invalidated microsite. Space separated in the environment.
+CDN_PURGE_URLS = os.environ.get('CDN_PURGE_URLS', '').split()
+CDN_PURGE_WORKERS = 4
+
+# Ping database connections kept from earlier requests (CONN_MAX_AGE) when a
+# request first uses them, replacing broken ones, see vizmanager/db.py
+DB_HEALTH_CHECKS = os.environ.get('DB_HEALTH_CHECKS', '1') == '1'
+
+# Dataset.drilldown asks OS_API for aggregates OS_AGGREGATE_PAGE_SIZE cells at
+# a time, at most OS_AGGREGATE_WORKERS pages at once, and caches every page
+OS_AGGREGATE_PAGE_SIZE = 1000
+OS_AGGREGATE_WORKERS = 4
+OS_AGGREGATE_CACHE_TIMEOUT = 60 * 60
+
+# snapshot_dataset stores local columnar copies of the facts of datasets here,
+# downloading SNAPSHOT_PAGE_SIZE facts per request
+SNAPSHOTS_ROOT = os.environ.get('SNAPSHOTS_ROOT', 'snapshots')
+SNAPSHOT_PAGE_SIZE = 10000
+
+# PerformanceMiddleware counts and times database queries through Django's
+# debug cursor, which keeps the SQL of every query of a request in memory:
+# only turn it on while investigating (it is implied by DEBUG)
+PERFORMANCE_DB_QUERIES = os.environ.get('PERFORMANCE_DB_QUERIES', '0') == '1'
+
+# /metrics exposes latencies and request counts per endpoint; it is only
+# served with a token set, to requests sending `Authorization: Bearer <token>`
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
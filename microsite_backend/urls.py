@@ -17,6 +17,7 @@ from django.conf.urls import url, include
 from django.contrib import admin
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 from vizmanager.admin import ma_site
+from vizmanager.views import MetricsView
 from microsite_backend import settings
 import vizmanager
 
@@ -36,4 +37,8 @@ urlpatterns = [
     url(r'^{}/'.format(settings.HOST_PREFIX), include(urlpatterns))
 ]
 
+urlpatterns += [
+    url(r'^metrics$', MetricsView.as_view(), name='metrics'),
+]
+
 urlpatterns += staticfiles_urlpatterns()
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class VizmanagerConfig(AppConfig):
     name = 'vizmanager'
+
+    def ready(self):
+        from django.core.signals import request_started
+        from vizmanager import db, signals
+        signals.connect()
+        request_started.connect(db.check_connections,
+                                dispatch_uid='vizmanager.check_connections')
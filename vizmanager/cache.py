@@ -0,0 +1,324 @@
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+from django.core.cache import cache, caches, InvalidCacheBackendError
+
+from microsite_backend import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+MICROSITE_VERSION_KEY = 'vizmanager:microsite-version:{pk}'
+MICROSITE_PAGE_KEY = 'vizmanager:microsite-page:{pk}:{version}'
+OS_MODEL_KEY = 'vizmanager:os-model:{digest}'
+OS_MODEL_REFRESH_KEY = 'vizmanager:os-model-refresh:{digest}'
+OS_AGGREGATE_KEY = 'vizmanager:os-aggregate:{digest}:{page}'
+THEME_DIGEST_KEY = 'vizmanager:theme-digest:{pk}'
+THEME_ASSET_KEY = 'vizmanager:theme-asset:{pk}:{digest}'
+
+
+def get_microsite_version(pk):
+    """
+    Look up the cached render version of a microsite
+    :param pk: primary key of the microsite
+    :return: integer version, or None if it is not cached
+    """
+    return cache.get(MICROSITE_VERSION_KEY.format(pk=pk))
+
+
+def set_microsite_version(pk, version):
+    """
+    Remember the render version of a microsite
+    :param pk: primary key of the microsite
+    :param version: integer version as stored in the database
+    :return: None
+    """
+    cache.set(MICROSITE_VERSION_KEY.format(pk=pk), version,
+              settings.MICROSITE_VERSION_CACHE_TIMEOUT)
+
+
+def forget_microsite_versions(pks):
+    """
+    Drop the cached versions of the given microsites so that the next request
+    reads the bumped version from the database
+    :param pks: iterable of microsite primary keys
+    :return: None
+    """
+    cache.delete_many([MICROSITE_VERSION_KEY.format(pk=pk) for pk in pks])
+
+
+def get_microsite_page(pk, version):
+    """
+    Look up a rendered microsite page
+    :param pk: primary key of the microsite
+    :param version: render version of the microsite
+    :return: (etag, content) tuple, or None if the page is not cached
+    """
+    return cache.get(MICROSITE_PAGE_KEY.format(pk=pk, version=version))
+
+
+def set_microsite_page(pk, version, etag, content):
+    """
+    Store a rendered microsite page
+    :param pk: primary key of the microsite
+    :param version: render version the page was rendered from
+    :param etag: quoted ETag of the content
+    :param content: rendered page as bytes
+    :return: None
+    """
+    cache.set(MICROSITE_PAGE_KEY.format(pk=pk, version=version),
+              (etag, content), settings.MICROSITE_PAGE_CACHE_TIMEOUT)
+
+
+def get_theme_digest(pk):
+    """
+    Look up the content digest of the current version of a theme
+    :param pk: primary key of the theme
+    :return: string, or None if it is not cached
+    """
+    return cache.get(THEME_DIGEST_KEY.format(pk=pk))
+
+
+def get_theme_asset(pk, digest):
+    """
+    Look up the encoded variants of a theme's JSON
+    :param pk: primary key of the theme, the same JSON under another theme
+               is not found
+    :param digest: content digest of the JSON
+    :return: dictionary of bytes by content encoding, or None if not cached
+    """
+    return cache.get(THEME_ASSET_KEY.format(pk=pk, digest=digest))
+
+
+def set_theme_asset(pk, digest, variants):
+    """
+    Store the encoded variants of a theme's JSON, and make them the current
+    version of the theme
+    :param pk: primary key of the theme
+    :param digest: content digest of the JSON
+    :param variants: dictionary of bytes by content encoding
+    :return: None
+    """
+    cache.set(THEME_ASSET_KEY.format(pk=pk, digest=digest), variants,
+              settings.THEME_ASSET_CACHE_TIMEOUT)
+    cache.set(THEME_DIGEST_KEY.format(pk=pk), digest,
+              settings.THEME_DIGEST_CACHE_TIMEOUT)
+
+
+def os_model_cache():
+    """
+    The cache holding OpenSpending models, the 'os_models' cache if it is
+    configured, the default cache otherwise
+    :return: Django cache backend
+    """
+    try:
+        return caches['os_models']
+    except InvalidCacheBackendError:
+        return cache
+
+
+def os_model_digest(code):
+    """
+    Hash OS_API and a dataset code into something usable in any cache key
+    :param code: OpenSpending dataset code
+    :return: hex digest string
+    """
+    return hashlib.md5('{}|{}'.format(settings.OS_API, code).encode('utf-8'))\
+        .hexdigest()
+
+
+def get_os_model(code, fetch):
+    """
+    Get the OpenSpending model of a dataset from the shared cache, calling
+    `fetch` only when it is missing.
+    Expired models are still returned while `fetch` refreshes them in the
+    background, and failing codes are remembered for a while so that they
+    don't hit OS_API on every call.
+    :param code: OpenSpending dataset code
+    :param fetch: callable returning the model of the code, raising
+                  RuntimeError if OS_API doesn't know the code and IOError
+                  (upstream.UpstreamError) if it can't be reached
+    :return: dictionary containing an OpenSpending model
+    """
+    digest = os_model_digest(code)
+    entry = os_model_cache().get(OS_MODEL_KEY.format(digest=digest))
+
+    if entry is not None and entry['expires'] > time.time():
+        if 'error' in entry:
+            raise RuntimeError(entry['error'])
+        return entry['model']
+
+    if entry is not None and 'model' in entry:
+        # stale model: serve it and refresh it once, whoever gets there first
+        if os_model_cache().add(OS_MODEL_REFRESH_KEY.format(digest=digest),
+                                True, settings.OS_MODEL_CACHE_TIMEOUT):
+            threading.Thread(target=refresh_os_model, args=(code, fetch),
+                             daemon=True).start()
+        return entry['model']
+
+    return refresh_os_model(code, fetch)
+
+
+def refresh_os_model(code, fetch):
+    """
+    Fetch the OpenSpending model of a dataset and store it in the shared cache
+    :param code: OpenSpending dataset code
+    :param fetch: see `get_os_model`
+    :return: dictionary containing an OpenSpending model, the cached one if
+             fetching fails
+    """
+    digest = os_model_digest(code)
+    key = OS_MODEL_KEY.format(digest=digest)
+    try:
+        model = fetch()
+    except (RuntimeError, IOError) as e:
+        entry = os_model_cache().get(key)
+        if entry is not None and 'model' in entry:
+            # keep serving the model we have, a failure may be transient;
+            # try again after OS_MODEL_CACHE_ERROR_TIMEOUT
+            logger.warning('Could not refresh the OpenSpending model of %s: '
+                           '%s', code, e)
+            entry['expires'] = time.time() + \
+                settings.OS_MODEL_CACHE_ERROR_TIMEOUT
+            os_model_cache().set(key, entry,
+                                 settings.OS_MODEL_CACHE_ERROR_TIMEOUT +
+                                 settings.OS_MODEL_CACHE_STALE_TIMEOUT)
+            return entry['model']
+        # only codes which never had a model are remembered as failing, an
+        # outage included, so that it isn't called for every request
+        os_model_cache().set(key, {
+            'error': str(e),
+            'expires': time.time() + settings.OS_MODEL_CACHE_ERROR_TIMEOUT,
+        }, settings.OS_MODEL_CACHE_ERROR_TIMEOUT)
+        raise
+    finally:
+        os_model_cache().delete(OS_MODEL_REFRESH_KEY.format(digest=digest))
+
+    os_model_cache().set(key, {
+        'model': model,
+        'expires': time.time() + settings.OS_MODEL_CACHE_TIMEOUT,
+    }, settings.OS_MODEL_CACHE_TIMEOUT + settings.OS_MODEL_CACHE_STALE_TIMEOUT)
+    return model
+
+
+def os_aggregate_digest(code, params):
+    """
+    Hash OS_API, a dataset code and the parameters of an aggregate query
+    (drilldown, cut, aggregates, page size...) into something usable in any
+    cache key
+    :param code: OpenSpending dataset code
+    :param params: dictionary of query parameters, without the page
+    :return: hex digest string
+    """
+    query = '&'.join('{}={}'.format(name, params[name])
+                     for name in sorted(params))
+    return hashlib.md5('{}|{}|{}'.format(settings.OS_API, code, query)
+                       .encode('utf-8')).hexdigest()
+
+
+def get_os_aggregate_page(digest, page):
+    """
+    :param digest: string, see os_aggregate_digest
+    :param page: integer, 1 based
+    :return: dictionary with 'cells' and 'total_cell_count', None if missing
+    """
+    return os_model_cache().get(OS_AGGREGATE_KEY.format(digest=digest,
+                                                        page=page))
+
+
+def set_os_aggregate_page(digest, page, data):
+    """
+    Remember a page of aggregate cells, in the cache holding OpenSpending
+    models as they change together
+    :param data: dictionary with 'cells' and 'total_cell_count'
+    """
+    os_model_cache().set(OS_AGGREGATE_KEY.format(digest=digest, page=page),
+                         data, settings.OS_AGGREGATE_CACHE_TIMEOUT)
+
+
+def normalise_query(q):
+    """
+    Normalise a search query so that equivalent queries share cache entries
+    :param q: string, search query as typed
+    :return: string, lower cased with whitespace collapsed
+    """
+    return ' '.join(q.lower().split())
+
+
+class LRUCache(object):
+    """
+    Thread safe, per-process cache holding at most `size` entries for at most
+    `timeout` seconds each, evicting the least recently used entry when full
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, the others wait for it and get its result (or its exception)
+    """
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,47 @@
+"""
+Health checks of persistent database connections.
+
+With CONN_MAX_AGE, a connection outlives the request that opened it. When
+the server or a pooler in between drops it meanwhile, Django only finds out
+when the next request's first query fails. Django 1.11 has no
+CONN_HEALTH_CHECKS, so, like it does from Django 4.1, the connections kept
+from an earlier request are pinged when a request first uses them, and broken
+ones are replaced. Requests that don't touch the database (cached pages) don't
+ping anything.
+"""
+import functools
+
+from django.db import connections
+
+from microsite_backend import settings
+
+
+def check_connections(**kwargs):
+    """
+    request_started receiver, connected in VizmanagerConfig.ready: arm a
+    health check on the first use of each connection kept from an earlier
+    request
+    """
+    if not settings.DB_HEALTH_CHECKS:
+        return
+    for connection in connections.all():
+        if connection.connection is not None and \
+                'ensure_connection' not in connection.__dict__:
+            # every use of a connection (cursors, transactions) goes through
+            # ensure_connection, shadowed here until the first one
+            connection.ensure_connection = functools.partial(
+                check_on_first_use, connection)
+
+
+def check_on_first_use(connection):
+    """
+    Close `connection` if it doesn't answer anymore, then let it connect as
+    usual
+    :param connection: django.db.backends.base.base.BaseDatabaseWrapper
+    """
+    del connection.ensure_connection
+    if connection.connection is not None and \
+            not connection.in_atomic_block and \
+            not connection.is_usable():
+        connection.close()
+    connection.ensure_connection()
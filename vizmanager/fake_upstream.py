@@ -0,0 +1,234 @@
+"""
+A local stand-in for OS_API and KPI_API, answering the requests this project
+makes with deterministic made-up data, after an optional delay that mimics
+the latency of the real APIs. Used by the benchmark command and the tests.
+
+    server = FakeUpstream(latency=0.02)
+    server.start()
+    settings.OS_API = server.os_api
+    settings.KPI_API = server.kpi_api
+    ...
+    server.stop()
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import islice, product
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+from vizmanager.models import KPIFilterTerm
+
+
+def os_model(code, dimensions=8, measures=2):
+    """
+    :param code: string, dataset code
+    :return: dictionary shaped like an OpenSpending model, with two
+             hierarchies of three levels
+    """
+    return {
+        'dimensions': dict(
+            ('dimension_{}'.format(i), {
+                'attributes': dict(
+                    ('attribute_{}'.format(j), {
+                        'ref': 'dimension_{}.attribute_{}'.format(i, j)})
+                    for j in range(2)),
+                'key_ref': 'dimension_{}.attribute_0'.format(i),
+                'label_ref': 'dimension_{}.attribute_1'.format(i),
+                'label': 'Dimension {}'.format(i),
+            }) for i in range(dimensions)),
+        'measures': dict(('measure_{}'.format(i), {
+            'label': 'Measure {}'.format(i), 'currency': 'EUR'})
+            for i in range(measures)),
+        'hierarchies': dict(('hierarchy_{}'.format(i), {
+            'levels': ['dimension_{}'.format(i * 3 + j) for j in range(3)]})
+            for i in range(2)),
+    }
+
+
+def aggregate(params, members):
+    """
+    Sum a measure per member of the drilled down dimensions, each dimension
+    having `members` members whose keys are 0 to members - 1
+    :param params: dictionary of Babbage aggregate query parameters
+    :return: dictionary shaped like a Babbage aggregate response
+    """
+    drilldown = [ref for ref in params.get('drilldown', '').split('|') if ref]
+    cut = dict(part.split(':', 1)
+               for part in params.get('cut', '').split('|') if part)
+    cut = dict((ref.split('.')[0], json.loads(value))
+               for ref, value in cut.items())
+    dimensions = [dimension for dimension in OrderedDict.fromkeys(
+        ref.split('.')[0] for ref in drilldown) if dimension not in cut]
+    page = int(params.get('page', 1))
+    pagesize = int(params.get('pagesize', 10000))
+    measure = params.get('aggregates', 'measure_0.sum')
+
+    def cell(keys):
+        member_keys = dict(cut, **dict(zip(dimensions, keys)))
+        values = dict(
+            (ref, member_keys[ref.split('.')[0]]
+             if ref.endswith('attribute_0')
+             else 'Member {}'.format(member_keys[ref.split('.')[0]]))
+            for ref in drilldown)
+        values[measure] = float(sum(member_keys.values()) + 1)
+        return values
+
+    total = members ** len(dimensions)
+    keys = product(range(members), repeat=len(dimensions))
+    cells = [cell(k)
+             for k in islice(keys, (page - 1) * pagesize, page * pagesize)]
+    return {'cells': cells, 'total_cell_count': total, 'page': page,
+            'page_size': pagesize}
+
+
+def facts(params, count, members, revision=0):
+    """
+    :param count: integer, total number of facts
+    :param revision: integer, added to every measure, change it to change
+                     the facts
+    :return: dictionary shaped like a Babbage facts response, the members of
+             dimension i in fact n have the key (n * (i + 1)) % members
+    """
+    page = int(params.get('page', 1))
+    pagesize = int(params.get('pagesize', 10000))
+    fields = params.get('fields', '').split(',')
+
+    def fact(n):
+        values = {}
+        for ref in fields:
+            name, _, attribute = ref.partition('.')
+            if name.startswith('dimension_'):
+                key = (n * (int(name.split('_')[1]) + 1)) % members
+                values[ref] = key if attribute == 'attribute_0' \
+                    else 'Member {}'.format(key)
+            elif name.startswith('measure_'):
+                values[ref] = float(n % 7 + int(name.split('_')[1]) +
+                                    revision)
+        return values
+
+    rows = range((page - 1) * pagesize, min(page * pagesize, count))
+    return {'data': [fact(n) for n in rows], 'total_fact_count': count,
+            'page': page, 'page_size': pagesize}
+
+
+def packages(q, size):
+    """
+    :return: list of packages as returned by OpenSpending's search
+    """
+    q = q.strip('"')
+    return [{'id': 'package-{}-{}'.format(q, i),
+             'package': {'title': 'Budget of {} {}'.format(q, i)}}
+            for i in range(min(size, 25))]
+
+
+def filter_values(kind, q):
+    """
+    :return: list of KPI_API filter values
+    """
+    return [{'url': 'http://kpi.example.org/{}/{}-{}'.format(kind, q, i),
+             'label': '{} {} {}'.format(kind.title(), q, i)}
+            for i in range(10)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't let them wait for ACKs
+    disable_nagle_algorithm = True
+    model_path = re.compile(r'/api/3/cubes/(?P<code>[^/]+)/model$')
+    aggregate_path = re.compile(r'/api/3/cubes/(?P<code>[^/]+)/aggregate$')
+    facts_path = re.compile(r'/api/3/cubes/(?P<code>[^/]+)/facts$')
+    filter_path = re.compile(r'/kpi/api/v1/filters/(?P<kind>\w+)$')
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        # OS_API's search lives under a different base, see
+        # views.DatasetAutocomplete, whose URL has a double slash that
+        # urlsplit would take for the start of a host
+        url = urlsplit(re.sub('^/+', '/', self.path))
+        path = re.sub('/+', '/', url.path)
+        params = dict((key, values[0])
+                      for key, values in parse_qs(url.query).items())
+        self.server.count()
+
+        match = self.model_path.match(path)
+        if match:
+            return self.answer({'model': os_model(match.group('code'))})
+        if self.aggregate_path.match(path):
+            return self.answer(aggregate(params, self.server.members))
+        if self.facts_path.match(path):
+            return self.answer(facts(params, self.server.facts,
+                                     self.server.members,
+                                     self.server.revision))
+        if path == '/search/package':
+            return self.answer(packages(params.get('q', ''),
+                                        int(params.get('size', 10))))
+        match = self.filter_path.match(path)
+        if match and match.group('kind') in KPIFilterTerm.KINDS:
+            return self.answer(filter_values(match.group('kind'),
+                                             params.get('q', '')))
+        self.answer({'error': 'not found'}, status=404)
+
+    def do_PURGE(self):
+        self.server.count()
+        self.answer({})
+
+    def answer(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeUpstream(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, members=10, facts=1000, host='127.0.0.1',
+                 port=0):
+        """
+        :param latency: float, seconds to wait before answering each request
+        :param members: integer, members of each dimension
+        :param facts: integer, facts of each dataset
+        :param port: integer, 0 picks a free port
+        """
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.latency = latency
+        self.members = members
+        self.facts = facts
+        self.revision = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    @property
+    def os_api(self):
+        return '{}/api/3'.format(self.base_url)
+
+    @property
+    def kpi_api(self):
+        return '{}/kpi/api/v1'.format(self.base_url)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='fake-upstream', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,99 @@
+"""
+Purging of the caches of microsite pages.
+
+The version of a microsite is bumped in the database along with the change
+that affects it (see vizmanager.signals), while purging what was cached under
+the old version waits for the transaction to commit: purged earlier, a
+concurrent request could cache the old version again before the new one is
+visible. Purges are batched per transaction, so an admin save touching many
+objects purges each microsite once.
+
+When CDN_PURGE_URLS is set, the URLs of purged microsites are also sent a
+PURGE request on each of those hosts, from a background thread.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.urlresolvers import reverse
+from django.db import transaction
+
+from microsite_backend import settings
+from vizmanager import cache, upstream
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+class PurgeBatch(object):
+    """
+    Microsites to purge once the current transaction commits
+    """
+    def __init__(self):
+        self.pks = set()
+
+    def flush(self):
+        pks, self.pks = self.pks, set()
+        if pks:
+            purge_now(pks)
+
+
+def purge(pks):
+    """
+    Purge the caches of the given microsites when the current transaction
+    commits, or right away outside of a transaction
+    :param pks: iterable of microsite primary keys, None values are ignored
+    :return: None
+    """
+    pks = set(pk for pk in pks if pk is not None)
+    if not pks:
+        return
+    connection = transaction.get_connection()
+    if not connection.in_atomic_block:
+        purge_now(pks)
+        return
+
+    batch = getattr(connection, 'microsite_purge_batch', None)
+    # a rolled back transaction drops the flush of its batch, start a new one
+    if batch is None or not any(func == batch.flush for sids, func
+                                in connection.run_on_commit):
+        batch = connection.microsite_purge_batch = PurgeBatch()
+        transaction.on_commit(batch.flush)
+    batch.pks.update(pks)
+
+
+def purge_now(pks):
+    """
+    :param pks: set of microsite primary keys
+    :return: None
+    """
+    cache.forget_microsite_versions(pks)
+    if settings.CDN_PURGE_URLS:
+        global _executor
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CDN_PURGE_WORKERS)
+        for base_url in settings.CDN_PURGE_URLS:
+            for path in microsite_paths(pks):
+                _executor.submit(send_purge, base_url.rstrip('/') + path)
+
+
+def microsite_paths(pks):
+    """
+    :param pks: iterable of microsite primary keys
+    :return: list of the URL paths serving the given microsites
+    """
+    return [reverse(name, kwargs={'pk': pk}) for pk in sorted(pks)
+            for name in ('vizmanager:microsite-detail',
+                         'vizmanager:api-microsite-detail')]
+
+
+def send_purge(url):
+    try:
+        response = upstream.request('PURGE', url)
+    except upstream.UpstreamError:
+        logger.exception('Could not purge %s', url)
+        return
+    if response.status_code >= 400 and response.status_code != 404:
+        logger.warning('Purging %s answered %s', url, response.status_code)
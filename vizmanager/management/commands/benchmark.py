@@ -0,0 +1,273 @@
+import collections
+import json
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, \
+    setup_test_environment, teardown_test_environment
+
+from microsite_backend import settings
+from vizmanager import performance
+from vizmanager.fake_upstream import FakeUpstream
+from vizmanager.models import Dataset, KPI, Microsite, Municipality, \
+    Organization, Phase, Theme, Year
+from vizmanager.views import UpstreamAutocomplete
+
+# the benchmark must not touch the caches of a running site
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark',
+    },
+    'os_models': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'benchmark-os-models',
+    },
+}
+# figures compared with the baseline, and whether they must match exactly
+COMPARED = (('queries', True), ('p95_ms', False), ('alloc_kib', False))
+
+
+def clear_caches():
+    for alias in CACHES:
+        caches[alias].clear()
+    UpstreamAutocomplete.results_cache.clear()
+
+
+def create_microsite(size):
+    """
+    Create a microsite showing `size` datasets and `size` KPIs
+    :param size: integer
+    :return: Microsite
+    """
+    municipality = Municipality.objects.create(
+        name='Municipality {}'.format(size), country='Benchmark')
+    microsite = Microsite.objects.create(
+        name='Microsite {}'.format(size), municipality=municipality)
+    microsite.selected_theme = Theme.objects.create(
+        name='theme-{}'.format(size), microsite=microsite)
+    microsite.save()
+
+    Dataset.objects.bulk_create([
+        Dataset(name='Dataset {}'.format(i), microsite=microsite,
+                code='dataset-{}-{}'.format(size, i), viz_type='Treemap',
+                initial_dimension='dimension_0.attribute_0',
+                initial_measure='measure_0')
+        for i in range(size)])
+
+    urls = ['http://kpi.example.org/{}/{}'.format(size, i)
+            for i in range(size)]
+    for model in (Organization, Year, Phase):
+        model.objects.bulk_create([
+            model(name='{} {}'.format(model.__name__, url), url=url)
+            for url in urls])
+    KPI.objects.bulk_create([
+        KPI(name='KPI {}'.format(url), organization_id=url, year_id=url,
+            phase_id=url) for url in urls])
+    microsite.kpi_set.add(*KPI.objects.filter(organization_id__in=urls))
+    return microsite
+
+
+class Command(BaseCommand):
+    help = 'Time the microsite pages, the autocompletes and the dataset ' \
+           'admin against a local fake of OS_API and KPI_API, in a ' \
+           'throwaway test database. Reports latency percentiles, queries ' \
+           'and allocations per request, and fails when they regressed ' \
+           'from a baseline saved by an earlier run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='1,10,100,1000',
+                            help='Comma separated numbers of datasets and '
+                                 'KPIs of the benchmarked microsites')
+        parser.add_argument('--requests', type=int, default=20,
+                            help='Timed requests per scenario')
+        parser.add_argument('--latency', type=float, default=0.01,
+                            help='Seconds the fake upstream APIs take to '
+                                 'answer')
+        parser.add_argument('--scenarios',
+                            help='Comma separated scenarios to run, all by '
+                                 'default')
+        parser.add_argument('--baseline',
+                            help='JSON file of results to compare with')
+        parser.add_argument('--save',
+                            help='Write the results to this JSON file, to '
+                                 'be used as a baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative increase of the p95 '
+                                 'latency and allocations over the baseline; '
+                                 'queries must not increase at all')
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes must be comma separated integers')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as baseline_file:
+                baseline = json.load(baseline_file)
+
+        server = FakeUpstream(latency=options['latency'])
+        server.start()
+        themes_folder = tempfile.TemporaryDirectory()
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True,
+                                           serialize=False)
+        try:
+            with override_settings(CACHES=CACHES), \
+                    mock.patch.multiple(
+                        settings, OS_API=server.os_api,
+                        KPI_API=server.kpi_api,
+                        OS_VIEWER_THEMES_FOLDER=themes_folder.name,
+                        THEME_FILES_WRITE_BEHIND=False, CDN_PURGE_URLS=[]), \
+                    mock.patch.object(performance.logger, 'disabled', True):
+                results = self.run_scenarios(sizes, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            themes_folder.cleanup()
+            server.stop()
+
+        self.report(results, baseline)
+        if options['save']:
+            with open(options['save'], 'w') as results_file:
+                json.dump(results, results_file, indent=2, sort_keys=True)
+
+        if baseline is not None:
+            regressions = self.compare(results, baseline,
+                                       options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions from {}:\n{}'.format(
+                    options['baseline'], '\n'.join(regressions)))
+            self.stdout.write(self.style.SUCCESS(
+                'No regression from {}'.format(options['baseline'])))
+
+    def scenarios(self, sizes):
+        """
+        :param sizes: list of integers
+        :return: list of (scenario, size, URL, function run before each
+                 request), size is None for scenarios not depending on it
+        """
+        scenarios = []
+        for name, view in (('dataset-autocomplete', 'dataset'),
+                           ('organization-autocomplete', 'organization'),
+                           ('year-autocomplete', 'year'),
+                           ('phase-autocomplete', 'phase')):
+            # a new query each time, so the upstream API is called
+            queries = ('{}{}'.format(name[:4], i) for i in range(10 ** 6))
+            scenarios.append((
+                name, None,
+                lambda view=view, queries=queries: '{}?q={}'.format(
+                    reverse('vizmanager:{}-autocomplete'.format(view)),
+                    next(queries)),
+                clear_caches))
+
+        for size in sizes:
+            microsite = create_microsite(size)
+            dataset = microsite.dataset_set.order_by('pk').first()
+            detail = reverse('vizmanager:microsite-detail',
+                             kwargs={'pk': microsite.pk})
+            scenarios.extend([
+                ('microsite-detail', size, lambda url=detail: url,
+                 clear_caches),
+                ('microsite-detail-cached', size, lambda url=detail: url,
+                 lambda: None),
+                ('dataset-change-form', size,
+                 lambda pk=dataset.pk: reverse(
+                     'admin:vizmanager_dataset_change', args=[pk]),
+                 clear_caches),
+                ('dataset-changelist', size,
+                 lambda pk=microsite.pk: '{}?microsite__id__exact={}'.format(
+                     reverse('admin:vizmanager_dataset_changelist'), pk),
+                 clear_caches),
+            ])
+        return scenarios
+
+    def run_scenarios(self, sizes, options):
+        client = Client()
+        client.force_login(User.objects.create_superuser(
+            'benchmark', 'benchmark@example.org', 'benchmark'))
+        selected = options['scenarios'] and \
+            set(options['scenarios'].split(','))
+
+        results = collections.OrderedDict()
+        for name, size, url, before in self.scenarios(sizes):
+            if selected and name not in selected:
+                continue
+            key = name if size is None else '{} {}'.format(name, size)
+            self.stderr.write('Running {}'.format(key))
+
+            # warm up imports, templates and connections
+            before()
+            self.get(client, url())
+
+            timings, queries = [], []
+            for _ in range(options['requests']):
+                before()
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    self.get(client, url())
+                    timings.append(time.perf_counter() - started)
+                queries.append(len(captured))
+
+            # allocations are measured apart, tracing slows everything down
+            before()
+            tracemalloc.start()
+            self.get(client, url())
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            timings.sort()
+            results[key] = collections.OrderedDict(
+                [('p{}_ms'.format(p),
+                  round(performance.percentile(timings, p) * 1000, 2))
+                 for p in (50, 95, 99)] +
+                [('queries', max(queries)),
+                 ('alloc_kib', round(peak / 1024.0, 1))])
+        return results
+
+    def get(self, client, url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise CommandError('{} answered {}'.format(url,
+                                                       response.status_code))
+        return response
+
+    def report(self, results, baseline):
+        row = '{:<34} {:>9} {:>9} {:>9} {:>8} {:>10}'
+        self.stdout.write(row.format('scenario', 'p50 ms', 'p95 ms',
+                                     'p99 ms', 'queries', 'alloc KiB'))
+        for key, result in results.items():
+            self.stdout.write(row.format(key, *result.values()))
+            if baseline and key in baseline:
+                self.stdout.write(row.format(
+                    '  baseline', *[baseline[key].get(figure, '-')
+                                    for figure in result]))
+
+    def compare(self, results, baseline, tolerance):
+        """
+        :return: list of strings describing the regressions
+        """
+        regressions = []
+        for key, result in results.items():
+            if key not in baseline:
+                continue
+            for figure, exact in COMPARED:
+                expected = baseline[key].get(figure)
+                if expected is None or result.get(figure) is None:
+                    # not measured by the run which saved the baseline
+                    continue
+                allowed = expected * (1 if exact else 1 + tolerance)
+                if result[figure] > allowed:
+                    regressions.append('{} {}: {} > {}'.format(
+                        key, figure, result[figure], expected))
+        return regressions
@@ -0,0 +1,178 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.template.loader import render_to_string
+
+from microsite_backend import settings
+from vizmanager.models import Microsite
+from vizmanager.theme_files import encode_variants
+from vizmanager.views import MicrositeDetailView
+
+MANIFEST = 'manifest.json'
+# file extension of each precompressed variant
+EXTENSIONS = {'identity': '', 'gzip': '.gz', 'br': '.br'}
+
+
+def render_microsite(pk):
+    """
+    Render the page of a microsite the way MicrositeDetailView does
+    :param pk: integer, primary key of the microsite
+    :return: (version, string of HTML), or None if the microsite is gone
+    """
+    microsite = Microsite.objects.with_content().filter(pk=pk).first()
+    if microsite is None:
+        return None
+    view = MicrositeDetailView(object=microsite, kwargs={'pk': pk})
+    content = render_to_string(view.get_template_names(),
+                               view.get_context_data(object=microsite))
+    return microsite.version, content
+
+
+def write_file(path, data):
+    """
+    Replace a file atomically, so the web server never serves a partially
+    written page
+    :param path: string, path of the file
+    :param data: bytes
+    :return: None
+    """
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def build_microsite(job):
+    """
+    Render a microsite into <output>/<pk>/index.html with its precompressed
+    siblings. Runs in the worker processes.
+    :param job: (output folder, primary key of the microsite)
+    :return: (primary key, version rendered or None if the microsite is gone)
+    """
+    output, pk = job
+    page = render_microsite(pk)
+    if page is None:
+        return pk, None
+    version, content = page
+    path = os.path.join(output, str(pk), 'index.html')
+    for encoding, data in encode_variants(content).items():
+        write_file(path + EXTENSIONS[encoding], data)
+    return pk, version
+
+
+def copy_static(output):
+    """
+    Copy the collected static files (see collectstatic) into the output folder,
+    where the `{% static %}` links of the pages point when the folder is
+    served at the root of the site. Files already copied are skipped.
+    :param output: string, folder the microsites are built into
+    :return: number of files copied, None if STATIC_URL is on another host
+    """
+    url = urlsplit(settings.STATIC_URL)
+    if url.netloc:
+        return None
+    target = os.path.join(output, url.path.strip('/'))
+    copied = 0
+    for folder, _, names in os.walk(settings.STATIC_ROOT):
+        destination = os.path.join(
+            target, os.path.relpath(folder, settings.STATIC_ROOT))
+        os.makedirs(destination, exist_ok=True)
+        for name in names:
+            source = os.path.join(folder, name)
+            path = os.path.join(destination, name)
+            stat = os.stat(source)
+            try:
+                copy = os.stat(path)
+                if copy.st_size == stat.st_size and \
+                        copy.st_mtime_ns == stat.st_mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+            shutil.copy2(source, path)
+            copied += 1
+    return copied
+
+
+class Command(BaseCommand):
+    help = 'Render every microsite into a tree of static HTML files ' \
+           '(<pk>/index.html, with .gz and .br siblings) that a web server ' \
+           'or a CDN can serve directly, along with the collected static ' \
+           'files. Only microsites changed since the last build are ' \
+           'rendered again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output',
+                            default=settings.STATIC_MICROSITES_ROOT,
+                            help='Folder to build into, defaults to '
+                                 'STATIC_MICROSITES_ROOT')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of rendering processes, defaults to '
+                                 'the number of cores')
+        parser.add_argument('--force', action='store_true',
+                            help='Render all microsites, changed or not')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        manifest_path = os.path.join(output, MANIFEST)
+        try:
+            with open(manifest_path) as manifest_file:
+                built = json.load(manifest_file)
+        except (IOError, ValueError):
+            built = {}
+        if options['force']:
+            built = {}
+
+        versions = dict((str(pk), version) for pk, version in
+                        Microsite.objects.values_list('pk', 'version'))
+        outdated = [int(pk) for pk, version in versions.items()
+                    if built.get(pk) != version]
+        removed = [pk for pk in built if pk not in versions]
+
+        for pk in removed:
+            shutil.rmtree(os.path.join(output, pk), ignore_errors=True)
+            del built[pk]
+
+        if outdated:
+            # forked workers must not share the connection of this process
+            connections.close_all()
+            jobs = [(output, pk) for pk in sorted(outdated)]
+            with multiprocessing.Pool(max(options['workers'] or 1, 1)) as pool:
+                for pk, version in pool.imap_unordered(build_microsite, jobs):
+                    if version is None:
+                        shutil.rmtree(os.path.join(output, str(pk)),
+                                      ignore_errors=True)
+                        built.pop(str(pk), None)
+                    else:
+                        built[str(pk)] = version
+
+        copied = copy_static(output)
+        if copied is None:
+            self.stdout.write('Static files are served from STATIC_URL, '
+                              'not copied')
+        elif not os.path.isdir(settings.STATIC_ROOT):
+            self.stdout.write(self.style.WARNING(
+                'No static files found in {}, run collectstatic first'
+                .format(settings.STATIC_ROOT)))
+        else:
+            self.stdout.write('{} static files copied'.format(copied))
+
+        # written last, an interrupted build is resumed by the next one
+        write_file(manifest_path, json.dumps(built, sort_keys=True, indent=2)
+                   .encode('utf-8'))
+        self.stdout.write(self.style.SUCCESS(
+            '{} microsites rendered, {} removed, {} unchanged'.format(
+                len(outdated), len(removed), len(versions) - len(outdated))))
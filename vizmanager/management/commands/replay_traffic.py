@@ -0,0 +1,216 @@
+import collections
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from vizmanager.performance import percentile
+
+
+def read_log(paths):
+    """
+    Read the request lines logged by vizmanager.performance, skipping any
+    other output mixed into the files
+    :param paths: list of file paths, '-' for the standard input
+    :return: generator of dictionaries with at least 'path'
+    """
+    for path in paths:
+        with open(0 if path == '-' else path) as log_file:
+            for line in log_file:
+                line = line.strip()
+                if not line.startswith('{'):
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and 'path' in entry:
+                    yield entry
+
+
+class Recorder(object):
+    """
+    Latencies (from the scheduled start of each request) and failures per
+    endpoint
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.service_times = collections.defaultdict(list)
+        self.errors = collections.Counter()
+
+    def add(self, endpoint, latency, service_time, ok):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.service_times[endpoint].append(service_time)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+class Command(BaseCommand):
+    help = 'Replay request logs of PerformanceMiddleware (JSON lines on ' \
+           'the vizmanager.performance logger) against a running ' \
+           'instance, and report throughput and latency percentiles per ' \
+           'endpoint. Requests are sent open loop: at their recorded ' \
+           'times, or at --rate per second, whether earlier requests ' \
+           'returned or not, so queueing in the server shows in the ' \
+           'latencies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='+',
+                            help='Log files to replay, - for the standard '
+                                 'input')
+        parser.add_argument('--target', required=True,
+                            help='Base URL of the instance, e.g. '
+                                 'http://localhost:8000')
+        parser.add_argument('--concurrency', type=int, default=64,
+                            help='Maximum requests in flight; further '
+                                 'requests wait, and their wait counts in '
+                                 'their latency')
+        parser.add_argument('--rate', type=float,
+                            help='Send requests at this average rate per '
+                                 'second (Poisson arrivals) instead of at '
+                                 'their recorded times')
+        parser.add_argument('--speed', type=float, default=1.0,
+                            help='Replay recorded times this many times '
+                                 'faster')
+        parser.add_argument('--closed-loop', action='store_true',
+                            help='Ignore arrival times, each of the '
+                                 '--concurrency clients sends its next '
+                                 'request as soon as the previous one '
+                                 'returned')
+        parser.add_argument('--limit', type=int,
+                            help='Replay at most this many requests')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds to wait for each response')
+        parser.add_argument('--seed', type=int,
+                            help='Random seed of the --rate arrivals')
+        parser.add_argument('--output',
+                            help='Also write the results to this JSON file')
+
+    def handle(self, *args, **options):
+        entries = [entry for entry in read_log(options['logs'])
+                   if entry.get('method', 'GET') == 'GET']
+        if options['limit']:
+            entries = entries[:options['limit']]
+        if not entries:
+            raise CommandError('No GET requests found in the logs')
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=options['concurrency'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        recorder = Recorder()
+        target = options['target'].rstrip('/')
+
+        def send(entry, scheduled):
+            url = target + entry['path']
+            if entry.get('query'):
+                url = '{}?{}'.format(url, entry['query'])
+            started = time.perf_counter()
+            try:
+                ok = session.get(url, timeout=options['timeout']).ok
+            except requests.RequestException:
+                ok = False
+            finished = time.perf_counter()
+            recorder.add(entry.get('url_name') or entry['path'],
+                         finished - (scheduled or started),
+                         finished - started, ok)
+
+        started = time.perf_counter()
+        if options['closed_loop']:
+            self.closed_loop(entries, send, options['concurrency'])
+        else:
+            self.open_loop(entries, send, self.arrivals(entries, options),
+                           options['concurrency'])
+        elapsed = time.perf_counter() - started
+
+        results = self.summarise(recorder, elapsed)
+        self.report(results, len(entries), elapsed)
+        if options['output']:
+            with open(options['output'], 'w') as results_file:
+                json.dump(results, results_file, indent=2, sort_keys=True)
+
+    def arrivals(self, entries, options):
+        """
+        :return: list of the offsets, in seconds from the start of the
+                 replay, at which to send each request
+        """
+        if options['rate']:
+            generator = random.Random(options['seed'])
+            offsets, offset = [], 0.0
+            for _ in entries:
+                offsets.append(offset)
+                offset += generator.expovariate(options['rate'])
+            return offsets
+
+        if any('timestamp' not in entry for entry in entries):
+            raise CommandError('The logs have no timestamps, use --rate or '
+                               '--closed-loop')
+        # several workers append to the logs, which are only roughly in order
+        first = min(entry['timestamp'] for entry in entries)
+        return [(entry['timestamp'] - first) / options['speed']
+                for entry in entries]
+
+    def open_loop(self, entries, send, offsets, concurrency):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            start = time.perf_counter()
+            for entry, offset in sorted(zip(entries, offsets),
+                                        key=lambda pair: pair[1]):
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, entry, start + offset)
+
+    def closed_loop(self, entries, send, concurrency):
+        pending = iter(entries)
+        lock = threading.Lock()
+
+        def client():
+            while True:
+                with lock:
+                    entry = next(pending, None)
+                if entry is None:
+                    return
+                send(entry, None)
+
+        clients = [threading.Thread(target=client)
+                   for _ in range(concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+
+    def summarise(self, recorder, elapsed):
+        results = collections.OrderedDict()
+        for endpoint in sorted(recorder.latencies):
+            latencies = sorted(recorder.latencies[endpoint])
+            service_times = sorted(recorder.service_times[endpoint])
+            results[endpoint] = collections.OrderedDict((
+                ('requests', len(latencies)),
+                ('errors', recorder.errors[endpoint]),
+                ('rps', round(len(latencies) / elapsed, 2)),
+                ('p50_ms', round(percentile(latencies, 50) * 1000, 1)),
+                ('p95_ms', round(percentile(latencies, 95) * 1000, 1)),
+                ('p99_ms', round(percentile(latencies, 99) * 1000, 1)),
+                ('service_p99_ms',
+                 round(percentile(service_times, 99) * 1000, 1)),
+            ))
+        return results
+
+    def report(self, results, total, elapsed):
+        row = '{:<38} {:>8} {:>6} {:>8} {:>9} {:>9} {:>9} {:>11}'
+        self.stdout.write(row.format('endpoint', 'requests', 'errors',
+                                     'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                                     'service p99'))
+        for endpoint, result in results.items():
+            self.stdout.write(row.format(endpoint, *result.values()))
+        self.stdout.write('{} requests in {:.1f}s, {:.1f} requests/s'
+                          .format(total, elapsed, total / elapsed))
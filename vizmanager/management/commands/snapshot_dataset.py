@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from vizmanager import snapshots, upstream
+from vizmanager.models import Dataset
+
+
+class Command(BaseCommand):
+    help = 'Download the facts of OpenSpending datasets into local columnar ' \
+           'snapshots (see vizmanager/snapshots.py), from which their ' \
+           'aggregates are computed without going upstream. Run it again ' \
+           'to download the facts added since; a change of the dimensions ' \
+           'or measures of a dataset downloads all its facts again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('codes', nargs='*',
+                            help='OpenSpending codes of the datasets')
+        parser.add_argument('--all', action='store_true',
+                            help='Snapshot the datasets of every microsite')
+        parser.add_argument('--page-size', type=int,
+                            help='Number of facts downloaded per request')
+        parser.add_argument('--full', action='store_true',
+                            help='Download all the facts again')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            codes = Dataset.objects.exclude(code='').order_by('code')\
+                .values_list('code', flat=True).distinct()
+        elif options['codes']:
+            codes = options['codes']
+        else:
+            raise CommandError('Give the codes of the datasets, or --all')
+
+        for code in codes:
+            datasets = list(Dataset.objects.filter(code=code).order_by('pk'))
+            if not datasets:
+                raise CommandError('No dataset has the code {}'.format(code))
+            # datasets of a code share its snapshot, roll it up for the
+            # initial dimension of each of them
+            initial_dimensions = sorted(set(
+                dataset.initial_dimension for dataset in datasets
+                if dataset.initial_dimension))
+            try:
+                snapshot, downloaded = snapshots.take_snapshot(
+                    datasets[0], full=options['full'],
+                    page_size=options['page_size'],
+                    initial_dimensions=initial_dimensions)
+            except (RuntimeError, upstream.UpstreamError) as e:
+                raise CommandError('{}\nRun the command again to resume.'
+                                   .format(e))
+            self.stdout.write('{}: {} facts downloaded, {} in the snapshot'
+                              .format(code, downloaded, snapshot.rows))
@@ -0,0 +1,87 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from microsite_backend import settings
+from vizmanager import upstream
+from vizmanager.models import KPIFilterTerm, KPIFilterTermSuffix, \
+    SyncState, fold, word_suffixes
+
+
+class Command(BaseCommand):
+    help = 'Download the KPI_API filter vocabularies (organizations, years, ' \
+           'budget phases) used by the KPI autocompletes. Run it ' \
+           'periodically to keep them fresh.'
+
+    SYNC_NAME = 'kpi-filters'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kinds', nargs='*',
+                            help='Vocabularies to sync among {}, all by '
+                                 'default'
+                                 .format(', '.join(KPIFilterTerm.KINDS)))
+
+    def handle(self, *args, **options):
+        for kind in options['kinds']:
+            if kind not in KPIFilterTerm.KINDS:
+                raise CommandError('Unknown vocabulary {}'.format(kind))
+
+        state, _ = SyncState.objects.get_or_create(name=self.SYNC_NAME)
+        state.started = timezone.now()
+        state.finished = None
+        state.save()
+
+        for kind in options['kinds'] or KPIFilterTerm.KINDS:
+            url = '{}/filters/{}'.format(settings.KPI_API, kind)
+            try:
+                response = upstream.get(url)
+            except upstream.UpstreamError as e:
+                raise CommandError(e)
+            if not response.ok:
+                raise CommandError('{} answered {}'
+                                   .format(url, response.status_code))
+
+            created, updated, removed = self.store(kind, response.json())
+            self.stdout.write('{}: {} new, {} changed, {} removed'
+                              .format(kind, created, updated, removed))
+
+        state.finished = timezone.now()
+        state.save()
+        self.stdout.write(self.style.SUCCESS('KPI filters synced'))
+
+    @transaction.atomic
+    def store(self, kind, values):
+        """
+        Upsert a whole vocabulary, touching only the terms that changed
+        :param kind: vocabulary, one of KPIFilterTerm.KINDS
+        :param values: list of {"url": ..., "label": ...} from KPI_API
+        :return: numbers of created, updated and removed terms
+        """
+        labels = dict((value['url'], value['label']) for value in values)
+        existing = dict((term.url, term) for term in
+                        KPIFilterTerm.objects.filter(kind=kind))
+
+        _, removed = KPIFilterTerm.objects.filter(kind=kind)\
+            .exclude(url__in=list(labels)).delete()
+
+        updated = 0
+        for url, label in labels.items():
+            term = existing.get(url)
+            if term is not None and term.label != label:
+                term.label = label
+                term.save()
+                updated += 1
+
+        created = [KPIFilterTerm(kind=kind, url=url, label=label,
+                                 search_label=fold(label))
+                   for url, label in labels.items() if url not in existing]
+        KPIFilterTerm.objects.bulk_create(created)
+        # bulk_create skips save(), index the new terms here
+        KPIFilterTermSuffix.objects.bulk_create([
+            KPIFilterTermSuffix(term=term, suffix=suffix)
+            for term in KPIFilterTerm.objects.filter(kind=kind,
+                                                     suffixes__isnull=True)
+            for suffix in word_suffixes(term.search_label)])
+
+        return len(created), updated, \
+            removed.get(KPIFilterTerm._meta.label, 0)
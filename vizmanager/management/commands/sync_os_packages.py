@@ -0,0 +1,99 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from microsite_backend import settings
+from vizmanager import cache, upstream
+from vizmanager.models import OpenSpendingPackage, OpenSpendingPackageGram, \
+    SyncState, ngrams
+
+
+class Command(BaseCommand):
+    help = 'Download the OpenSpending package catalogue into the local ' \
+           'search index used by the dataset autocomplete. Run it ' \
+           'periodically to keep the index fresh; an interrupted run is ' \
+           'resumed where it stopped.'
+
+    SYNC_NAME = 'os-packages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=500,
+                            help='Number of packages downloaded per request')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an interrupted run and start over')
+
+    def handle(self, *args, **options):
+        # TODO: they really use a different base URL for search, see
+        # views.DatasetAutocomplete
+        search_url = settings.OS_API.replace('api/3', '/search/package')
+        page_size = options['page_size']
+
+        state, _ = SyncState.objects.get_or_create(name=self.SYNC_NAME)
+        if options['restart'] or state.started is None or \
+                state.finished is not None:
+            state.started = timezone.now()
+            state.cursor = 0
+            state.finished = None
+            state.save()
+        elif state.cursor:
+            self.stdout.write('Resuming at package {}'.format(state.cursor))
+
+        while True:
+            try:
+                response = upstream.get(search_url, params={
+                    'size': page_size, 'from': state.cursor})
+            except upstream.UpstreamError as e:
+                raise CommandError('{}\nRun the command again to resume.'
+                                   .format(e))
+            if not response.ok:
+                raise CommandError('{} answered {}\nRun the command again to '
+                                   'resume.'.format(search_url,
+                                                    response.status_code))
+            page = response.json()
+            if not page:
+                break
+
+            with transaction.atomic():
+                self.store(page)
+                state.cursor += len(page)
+                state.save()
+            self.stdout.write('{} packages synced'.format(state.cursor))
+
+        # packages not seen during this run were removed from OpenSpending
+        _, removed = OpenSpendingPackage.objects\
+            .filter(synced__lt=state.started).delete()
+        state.finished = timezone.now()
+        state.save()
+        self.stdout.write(self.style.SUCCESS(
+            'Catalogue synced, {} packages, {} removed'
+            .format(state.cursor,
+                    removed.get(OpenSpendingPackage._meta.label, 0))))
+
+    def store(self, page):
+        """
+        Upsert a page of packages, rebuilding the index only for new packages
+        and packages whose title changed
+        :param page: list of packages as returned by OpenSpending's search
+        :return: None
+        """
+        now = timezone.now()
+        titles = dict((package['id'], package['package'].get('title') or
+                       package['id']) for package in page)
+        existing = OpenSpendingPackage.objects.in_bulk(list(titles))
+
+        changed = [code for code, title in titles.items()
+                   if code not in existing or existing[code].title != title]
+        OpenSpendingPackage.objects.filter(code__in=changed).delete()
+        OpenSpendingPackage.objects.bulk_create([
+            OpenSpendingPackage(code=code, title=titles[code],
+                                search_title=cache.normalise_query(
+                                    titles[code]),
+                                synced=now)
+            for code in changed])
+        OpenSpendingPackageGram.objects.bulk_create([
+            OpenSpendingPackageGram(package_id=code, gram=gram)
+            for code in changed
+            for gram in ngrams(cache.normalise_query(titles[code]))])
+
+        OpenSpendingPackage.objects.filter(code__in=list(titles))\
+            .update(synced=now)
@@ -0,0 +1,39 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from microsite_backend import settings
+from vizmanager.models import Theme
+from vizmanager.theme_files import theme_file_path
+
+
+class Command(BaseCommand):
+    help = "Rebuild OS Viewer's themes folder from the themes in the " \
+           "database, rewriting only the files whose content changed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prune', action='store_true',
+                            help='Also delete theme files no theme maps to, '
+                                 'e.g. left behind by renamed themes')
+
+    def handle(self, *args, **options):
+        written = 0
+        paths = set()
+        themes = Theme.objects.all()
+        for theme in themes:
+            paths.add(theme_file_path(theme.__str__()))
+            if theme.create_theme_file():
+                written += 1
+
+        pruned = 0
+        folder = settings.OS_VIEWER_THEMES_FOLDER
+        if options['prune'] and os.path.isdir(folder):
+            for filename in os.listdir(folder):
+                path = os.path.join(folder, filename)
+                if filename.endswith('.json') and path not in paths:
+                    os.remove(path)
+                    pruned += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            '{} themes, {} files written, {} pruned'
+            .format(len(themes), written, pruned)))
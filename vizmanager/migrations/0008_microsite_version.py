@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vizmanager', '0007_auto_20170829_1450'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='microsite',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
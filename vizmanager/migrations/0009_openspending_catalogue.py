@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:09
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vizmanager', '0008_microsite_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenSpendingPackage',
+            fields=[
+                ('code', models.CharField(max_length=200, primary_key=True, serialize=False, verbose_name='Code')),
+                ('title', models.CharField(max_length=500, verbose_name='Title')),
+                ('search_title', models.CharField(db_index=True, max_length=500)),
+                ('synced', models.DateTimeField(verbose_name='Synced')),
+            ],
+            options={
+                'verbose_name': 'OpenSpending Package',
+                'verbose_name_plural': 'OpenSpending Packages',
+            },
+        ),
+        migrations.CreateModel(
+            name='OpenSpendingPackageGram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(db_index=True, max_length=3)),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='grams', to='vizmanager.OpenSpendingPackage')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('name', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('started', models.DateTimeField(null=True)),
+                ('cursor', models.PositiveIntegerField(default=0)),
+                ('finished', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='openspendingpackagegram',
+            unique_together=set([('gram', 'package')]),
+        ),
+    ]
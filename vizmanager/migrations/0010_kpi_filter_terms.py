@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 17:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vizmanager', '0009_openspending_catalogue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KPIFilterTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('organizations', 'organizations'), ('years', 'years'), ('phases', 'phases')], max_length=20)),
+                ('url', models.URLField(verbose_name='Url')),
+                ('label', models.CharField(max_length=200, verbose_name='Label')),
+                ('search_label', models.CharField(max_length=200)),
+            ],
+            options={
+                'verbose_name': 'KPI Filter Term',
+                'verbose_name_plural': 'KPI Filter Terms',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='kpifilterterm',
+            unique_together=set([('kind', 'url')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='kpifilterterm',
+            index_together=set([('kind', 'search_label')]),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def index_terms(apps, schema_editor):
+    KPIFilterTerm = apps.get_model('vizmanager', 'KPIFilterTerm')
+    KPIFilterTermSuffix = apps.get_model('vizmanager', 'KPIFilterTermSuffix')
+    suffixes = []
+    for term in KPIFilterTerm.objects.all():
+        words = term.search_label.split(' ')
+        suffixes.extend(KPIFilterTermSuffix(term=term, suffix=suffix)
+                        for suffix in set(' '.join(words[i:])
+                                          for i in range(len(words))))
+    KPIFilterTermSuffix.objects.bulk_create(suffixes)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vizmanager', '0010_kpi_filter_terms'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KPIFilterTermSuffix',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('suffix', models.CharField(db_index=True, max_length=200)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='kpifilterterm',
+            name='search_label',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='kpifiltertermsuffix',
+            name='term',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='suffixes', to='vizmanager.KPIFilterTerm'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='kpifiltertermsuffix',
+            unique_together=set([('term', 'suffix')]),
+        ),
+        migrations.RunPython(index_terms, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,72 @@
-from django.forms.models import model_to_dict
+import threading
+from contextlib import contextmanager
+
+
+_tracking = threading.local()
+
+
+@contextmanager
+def untracked():
+    """
+    Instances of ModelDiffMixin models created or loaded inside this block
+    don't record their initial values, which saves the cost for bulk reads.
+    They report no changes.
+    """
+    previous = getattr(_tracking, 'disabled', False)
+    _tracking.disabled = True
+    try:
+        yield
+    finally:
+        _tracking.disabled = previous
 
 
 class ModelDiffMixin(object):
     """
     A model mixin that tracks model fields' values and provide some useful api
     to know what fields have been changed.
+    Only the fields named in `tracked_fields` are tracked, all concrete fields
+    if it is None. Their raw values are copied from the instance's __dict__
+    when it is created or loaded, so loading an instance stays cheap.
     """
+    tracked_fields = None
+
     def __init__(self, *args, **kwargs):
         super(ModelDiffMixin, self).__init__(*args, **kwargs)
-        self.__initial = self._dict
+        self._snapshot()
+
+    @classmethod
+    def _diff_fields(cls):
+        """
+        (name, attname) pairs of the tracked fields, computed once per class
+        """
+        if '_diff_fields_cache' not in cls.__dict__:
+            cls._diff_fields_cache = [
+                (field.name, field.attname)
+                for field in cls._meta.concrete_fields
+                if cls.tracked_fields is None or
+                field.name in cls.tracked_fields]
+        return cls._diff_fields_cache
+
+    def _snapshot(self):
+        if getattr(_tracking, 'disabled', False):
+            self._diff_initial = None
+            return
+        # deferred fields are missing from __dict__ and are not tracked
+        values = self.__dict__
+        self._diff_initial = dict(
+            (attname, values[attname])
+            for name, attname in self._diff_fields() if attname in values)
 
     @property
     def diff(self):
-        d1 = self.__initial
-        d2 = self._dict
-        diffs = [(k, (v, d2[k])) for k, v in d1.items() if v != d2[k]]
+        initial = self._diff_initial
+        if not initial:
+            return {}
+        current = self.__dict__
+        diffs = [(name, (initial[attname], current[attname]))
+                 for name, attname in self._diff_fields()
+                 if attname in initial and attname in current and
+                 initial[attname] != current[attname]]
         return dict(diffs)
 
     @property
@@ -36,9 +88,4 @@ class ModelDiffMixin(object):
         Saves model and set initial state.
         """
         super(ModelDiffMixin, self).save(*args, **kwargs)
-        self.__initial = self._dict
-
-    @property
-    def _dict(self):
-        return model_to_dict(self, fields=[field.name for field in
-                                           self._meta.fields])
+        self._snapshot()
@@ -1,17 +1,20 @@
 import json
-import os
-import pdb
+import unicodedata
 import urllib
-import requests
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.core.urlresolvers import reverse
+from django.db import models, transaction
 from django.utils.translation import ugettext_lazy as _
 
 from colorfield.fields import ColorField
 
 from microsite_backend import settings
+from vizmanager import cache, invalidation, theme_files, upstream
 from vizmanager.model_mixins import ModelDiffMixin
+from vizmanager.tree import HierarchyTree
 
 
 class Organization(models.Model):
@@ -91,6 +94,21 @@ class KPI(models.Model):
         }
         return '{}{}'.format(url, urllib.parse.urlencode(params))
 
+    def as_document(self):
+        """
+        Build the API representation of this KPI
+        :return: dictionary
+        """
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'organization': {'url': self.organization.url,
+                             'name': self.organization.name},
+            'year': {'url': self.year.url, 'name': self.year.name},
+            'phase': {'url': self.phase.url, 'name': self.phase.name},
+            'embed_url': self.embed_url(),
+        }
+
 
 class Municipality(models.Model):
     name = models.CharField(max_length=200, verbose_name=_('Name'))
@@ -117,6 +135,21 @@ class Profile(models.Model):
         return '{}'.format(self.user.username)
 
 
+class MicrositeManager(models.Manager):
+
+    def with_content(self):
+        """
+        Microsites along with everything shown on their page, fetched in a
+        fixed number of queries no matter how many datasets and KPIs they have
+        :return: QuerySet of microsites
+        """
+        return self.select_related('selected_theme', 'municipality', 'forum')\
+            .prefetch_related(
+                models.Prefetch('dataset_set'),
+                models.Prefetch('kpi_set', queryset=KPI.objects.select_related(
+                    'phase', 'year', 'organization')))
+
+
 class Microsite(models.Model):
     name = models.CharField(max_length=200, verbose_name=_('Name'))
     municipality = models.ForeignKey(Municipality,
@@ -151,6 +184,16 @@ class Microsite(models.Model):
                                    default='OpenSpending',
                                    choices=(('OpenSpending', 'OpenSpending'),
                                             ('Babbage-ui', 'Babbage-ui'),))
+    # bumped whenever anything shown on the microsite page changes, rendered
+    # pages are cached per version
+    version = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = MicrositeManager()
+
+    # top level fields of the API representation, see as_document
+    DOCUMENT_FIELDS = ('name', 'municipality', 'language', 'layout',
+                       'forum_platform', 'stacked_datasets', 'render_from',
+                       'version', 'theme', 'datasets', 'kpis')
 
     def create_forum(self):
         self.forum = Forum()
@@ -158,15 +201,84 @@ class Microsite(models.Model):
 
     def save(self, *args, **kwargs):
         """
-        Prior to saving the Microsite, create its Forum
+        Prior to saving the Microsite, bump its version, and create its Forum
+        after saving it
         :param args: default args
         :param kwargs: default kwargs
         :return: None
         """
+        bump = not self._state.adding
+        if bump:
+            # increment in the database so a concurrent bump is never lost
+            self.version = models.F('version') + 1
         super(self.__class__, self).save(*args, **kwargs)
+        if bump:
+            self.refresh_from_db(fields=['version'])
+            invalidation.purge([self.pk])
         if not hasattr(self, 'forum'):
             self.create_forum()
 
+    def as_document(self, fields=None):
+        """
+        Build the API representation of this microsite, with its theme,
+        datasets and KPIs included. Use Microsite.objects.with_content() to
+        fetch microsites for it.
+        :param fields: iterable of the DOCUMENT_FIELDS to include, all of
+                       them by default; the id is always included
+        :return: dictionary
+        """
+        fields = self.DOCUMENT_FIELDS if fields is None else fields
+        builders = {
+            'name': lambda: self.name,
+            'municipality': lambda: {'id': self.municipality.pk,
+                                     'name': self.municipality.name,
+                                     'country': self.municipality.country},
+            'language': lambda: self.language,
+            'layout': lambda: self.layout,
+            'forum_platform': lambda: self.forum_platform,
+            'stacked_datasets': lambda: self.stacked_datasets,
+            'render_from': lambda: self.render_from,
+            'version': lambda: self.version,
+            'theme': lambda: self.selected_theme.as_document()
+            if self.selected_theme is not None else None,
+            'datasets': lambda: [dataset.as_document()
+                                 for dataset in self.dataset_set.all()],
+            'kpis': lambda: [kpi.as_document() for kpi in self.kpi_set.all()],
+        }
+        document = {'id': self.pk}
+        for field in fields:
+            document[field] = builders[field]()
+        return document
+
+    @classmethod
+    def bump_versions(cls, pks):
+        """
+        Invalidate the cached pages of the given microsites: bump their
+        versions now, and purge their caches once the transaction commits
+        :param pks: iterable of microsite primary keys, None values are ignored
+        :return: None
+        """
+        pks = set(pk for pk in pks if pk is not None)
+        if not pks:
+            return
+        cls.objects.filter(pk__in=pks).update(version=models.F('version') + 1)
+        invalidation.purge(pks)
+
+    @classmethod
+    def current_version(cls, pk):
+        """
+        Get the version of a microsite, from the cache if possible
+        :param pk: primary key of the microsite
+        :return: integer version, or None if the microsite does not exist
+        """
+        version = cache.get_microsite_version(pk)
+        if version is None:
+            version = cls.objects.filter(pk=pk)\
+                .values_list('version', flat=True).first()
+            if version is not None:
+                cache.set_microsite_version(pk, version)
+        return version
+
     def __str__(self):
         return '{}'.format(self.name)
 
@@ -204,7 +316,9 @@ class Theme(models.Model):
 
     def json(self):
         """
-        Build the json representation of this theme that is needed by OS Viewer
+        Build the json representation of this theme that is needed by OS
+        Viewer, with sorted keys so that the same theme always gives the same
+        string
         :return: JSON string
         """
         return json.dumps({
@@ -216,36 +330,75 @@ class Theme(models.Model):
             'header': {},
             'footer': {},
             'socialMedia': {}
-        })
+        }, sort_keys=True)
 
-    def create_theme_file(self):
+    def as_document(self):
         """
-        Create the file representing this theme and save it to OS Viewer's
-        themes folder
-        :return: None
+        Build the API representation of this theme
+        :return: dictionary
         """
-        folder = '{}'.format(settings.OS_VIEWER_THEMES_FOLDER)
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'colors': {
+                'brand': self.brand_color,
+                'sidebar': self.sidebar_color,
+                'content': self.content_color
+            },
+            'json_url': self.json_url(),
+        }
 
-        # create the folder if it doesn't exist to avoid crashing
-        if not os.path.exists(folder):
-            os.makedirs(folder)
+    def publish(self, content=None):
+        """
+        Precompress the JSON of this theme and make it available to the theme
+        JSON endpoint under its content digest
+        :param content: string, JSON of this theme if already built
+        :return: string, content digest of the JSON
+        """
+        content = self.json() if content is None else content
+        digest = theme_files.content_digest(content)
+        cache.set_theme_asset(self.pk, digest,
+                              theme_files.encode_variants(content))
+        return digest
 
-        file_path = '{folder}/{filename}.json'.format(
-            folder=settings.OS_VIEWER_THEMES_FOLDER,
-            filename=self.__str__())
-        theme_file = open(file_path, 'w')
-        theme_file.write(self.json())
-        theme_file.close()
+    def json_url(self):
+        """
+        Build the content addressed URL of this theme's JSON, which can be
+        cached forever since it changes whenever the theme does
+        :return: URL string
+        """
+        digest = cache.get_theme_digest(self.pk)
+        if digest is None:
+            digest = self.publish()
+        return reverse('vizmanager:theme-json',
+                       kwargs={'pk': self.pk, 'digest': digest})
+
+    def create_theme_file(self):
+        """
+        Create the file representing this theme and save it to OS Viewer's
+        themes folder, unless it is up to date already
+        :return: boolean, whether the file was written
+        """
+        return theme_files.write_theme_file(self.__str__(), self.json())
 
     def save(self, *args, **kwargs):
         """
-        Prior to saving the theme, create its theme file
+        After saving the theme, publish its JSON and queue the writing of its
+        theme file once the transaction commits
         :param args: default args
         :param kwargs: default kwargs
         :return: None
         """
-        self.create_theme_file()
         super(self.__class__, self).save(*args, **kwargs)
+        pk, name, content = self.pk, self.__str__(), self.json()
+
+        def materialise():
+            self.publish(content)
+            if settings.THEME_FILES_WRITE_BEHIND:
+                theme_files.enqueue(pk, name, content)
+            else:
+                theme_files.write_theme_file(name, content)
+        transaction.on_commit(materialise)
 
     def __str__(self):
         return '{}'.format(self.name)
@@ -277,6 +430,45 @@ class Hierarchy(models.Model):
         verbose_name_plural = _('Hierarchies')
 
 
+class DatasetManager(models.Manager):
+
+    def prefetch_os_models(self, datasets=None):
+        """
+        Get the OpenSpending models of many datasets at once, downloading the
+        ones missing from the shared cache concurrently and each code only
+        once. Datasets whose model can't be fetched are left alone, calling
+        get_os_model on them raises the error as usual.
+        :param datasets: iterable of Datasets, all datasets by default
+        :return: list of the datasets, with their os_model set
+        """
+        datasets = list(self.all() if datasets is None else datasets)
+
+        by_code = defaultdict(list)
+        for dataset in datasets:
+            if dataset.code == '':
+                dataset.get_os_model()
+            elif not hasattr(dataset, 'os_model'):
+                by_code[dataset.code].append(dataset)
+        if not by_code:
+            return datasets
+
+        workers = min(settings.OS_MODEL_PREFETCH_WORKERS, len(by_code))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict(
+                (code, executor.submit(cache.get_os_model, code,
+                                       same_code[0].fetch_os_model))
+                for code, same_code in by_code.items())
+
+        for code, future in futures.items():
+            try:
+                os_model = future.result()
+            except (RuntimeError, IOError):
+                continue
+            for dataset in by_code[code]:
+                dataset.os_model = os_model
+        return datasets
+
+
 class Dataset(ModelDiffMixin, models.Model):
     name = models.CharField(max_length=200, verbose_name=_('Name'))
     microsite = models.ForeignKey(Microsite, verbose_name=_('Microsite'),
@@ -300,6 +492,12 @@ class Dataset(ModelDiffMixin, models.Model):
     initial_dimension = models.CharField(max_length=100, null=True)
     initial_measure = models.CharField(max_length=100, null=True)
 
+    objects = DatasetManager()
+
+    # only fields Dataset.save and vizmanager.signals look at need their
+    # changes tracked
+    tracked_fields = ('code', 'microsite')
+
     def save(self, *args, **kwargs):
         """
         Prior to saving a Dataset, make sure
@@ -336,6 +534,21 @@ class Dataset(ModelDiffMixin, models.Model):
         }
         return '{}{}'.format(url, urllib.parse.urlencode(params))
 
+    def as_document(self):
+        """
+        Build the API representation of this dataset
+        :return: dictionary
+        """
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'code': self.code,
+            'viz_type': self.viz_type,
+            'initial_dimension': self.initial_dimension,
+            'initial_measure': self.initial_measure,
+            'embed_url': self.embed_url(),
+        }
+
     def get_hierarchies(self):
         """
         Lists the hierarchies of this dataset
@@ -394,21 +607,28 @@ class Dataset(ModelDiffMixin, models.Model):
                 }
                 return self.os_model
 
-            # dataset with code, let's download the os_model
-            response = requests.get(self.os_model_url())
-            if response.status_code == 200:
-                self.os_model = response.json().get('model')
-            else:
-                # response from babbage API got an error, probably it doesn't
-                # contain this dataset's code
-                raise RuntimeError(
-                    'The configured OS_API is not working for this dataset.\n'
-                    'Please check the settings.py file.\n'
-                    'OS_API = {}.\n'
-                    'Dataset code = {}'
-                    .format(settings.OS_API, self.code))
+            # dataset with code, get the os_model from the shared cache or
+            # download it
+            self.os_model = cache.get_os_model(self.code, self.fetch_os_model)
         return self.os_model
 
+    def fetch_os_model(self):
+        """
+        Download the OpenSpending model of this dataset, bypassing all caches
+        :return: dictionary containing an OpenSpending model
+        """
+        response = upstream.get(self.os_model_url())
+        if response.status_code != 200:
+            # response from babbage API got an error, probably it doesn't
+            # contain this dataset's code
+            raise RuntimeError(
+                'The configured OS_API is not working for this dataset.\n'
+                'Please check the settings.py file.\n'
+                'OS_API = {}.\n'
+                'Dataset code = {}'
+                .format(settings.OS_API, self.code))
+        return response.json().get('model')
+
     def os_model_url(self):
         """
         Helper method to build the URL string to query the OS model data
@@ -416,21 +636,181 @@ class Dataset(ModelDiffMixin, models.Model):
         """
         return self.build_url('model')
 
-    def drilldown(self, hierarchy, cut):
+    def level_refs(self, level):
         """
-        Query OpenSpendings API to drilldown on given hierarchy and cut
-        :return: dictionary containing subjects, money spend, etc
+        Attribute refs identifying the members of a hierarchy level
+        :param level: string, name of a dimension of the OS model
+        :return: list of refs, the key ref first then the label ref if any
         """
-        return NotImplementedError
+        dimension = self.get_dimensions()[level]
+        refs = [ref for ref in (dimension.get('key_ref'),
+                                dimension.get('label_ref')) if ref]
+        if not refs:
+            refs = [attribute['ref'] for _, attribute
+                    in sorted(dimension.get('attributes', {}).items())][:1]
+        return list(OrderedDict.fromkeys(refs))
+
+    def next_level(self, hierarchy, cut):
+        """
+        First level of a hierarchy that is not cut yet
+        :param hierarchy: string, name of a hierarchy of the OS model
+        :param cut: dictionary of attribute refs to values
+        :return: string, name of the level, None if every level is cut
+        """
+        for level in self.get_hierarchies()[hierarchy]['levels']:
+            if not any(ref in cut for ref in self.level_refs(level)):
+                return level
+        return None
 
-    def build_tree(self, hierarchy):
+    def default_measure(self):
         """
-        Build the tree structure of the dataset on a given hierarchy
-        :return: dictionary containing the tree
+        :return: string, the initial measure, or the first measure of the OS
+                 model if it is not set
         """
-        self.get_os_model()
+        return self.initial_measure or sorted(self.get_measures())[0]
+
+    def drilldown(self, hierarchy, cut=None, measure=None):
+        """
+        Query OpenSpendings API to drilldown on given hierarchy and cut, i.e.
+        sum the measure per member of the first level of the hierarchy that is
+        not cut yet
+        :param hierarchy: string, name of a hierarchy of the OS model
+        :param cut: dictionary of attribute refs to values, e.g. the members
+                    of the upper levels drilled down so far
+        :param measure: string, name of a measure, see default_measure
+        :return: generator of cells, dictionaries of the level's refs and of
+                 '<measure>.sum' to their values, empty if every level is cut
+        """
+        cut = cut or {}
+        level = self.next_level(hierarchy, cut)
+        if level is None:
+            return iter(())
+        return self.aggregate(self.level_refs(level), cut, measure)
+
+    def aggregate(self, drilldown, cut=None, measure=None):
+        """
+        Query OpenSpendings API for the sum of a measure per member of the
+        given attributes, or compute it from the local snapshot of the dataset
+        if it has one (from its smallest rollup covering the attributes), see
+        get_snapshot.
+        Cells are fetched OS_AGGREGATE_PAGE_SIZE at a time, the pages after
+        the first one OS_AGGREGATE_WORKERS at once, and yielded as soon as
+        their page and the ones before it arrived, so that only a few pages
+        are ever held in memory. Every page is cached.
+        :param drilldown: list of attribute refs
+        :param cut: dictionary of attribute refs to values
+        :param measure: string, name of a measure, see default_measure
+        :return: generator of cells
+        """
+        params = {
+            'drilldown': '|'.join(drilldown),
+            'aggregates': '{}.sum'.format(measure or self.default_measure()),
+            'order': '{}:asc'.format(drilldown[0]),
+            'pagesize': settings.OS_AGGREGATE_PAGE_SIZE,
+        }
+        if cut:
+            # values are quoted the way Babbage parses them
+            params['cut'] = '|'.join('{}:{}'.format(ref, json.dumps(value))
+                                     for ref, value in sorted(cut.items()))
+
+        snapshot = self.get_snapshot()
+        if snapshot is not None:
+            from vizmanager.aggregation import AggregateQuery
+            try:
+                source = snapshot.source(list(drilldown) + list(cut or {}))
+                return AggregateQuery(source, params).cells()
+            except KeyError:
+                # attributes or measures missing from the snapshot, ask
+                # upstream
+                pass
+        return self.aggregate_pages(params)
+
+    def get_snapshot(self):
+        """
+        Local snapshot of the facts of this dataset, taken by the
+        snapshot_dataset command
+        :return: Snapshot, None if the dataset has none
+        """
+        try:
+            return self.snapshot
+        except AttributeError:
+            if self.code == '':
+                self.snapshot = None
+            else:
+                # numpy is only imported once a dataset needs it, like the
+                # HTTP client, see vizmanager.upstream
+                from vizmanager.snapshots import Snapshot
+                self.snapshot = Snapshot.open(self.code)
+        return self.snapshot
+
+    def aggregate_pages(self, params):
+        digest = cache.os_aggregate_digest(self.code, params)
+        first = self.fetch_aggregate_page(digest, params, 1)
+        for cell in first['cells']:
+            yield cell
+        pages = -(-first['total_cell_count'] // params['pagesize'])
+        if pages <= 1:
+            return
+
+        with ThreadPoolExecutor(
+                max_workers=settings.OS_AGGREGATE_WORKERS) as executor:
+            pending = deque()
+            next_page = 2
+            try:
+                while pending or next_page <= pages:
+                    while next_page <= pages and \
+                            len(pending) < settings.OS_AGGREGATE_WORKERS:
+                        pending.append(executor.submit(
+                            self.fetch_aggregate_page, digest, params,
+                            next_page))
+                        next_page += 1
+                    for cell in pending.popleft().result()['cells']:
+                        yield cell
+            finally:
+                # the consumer stopped early or a page failed
+                for future in pending:
+                    future.cancel()
+
+    def fetch_aggregate_page(self, digest, params, page):
+        """
+        Get a page of aggregate cells from the shared cache, or download it
+        :param digest: string, see cache.os_aggregate_digest
+        :param params: dictionary of query parameters, without the page
+        :param page: integer, 1 based
+        :return: dictionary with 'cells' and 'total_cell_count'
+        """
+        data = cache.get_os_aggregate_page(digest, page)
+        if data is not None:
+            return data
+
+        response = upstream.get(self.build_url('aggregate'),
+                                params=dict(params, page=page))
+        if response.status_code != 200:
+            raise RuntimeError(
+                'The configured OS_API could not aggregate this dataset.\n'
+                'OS_API = {}.\n'
+                'Dataset code = {}\n'
+                'Query = {}'
+                .format(settings.OS_API, self.code, params))
+        content = response.json()
+        data = {
+            'cells': content.get('cells', []),
+            'total_cell_count': content.get('total_cell_count', 0),
+        }
+        cache.set_os_aggregate_page(digest, page, data)
+        return data
 
-        return NotImplementedError
+    def build_tree(self, hierarchy, measure=None):
+        """
+        Build the tree structure of the dataset on a given hierarchy, with
+        its first level fetched, see vizmanager.tree
+        :param hierarchy: string, name of a hierarchy of the OS model
+        :param measure: string, name of a measure, see default_measure
+        :return: HierarchyTree, expand its nodes to fetch the levels below
+        """
+        tree = HierarchyTree(self, hierarchy, measure)
+        tree.expand()
+        return tree
 
     def __str__(self):
         return '{}'.format(self.name)
@@ -438,3 +818,188 @@ class Dataset(ModelDiffMixin, models.Model):
     class Meta:
         verbose_name = _('Dataset')
         verbose_name_plural = _('Datasets')
+
+
+def ngrams(text, n=3):
+    """
+    Split a normalised text into its distinct character n-grams
+    :param text: string
+    :param n: length of the grams
+    :return: set of strings
+    """
+    return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+class OpenSpendingPackageManager(models.Manager):
+
+    def search(self, q, limit):
+        """
+        Search the local catalogue for packages whose title contains `q`,
+        titles starting with `q` first
+        :param q: string, normalised search query
+        :param limit: maximum number of packages to return
+        :return: list of OpenSpendingPackage
+        """
+        packages = self.filter(search_title__contains=q)
+        grams = ngrams(q)
+        if grams:
+            # narrow down through the n-gram index first, the substring
+            # check then only runs over packages having all grams of q
+            matching = OpenSpendingPackageGram.objects\
+                .filter(gram__in=grams)\
+                .values('package')\
+                .annotate(grams=models.Count('gram'))\
+                .filter(grams=len(grams))\
+                .values('package')
+            packages = packages.filter(code__in=matching)
+        prefixed = list(packages.filter(search_title__startswith=q)
+                        .order_by('search_title')[:limit])
+        if len(prefixed) < limit:
+            prefixed += list(packages.exclude(search_title__startswith=q)
+                             .order_by('search_title')
+                             [:limit - len(prefixed)])
+        return prefixed
+
+
+class OpenSpendingPackage(models.Model):
+    """
+    Local copy of an OpenSpending package, so datasets can be searched for
+    without asking OS_API on every keystroke
+    """
+    code = models.CharField(max_length=200, primary_key=True,
+                            verbose_name=_('Code'))
+    title = models.CharField(max_length=500, verbose_name=_('Title'))
+    search_title = models.CharField(max_length=500, db_index=True)
+    synced = models.DateTimeField(verbose_name=_('Synced'))
+
+    objects = OpenSpendingPackageManager()
+
+    def __str__(self):
+        return '{}'.format(self.title)
+
+    class Meta:
+        verbose_name = _('OpenSpending Package')
+        verbose_name_plural = _('OpenSpending Packages')
+
+
+class OpenSpendingPackageGram(models.Model):
+    """
+    Trigram index over the titles of OpenSpending packages
+    """
+    gram = models.CharField(max_length=3, db_index=True)
+    package = models.ForeignKey(OpenSpendingPackage, related_name='grams',
+                                on_delete=models.CASCADE,)
+
+    class Meta:
+        unique_together = (('gram', 'package'),)
+
+
+class SyncState(models.Model):
+    """
+    Progress of a paged download from an upstream API, so that an interrupted
+    download can be resumed
+    """
+    name = models.CharField(max_length=100, primary_key=True)
+    started = models.DateTimeField(null=True)
+    cursor = models.PositiveIntegerField(default=0)
+    finished = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return '{}'.format(self.name)
+
+
+def fold(text):
+    """
+    Fold a text for case and accent insensitive matching
+    :param text: string
+    :return: string without diacritics, case folded, whitespace collapsed
+    """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ' '.join(''.join(char for char in decomposed
+                            if not unicodedata.combining(char))
+                    .casefold().split())
+
+
+def word_suffixes(text):
+    """
+    Split a folded text into its suffixes starting at each word, the text has
+    a word starting with q if one of them starts with q
+    :param text: string, see fold
+    :return: set of strings
+    """
+    words = text.split(' ')
+    return set(' '.join(words[i:]) for i in range(len(words)))
+
+
+class KPIFilterTermManager(models.Manager):
+
+    def search(self, kind, q, limit):
+        """
+        Find the terms of a vocabulary having a word starting with `q`,
+        ignoring case and accents, terms starting with `q` first
+        :param kind: vocabulary, one of KPIFilterTerm.KINDS
+        :param q: string, search query
+        :param limit: maximum number of terms to return
+        :return: list of KPIFilterTerm
+        """
+        q = fold(q)
+        terms = self.filter(kind=kind)
+        prefixed = list(terms.filter(search_label__startswith=q)
+                        .order_by('search_label')[:limit])
+        if len(prefixed) < limit:
+            # a prefix search of the word index, where searching the labels
+            # for ' ' + q would scan them all
+            matching = KPIFilterTermSuffix.objects\
+                .filter(suffix__startswith=q).values('term')
+            prefixed += list(terms.filter(pk__in=matching)
+                             .exclude(search_label__startswith=q)
+                             .order_by('search_label')
+                             [:limit - len(prefixed)])
+        return prefixed
+
+
+class KPIFilterTerm(models.Model):
+    """
+    Local copy of a term of the KPI_API filter vocabularies (organizations,
+    years, budget phases), kept up to date by the sync_kpi_filters command
+    """
+    KINDS = ('organizations', 'years', 'phases')
+
+    kind = models.CharField(max_length=20,
+                            choices=[(kind, kind) for kind in KINDS])
+    url = models.URLField(max_length=200, verbose_name=_('Url'))
+    label = models.CharField(max_length=200, verbose_name=_('Label'))
+    search_label = models.CharField(max_length=200, db_index=True)
+
+    objects = KPIFilterTermManager()
+
+    def save(self, *args, **kwargs):
+        self.search_label = fold(self.label)
+        super(self.__class__, self).save(*args, **kwargs)
+        self.suffixes.all().delete()
+        KPIFilterTermSuffix.objects.bulk_create(
+            KPIFilterTermSuffix(term=self, suffix=suffix)
+            for suffix in word_suffixes(self.search_label))
+
+    def __str__(self):
+        return '{}'.format(self.label)
+
+    class Meta:
+        verbose_name = _('KPI Filter Term')
+        verbose_name_plural = _('KPI Filter Terms')
+        unique_together = (('kind', 'url'),)
+        index_together = (('kind', 'search_label'),)
+
+
+class KPIFilterTermSuffix(models.Model):
+    """
+    Word index over the labels of KPI filter terms: the label from each of
+    its words on. Prefix matches on indexed CharFields use an index, on
+    PostgreSQL too, where Django adds a varchar_pattern_ops one for LIKE.
+    """
+    term = models.ForeignKey(KPIFilterTerm, related_name='suffixes',
+                             on_delete=models.CASCADE,)
+    suffix = models.CharField(max_length=200, db_index=True)
+
+    class Meta:
+        unique_together = (('term', 'suffix'),)
@@ -0,0 +1,256 @@
+"""
+Per request performance accounting.
+
+PerformanceMiddleware times every request, and the time spent in database
+queries, upstream HTTP calls (vizmanager.upstream) and template rendering
+within it. The figures are sent back in a Server-Timing header, logged as one
+line of JSON per request to the 'vizmanager.performance' logger (the format
+replayed by the replay_traffic command), and aggregated per URL name for the
+Prometheus endpoint (MetricsView).
+
+Metrics are kept per process: with several workers, each one is scraped on
+its own or the figures reflect only the worker that answered.
+"""
+import collections
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.utils.deprecation import MiddlewareMixin
+
+from microsite_backend import settings
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# upper bounds, in seconds, of the buckets of the request duration histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# kind: (what is counted, description)
+COUNTERS = collections.OrderedDict((
+    ('db', ('queries', 'database queries')),
+    ('upstream', ('calls', 'upstream HTTP calls')),
+    ('template', ('renders', 'template renders')),
+))
+
+
+class RequestStats(object):
+    """
+    Counts and durations (in seconds) of what happened during a request
+    """
+    KINDS = tuple(COUNTERS)
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts = dict((kind, 0) for kind in self.KINDS)
+        self.durations = dict((kind, 0.0) for kind in self.KINDS)
+        # kinds actually accounted for, database queries are optional
+        self.measured = set(self.KINDS)
+
+    def add(self, kind, duration, count=1):
+        self.counts[kind] += count
+        self.durations[kind] += duration
+
+
+def current():
+    """
+    :return: RequestStats of the request being handled by this thread, None
+             outside of a request
+    """
+    return getattr(_local, 'stats', None)
+
+
+def record(kind, duration, count=1):
+    """
+    Account for time spent on behalf of the current request, if any
+    :param kind: one of RequestStats.KINDS
+    :param duration: float, seconds
+    :param count: integer, number of operations
+    :return: None
+    """
+    stats = current()
+    if stats is not None:
+        stats.add(kind, duration, count)
+
+
+@contextmanager
+def timer(kind):
+    """
+    Account for the time spent in the block
+    :param kind: one of RequestStats.KINDS
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(kind, time.perf_counter() - started)
+
+
+class Metrics(object):
+    """
+    Request figures aggregated per URL name
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = collections.defaultdict(
+                lambda: [0] * len(BUCKETS))
+            self.totals = collections.defaultdict(float)
+
+    def observe(self, url_name, duration, stats):
+        with self.lock:
+            buckets = self.requests[url_name]
+            for i, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+            self.totals[('requests', url_name)] += 1
+            self.totals[('seconds', url_name)] += duration
+            for kind in RequestStats.KINDS:
+                if kind not in stats.measured:
+                    continue
+                self.totals[(kind, url_name)] += stats.durations[kind]
+                self.totals[(kind + '_count', url_name)] += stats.counts[kind]
+
+    def exposition(self):
+        """
+        :return: string, the metrics in Prometheus' text exposition format
+        """
+        with self.lock:
+            requests = dict((name, list(buckets))
+                            for name, buckets in self.requests.items())
+            totals = dict(self.totals)
+
+        lines = [
+            '# HELP microsite_request_duration_seconds Time to answer '
+            'requests.',
+            '# TYPE microsite_request_duration_seconds histogram',
+        ]
+        for name in sorted(requests):
+            label = 'url_name="{}"'.format(escape(name))
+            for bound, count in zip(BUCKETS, requests[name]):
+                lines.append('microsite_request_duration_seconds_bucket'
+                             '{{{},le="{}"}} {}'.format(label, bound, count))
+            lines.append('microsite_request_duration_seconds_bucket'
+                         '{{{},le="+Inf"}} {}'.format(
+                             label, int(totals[('requests', name)])))
+            lines.append('microsite_request_duration_seconds_sum{{{}}} {}'
+                         .format(label, totals[('seconds', name)]))
+            lines.append('microsite_request_duration_seconds_count{{{}}} {}'
+                         .format(label, int(totals[('requests', name)])))
+
+        for kind, (unit, description) in COUNTERS.items():
+            for metric, key, help_text in (
+                    ('microsite_{}_seconds_total'.format(kind), kind,
+                     'Time spent in {}.'.format(description)),
+                    ('microsite_{}_{}_total'.format(kind, unit),
+                     kind + '_count', 'Number of {}.'.format(description))):
+                lines.append('# HELP {} {}'.format(metric, help_text))
+                lines.append('# TYPE {} counter'.format(metric))
+                for name in sorted(requests):
+                    if (key, name) not in totals:
+                        # not measured, database queries by default
+                        continue
+                    lines.append('{}{{url_name="{}"}} {}'.format(
+                        metric, escape(name), totals[(key, name)]))
+        return '\n'.join(lines) + '\n'
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list of numbers
+    :param p: number, percentile between 0 and 100
+    :return: the nearest rank percentile of the values
+    """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+class PerformanceMiddleware(MiddlewareMixin):
+    """
+    Times requests, see the module documentation.
+    Database queries are read from the queries Django logs, which it only does
+    with DEBUG on or with PERFORMANCE_DB_QUERIES on, which turns on the debug
+    cursor for the duration of each request (keeping the SQL of its queries
+    in memory until the next request). Otherwise they are left out.
+    """
+
+    def process_request(self, request):
+        _local.stats = RequestStats()
+        request._performance_cursors = []
+        for connection in connections.all():
+            forced = connection.force_debug_cursor
+            if settings.PERFORMANCE_DB_QUERIES:
+                connection.force_debug_cursor = True
+            if connection.queries_logged:
+                request._performance_cursors.append(
+                    (connection, forced, len(connection.queries_log)))
+        if not request._performance_cursors:
+            _local.stats.measured.discard('db')
+
+    def process_template_response(self, request, response):
+        # listed first, this middleware is the last one called before the
+        # response is rendered
+        started = time.perf_counter()
+        response.add_post_render_callback(
+            lambda response: record('template',
+                                    time.perf_counter() - started))
+        return response
+
+    def process_response(self, request, response):
+        stats = current()
+        _local.stats = None
+        if stats is None:
+            # process_request didn't run, e.g. another middleware answered
+            return response
+        duration = time.perf_counter() - stats.started
+
+        for connection, forced, start in getattr(
+                request, '_performance_cursors', ()):
+            queries = list(connection.queries_log)[start:]
+            stats.add('db', sum(float(query['time']) for query in queries),
+                      len(queries))
+            connection.force_debug_cursor = forced
+
+        match = getattr(request, 'resolver_match', None)
+        url_name = match.view_name if match is not None else '<unmatched>'
+        metrics.observe(url_name, duration, stats)
+
+        response['Server-Timing'] = ', '.join(
+            ['{};dur={:.1f};desc="{} {}"'.format(
+                kind, stats.durations[kind] * 1000, stats.counts[kind],
+                COUNTERS[kind][0])
+             for kind in RequestStats.KINDS if kind in stats.measured] +
+            ['total;dur={:.1f}'.format(duration * 1000)])
+
+        line = {
+            'timestamp': round(time.time() - duration, 3),
+            'method': request.method,
+            'path': request.path,
+            'query': request.META.get('QUERY_STRING', ''),
+            'url_name': url_name,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 2),
+        }
+        for kind, (unit, _) in COUNTERS.items():
+            measured = kind in stats.measured
+            line['{}_{}'.format(kind, unit)] = \
+                stats.counts[kind] if measured else None
+            line['{}_ms'.format(kind)] = \
+                round(stats.durations[kind] * 1000, 2) if measured else None
+        logger.info(json.dumps(line, sort_keys=True))
+        return response
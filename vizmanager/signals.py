@@ -0,0 +1,99 @@
+"""
+Invalidation of microsite pages when the objects shown on them change.
+
+DEPENDENTS maps each model to the microsites showing its instances. When an
+instance is saved or deleted, the versions of just those microsites are bumped
+and their cached pages purged once the transaction commits (see
+vizmanager.invalidation). Microsites themselves bump their version in
+Microsite.save. Connected in VizmanagerConfig.ready.
+"""
+from django.db.models.signals import m2m_changed, post_delete, post_save, \
+    pre_delete
+
+from vizmanager import invalidation
+from vizmanager.models import Dataset, KPI, Microsite, Municipality, \
+    Organization, Phase, Theme, Year
+
+
+def dataset_microsites(dataset):
+    # both microsites if the dataset was moved between them
+    microsites = [dataset.microsite_id]
+    microsite_diff = dataset.get_field_diff('microsite')
+    if microsite_diff is not None:
+        microsites.append(microsite_diff[0])
+    return microsites
+
+
+def microsites_where(lookup):
+    return lambda instance: Microsite.objects.filter(**{lookup: instance})\
+        .values_list('pk', flat=True).distinct()
+
+
+# model: function of an instance returning the pks of the microsites showing it
+DEPENDENTS = {
+    Dataset: dataset_microsites,
+    Theme: microsites_where('selected_theme'),
+    KPI: microsites_where('kpi_set'),
+    Organization: microsites_where('kpi_set__organization'),
+    Year: microsites_where('kpi_set__year'),
+    Phase: microsites_where('kpi_set__phase'),
+    # not on the page, but in the API documents versioned alike
+    Municipality: microsites_where('municipality'),
+}
+# models found through many to many relations, which are gone by post_delete
+PRE_DELETE = (KPI, Organization, Year, Phase)
+
+
+def content_saved(sender, instance, raw=False, **kwargs):
+    """
+    Invalidate the microsites showing a saved object
+    """
+    if not raw:
+        Microsite.bump_versions(DEPENDENTS[sender](instance))
+
+
+def content_deleted(sender, instance, **kwargs):
+    """
+    Invalidate the microsites showing a deleted object
+    """
+    Microsite.bump_versions(DEPENDENTS[sender](instance))
+
+
+def microsite_deleted(sender, instance, **kwargs):
+    """
+    Purge the page of a deleted microsite, its cached version would keep
+    serving it for a while
+    """
+    invalidation.purge([instance.pk])
+
+
+def kpi_set_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidate the microsites whose KPIs were added, removed or cleared
+    """
+    if not reverse:
+        if action.startswith('post_'):
+            Microsite.bump_versions([instance.pk])
+    elif action == 'pre_clear':
+        # pk_set is not provided when clearing, remember the microsites before
+        # their relations are gone
+        instance._cleared_microsites = list(
+            instance.microsite_set.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        Microsite.bump_versions(
+            instance.__dict__.pop('_cleared_microsites', []))
+    elif action.startswith('post_'):
+        Microsite.bump_versions(pk_set)
+
+
+def connect():
+    for model in DEPENDENTS:
+        post_save.connect(content_saved, sender=model,
+                          dispatch_uid='vizmanager.content_saved')
+        delete_signal = pre_delete if model in PRE_DELETE else post_delete
+        delete_signal.connect(content_deleted, sender=model,
+                              dispatch_uid='vizmanager.content_deleted')
+    post_delete.connect(microsite_deleted, sender=Microsite,
+                        dispatch_uid='vizmanager.microsite_deleted')
+    m2m_changed.connect(kpi_set_changed, sender=Microsite.kpi_set.through,
+                        dispatch_uid='vizmanager.kpi_set_changed')
@@ -0,0 +1,508 @@
+"""
+Local columnar copies of the facts of OpenSpending datasets, written by the
+snapshot_dataset command, so that aggregates of hot datasets can be computed
+without going upstream.
+
+Each snapshot lives in SNAPSHOTS_ROOT/<digest of OS_API and code>/:
+
+    meta.json                 rows, dimensions and their dictionaries,
+                              measures, current generation
+    <generation>/dimension_<i>.codes
+                              uint32 code of the member of dimension i in
+                              each fact, an index into its dictionary
+    <generation>/measure_<i>.values
+                              float64 value of measure i in each fact
+    <generation>/rollup_<dimensions>_<facts>/
+                              the same columns for the facts summed per
+                              combination of members of some dimensions, the
+                              last measure being the number of facts
+
+Columns are only ever appended to, and meta.json is replaced once the columns
+are written, so readers always see consistent `rows` first values. Facts are
+downloaded in a fixed order, and new ones are expected after the stored ones.
+A change of the dimensions or measures of the OS model, or of stored facts
+upstream (see take_snapshot), writes a new generation from scratch.
+
+Every level of every hierarchy, and the initial dimension, is rolled up, so
+that the views microsites show most are summed from a few rows rather than
+from all the facts. Refreshing a snapshot adds the new facts to the rollups.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from microsite_backend import settings
+from vizmanager import aggregation, upstream
+from vizmanager.aggregation import COUNT
+
+
+CODES_DTYPE = np.uint32
+VALUES_DTYPE = np.float64
+
+
+def snapshot_path(code):
+    """
+    :param code: OpenSpending dataset code
+    :return: string, folder of the snapshot of the dataset
+    """
+    return os.path.join(settings.SNAPSHOTS_ROOT, hashlib.md5(
+        '{}|{}'.format(settings.OS_API, code).encode('utf-8')).hexdigest())
+
+
+def schema(dataset):
+    """
+    Dimensions and measures of a dataset's OS model, as stored in snapshots
+    :param dataset: Dataset
+    :return: (list of dimension dictionaries with 'name' and 'refs', list of
+             measure dictionaries with 'name' and 'ref', digest string)
+    """
+    dimensions = [{'name': name, 'refs': dataset.level_refs(name)}
+                  for name in sorted(dataset.get_dimensions())]
+    measures = [{'name': name, 'ref': measure.get('ref', name)}
+                for name, measure in sorted(dataset.get_measures().items())]
+    digest = hashlib.md5(json.dumps([dimensions, measures], sort_keys=True)
+                         .encode('utf-8')).hexdigest()
+    return dimensions, measures, digest
+
+
+class Columns(object):
+    """
+    Read only view of column files, memory mapped on first use
+    """
+    def __init__(self, rows, dimensions, measures):
+        self.rows = rows
+        self.dimensions = dimensions
+        self.measures = measures
+        self.measure_names = [measure['name'] for measure in measures]
+        self.columns = {}
+
+    def column_path(self, name):
+        raise NotImplementedError
+
+    def column(self, name, dtype):
+        if name not in self.columns:
+            if self.rows == 0:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[name] = np.memmap(self.column_path(name),
+                                               dtype=dtype, mode='r',
+                                               shape=(self.rows,))
+        return self.columns[name]
+
+    def dimension_index(self, ref):
+        """
+        :param ref: string, key or label ref of a dimension
+        :return: integer, index of the dimension having this ref
+        """
+        for i, dimension in enumerate(self.dimensions):
+            if ref in dimension['refs']:
+                return i
+        raise KeyError(ref)
+
+    def measure_index(self, name):
+        """
+        :param name: string, name or ref of a measure
+        :return: integer, index of the measure
+        """
+        for i, measure in enumerate(self.measures):
+            if name in (measure['name'], measure['ref']):
+                return i
+        raise KeyError(name)
+
+    def codes(self, i):
+        """
+        :param i: integer, index of a dimension
+        :return: array of the dictionary codes of the dimension in each row
+        """
+        return self.column('dimension_{}.codes'.format(i), CODES_DTYPE)
+
+    def values(self, i):
+        """
+        :param i: integer, index of a measure
+        :return: array of the values of the measure in each row
+        """
+        return self.column('measure_{}.values'.format(i), VALUES_DTYPE)
+
+
+class Snapshot(Columns):
+    """
+    The facts of a dataset, one row per fact
+    """
+    def __init__(self, path, meta):
+        super(Snapshot, self).__init__(meta['rows'], meta['dimensions'],
+                                       meta['measures'])
+        self.path = path
+        self.meta = meta
+
+    @classmethod
+    def open(cls, code):
+        """
+        :param code: OpenSpending dataset code
+        :return: Snapshot, None if the dataset has no snapshot
+        """
+        path = snapshot_path(code)
+        try:
+            with open(os.path.join(path, 'meta.json')) as meta_file:
+                return cls(path, json.load(meta_file))
+        except FileNotFoundError:
+            return None
+
+    def column_path(self, name):
+        return os.path.join(self.path, str(self.meta['generation']), name)
+
+    def rollups(self):
+        """
+        :return: list of the Rollups of this snapshot
+        """
+        return [Rollup(self, rollup)
+                for rollup in self.meta.get('rollups', {}).values()]
+
+    def source(self, refs):
+        """
+        Smallest set of columns from which aggregates over the given
+        attributes can be computed: the rollup with the fewest rows having
+        all their dimensions, the facts if there is none
+        :param refs: list of the attribute refs drilled down and cut on
+        :return: Snapshot or Rollup
+        """
+        needed = set(self.dimension_index(ref) for ref in refs)
+        candidates = [rollup for rollup in self.rollups()
+                      if needed <= set(rollup.indexes)]
+        return min(candidates, key=lambda rollup: rollup.rows) \
+            if candidates else self
+
+
+class Rollup(Columns):
+    """
+    The facts of a snapshot summed per combination of members of some of its
+    dimensions, one row per combination having facts, with their number in
+    the extra '_count' measure
+    """
+    def __init__(self, snapshot, meta):
+        super(Rollup, self).__init__(
+            meta['rows'],
+            [snapshot.dimensions[index] for index in meta['dimensions']],
+            snapshot.measures + [{'name': COUNT, 'ref': COUNT}])
+        self.snapshot = snapshot
+        self.meta = meta
+        # indexes of the dimensions in the snapshot
+        self.indexes = meta['dimensions']
+
+    def column_path(self, name):
+        return os.path.join(self.snapshot.path,
+                            str(self.snapshot.meta['generation']),
+                            self.meta['folder'], name)
+
+
+def fact_order(dataset, fields):
+    """
+    Order in which facts are downloaded, which must stay the same between
+    refreshes for new facts to come after the stored ones: by the fact key of
+    the model if it has one, otherwise by every attribute and measure, which
+    is at least deterministic
+    :param fields: list of attribute and measure refs downloaded
+    :return: string, Babbage order parameter
+    """
+    fact_key = dataset.get_os_model().get('fact_key')
+    return '|'.join('{}:asc'.format(ref)
+                    for ref in ([fact_key] if fact_key else fields))
+
+
+def fetch_facts(dataset, fields, order, page, page_size):
+    """
+    Download a page of facts of a dataset
+    :param fields: list of attribute and measure refs to include
+    :param order: string, see fact_order
+    :param page: integer, 1 based
+    :return: (list of fact dictionaries, total number of facts)
+    """
+    response = upstream.get(dataset.build_url('facts'), params={
+        'fields': ','.join(fields), 'order': order, 'page': page,
+        'pagesize': page_size})
+    if response.status_code != 200:
+        raise RuntimeError(
+            'The configured OS_API could not list the facts of this dataset.'
+            '\nOS_API = {}.\nDataset code = {}'
+            .format(settings.OS_API, dataset.code))
+    content = response.json()
+    return content.get('data', []), content.get('total_fact_count', 0)
+
+
+def page_check(page, page_size, facts, rows):
+    """
+    :param facts: list of the facts of the page
+    :param rows: integer, number of facts stored
+    :return: dictionary identifying the stored facts of a page, see unchanged
+    """
+    count = max(0, min(len(facts), rows - (page - 1) * page_size))
+    return {'page': page, 'page_size': page_size, 'count': count,
+            'digest': hashlib.sha1(json.dumps(facts[:count], sort_keys=True)
+                                   .encode('utf-8')).hexdigest()}
+
+
+def unchanged(dataset, fields, order, checks, first_page, page_size):
+    """
+    Whether pages of facts stored by an earlier snapshot are still the same
+    upstream
+    :param checks: list of page_check dictionaries
+    :param first_page: list of the facts of the first page, of page_size
+    :return: boolean
+    """
+    for check in checks:
+        if (check['page'], check['page_size']) == (1, page_size):
+            facts = first_page
+        else:
+            facts, _ = fetch_facts(dataset, fields, order, check['page'],
+                                   check['page_size'])
+        if page_check(check['page'], check['page_size'], facts,
+                      check['count'] + (check['page'] - 1) *
+                      check['page_size']) != check:
+            return False
+    return True
+
+
+def take_snapshot(dataset, full=False, page_size=None,
+                  initial_dimensions=None):
+    """
+    Bring the snapshot of a dataset up to date, appending the facts added
+    upstream since the last snapshot, or downloading all the facts if the
+    dataset has no snapshot yet, if its dimensions or measures changed or if
+    stored facts changed upstream: facts were removed, or the first page or
+    the last page stored differ.
+    Facts are downloaded a page at a time and written as they arrive.
+    :param dataset: Dataset
+    :param full: boolean, download all the facts whatever the snapshot
+    :param page_size: integer, facts per request, SNAPSHOT_PAGE_SIZE by
+                      default
+    :param initial_dimensions: see rollup_dimensions
+    :return: (Snapshot, number of facts downloaded)
+    """
+    page_size = page_size or settings.SNAPSHOT_PAGE_SIZE
+    path = snapshot_path(dataset.code)
+    dimensions, measures, digest = schema(dataset)
+    fields = [ref for dimension in dimensions for ref in dimension['refs']] \
+        + [measure['ref'] for measure in measures]
+    order = fact_order(dataset, fields)
+
+    current = Snapshot.open(dataset.code)
+    first_page, total = fetch_facts(dataset, fields, order, 1, page_size)
+    if full or current is None or current.meta['schema'] != digest \
+            or current.meta.get('order') != order or current.rows > total \
+            or not unchanged(dataset, fields, order,
+                             current.meta.get('checks', []), first_page,
+                             page_size):
+        generation = current.meta['generation'] + 1 if current else 1
+        meta = {
+            'code': dataset.code,
+            'schema': digest,
+            'order': order,
+            'generation': generation,
+            'rows': 0,
+            'dimensions': [dict(dimension, keys=[], labels=[])
+                           for dimension in dimensions],
+            'measures': measures,
+        }
+    else:
+        meta = current.meta
+        generation = None
+    start = meta['rows']
+
+    folder = os.path.join(path, str(meta['generation']))
+    os.makedirs(folder, exist_ok=True)
+    columns = ['dimension_{}.codes'.format(i) for i in range(len(dimensions))]\
+        + ['measure_{}.values'.format(i) for i in range(len(measures))]
+    files = []
+    try:
+        for name in columns:
+            column_file = open(os.path.join(folder, name), 'ab')
+            # drop whatever an interrupted refresh appended past `rows`
+            column_file.truncate(
+                start * np.dtype(CODES_DTYPE if name.endswith('.codes')
+                                 else VALUES_DTYPE).itemsize)
+            files.append(column_file)
+
+        encoders = [dict((key, code) for code, key in
+                         enumerate(dimension['keys']))
+                    for dimension in meta['dimensions']]
+        # start from the page of the last stored fact, so that the last page
+        # checked next time is never empty
+        page = (start - 1) // page_size + 1 if start else 1
+        skip = start - (page - 1) * page_size
+        facts = first_page
+        last_page = None
+        while True:
+            if page != 1:
+                facts, total = fetch_facts(dataset, fields, order, page,
+                                           page_size)
+            if facts:
+                last_page = (page, facts)
+            new_facts = facts[skip:]
+            if new_facts:
+                append_facts(meta, encoders, files, new_facts)
+            if not new_facts or meta['rows'] >= total:
+                break
+            page += 1
+            skip = 0
+    finally:
+        for column_file in files:
+            column_file.close()
+
+    meta['checks'] = [page_check(1, page_size, first_page, meta['rows'])]
+    if last_page is not None and last_page[0] != 1:
+        meta['checks'].append(page_check(last_page[0], page_size,
+                                         last_page[1], meta['rows']))
+
+    obsolete = update_rollups(dataset, path, meta, initial_dimensions)
+    meta['updated'] = time.time()
+    write_meta(path, meta)
+    for rollup_folder in obsolete:
+        shutil.rmtree(os.path.join(folder, rollup_folder), ignore_errors=True)
+    if generation is not None and generation > 1:
+        shutil.rmtree(os.path.join(path, str(generation - 1)),
+                      ignore_errors=True)
+    return Snapshot(path, meta), meta['rows'] - start
+
+
+def append_facts(meta, encoders, files, facts):
+    """
+    Encode a page of facts and append it to the column files
+    """
+    for dimension, encoder, column_file in zip(meta['dimensions'], encoders,
+                                               files):
+        key_ref, label_ref = dimension['refs'][0], dimension['refs'][-1]
+        codes = np.empty(len(facts), dtype=CODES_DTYPE)
+        for i, fact in enumerate(facts):
+            key = fact.get(key_ref)
+            code = encoder.get(key)
+            if code is None:
+                code = encoder[key] = len(dimension['keys'])
+                dimension['keys'].append(key)
+                dimension['labels'].append(fact.get(label_ref))
+            codes[i] = code
+        codes.tofile(column_file)
+
+    for measure, column_file in zip(meta['measures'],
+                                    files[len(meta['dimensions']):]):
+        # missing values count as 0, the way upstream sums skip them
+        np.array([fact.get(measure['ref']) or 0 for fact in facts],
+                 dtype=VALUES_DTYPE).tofile(column_file)
+    meta['rows'] += len(facts)
+
+
+def rollup_dimensions(dataset, meta, initial_dimensions=None):
+    """
+    Sets of dimensions worth rolling up: the levels of every hierarchy down
+    to each of its levels, and the initial dimensions
+    :param dataset: Dataset
+    :param meta: dictionary, meta of the snapshot
+    :param initial_dimensions: list of the initial dimensions (attribute
+                               refs) of all the datasets sharing the code of
+                               `dataset`, only its own by default
+    :return: list of sorted tuples of dimension indexes
+    """
+    if initial_dimensions is None:
+        initial_dimensions = [dataset.initial_dimension]
+    indexes = dict((dimension['name'], i)
+                   for i, dimension in enumerate(meta['dimensions']))
+    rollups = set()
+    for hierarchy in (dataset.get_hierarchies() or {}).values():
+        levels = []
+        for level in hierarchy.get('levels', []):
+            if level not in indexes:
+                break
+            levels.append(indexes[level])
+            rollups.add(tuple(sorted(set(levels))))
+    for name, dimension in dataset.get_dimensions().items():
+        refs = [attribute.get('ref') for attribute
+                in dimension.get('attributes', {}).values()]
+        if name in indexes and set(initial_dimensions) & set(refs):
+            rollups.add((indexes[name],))
+    return sorted(rollups)
+
+
+def update_rollups(dataset, path, meta, initial_dimensions=None):
+    """
+    Bring the rollups of a snapshot up to date with its facts, adding the
+    facts appended since a rollup was built to it rather than rolling all
+    the facts up again. Rollups of dimensions no longer worth rolling up
+    (e.g. the hierarchies of the OS model changed) are dropped.
+    :param dataset: Dataset
+    :param meta: dictionary, meta of the snapshot, its 'rollups' are updated
+    :param initial_dimensions: see rollup_dimensions
+    :return: list of the folders of the snapshot's generation no longer used
+    """
+    snapshot = Snapshot(path, meta)
+    previous = meta.get('rollups', {})
+    rollups = {}
+    for indexes in rollup_dimensions(dataset, meta, initial_dimensions):
+        name = '-'.join(str(index) for index in indexes)
+        rollup = previous.get(name)
+        if rollup is None or rollup['facts'] != meta['rows']:
+            rollup = build_rollup(snapshot, indexes, rollup)
+        rollups[name] = rollup
+    meta['rollups'] = rollups
+    used = set(rollup['folder'] for rollup in rollups.values())
+    return [rollup['folder'] for rollup in previous.values()
+            if rollup['folder'] not in used]
+
+
+def build_rollup(snapshot, indexes, previous=None):
+    """
+    Sum the facts of a snapshot per combination of members of some
+    dimensions, and write the sums into a folder of its generation
+    :param snapshot: Snapshot
+    :param indexes: tuple of dimension indexes
+    :param previous: dictionary, meta of the rollup of the same dimensions
+                     built from the first previous['facts'] facts, whose rows
+                     are added to the facts after them, None to roll up all
+                     the facts
+    :return: dictionary, meta of the rollup
+    """
+    start = previous['facts'] if previous else 0
+    columns = [snapshot.codes(index)[start:] for index in indexes]
+    weights = [snapshot.values(i)[start:]
+               for i in range(len(snapshot.measures))]
+    weights.append(np.ones(snapshot.rows - start, dtype=VALUES_DTYPE))
+    if previous:
+        rollup = Rollup(snapshot, previous)
+        columns = [np.concatenate((rollup.codes(i), codes))
+                   for i, codes in enumerate(columns)]
+        weights = [np.concatenate((rollup.values(i), values))
+                   for i, values in enumerate(weights)]
+
+    group_codes, inverse, groups = aggregation.group(
+        columns, [len(snapshot.dimensions[index]['keys'])
+                  for index in indexes])
+    sums = [np.bincount(inverse, weights=values, minlength=groups)
+            for values in weights]
+    # only the combinations having facts are rows
+    present = np.flatnonzero(sums[-1])
+
+    folder = 'rollup_{}_{}'.format('-'.join(str(index) for index in indexes),
+                                   snapshot.rows)
+    rollup = {'dimensions': list(indexes), 'rows': len(present),
+              'facts': snapshot.rows, 'folder': folder}
+    target = Rollup(snapshot, rollup)
+    os.makedirs(os.path.dirname(target.column_path('')), exist_ok=True)
+    for i, codes in enumerate(group_codes):
+        codes[present].astype(CODES_DTYPE).tofile(
+            target.column_path('dimension_{}.codes'.format(i)))
+    for i, values in enumerate(sums):
+        values[present].astype(VALUES_DTYPE).tofile(
+            target.column_path('measure_{}.values'.format(i)))
+    return rollup
+
+
+def write_meta(path, meta):
+    """
+    Replace the meta.json of a snapshot at once
+    """
+    descriptor, temporary = tempfile.mkstemp(dir=path, suffix='.json')
+    with os.fdopen(descriptor, 'w') as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(temporary, os.path.join(path, 'meta.json'))
@@ -7,7 +7,7 @@ visualizationDirective.init(MicrositeApp);
 MicrositeApp.controller('MainViewController', function MainViewController($scope) {
   dataset_dropdown = $('#dataset-dropdown')[0];
   if (dataset_dropdown) {
-    $scope.current_dataset_url = dataset_dropdown.value;
+    $scope.current_dataset = dataset_dropdown.value;
   }
 });
 
@@ -1,3 +1,1347 @@
-from django.test import TestCase
+import gzip
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+import multiprocessing.dummy
+import os
+import runpy
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+    override_settings
+
+from microsite_backend import import_profile, settings
+from vizmanager import cache, db, invalidation, performance, snapshots, \
+    theme_files, upstream
+from vizmanager.aggregation import AggregateQuery
+from vizmanager.cache import LRUCache, SingleFlight
+from vizmanager.fake_upstream import FakeUpstream
+from vizmanager.management.commands import benchmark, \
+    build_static_microsites, replay_traffic, sync_os_packages
+from vizmanager.model_mixins import untracked
+from vizmanager.models import Dataset, KPI, KPIFilterTerm, Microsite, \
+    Municipality, OpenSpendingPackage, OpenSpendingPackageGram, Organization, \
+    Phase, SyncState, Theme, Year, ngrams
+from vizmanager.views import UpstreamAutocomplete
+
+
+class MicrositeTestCase(TransactionTestCase):
+    # caches are purged when transactions commit, which TestCase never does
+
+    def setUp(self):
+        caches['default'].clear()
+        themes_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(themes_folder.cleanup)
+        for name, value in (('OS_VIEWER_THEMES_FOLDER', themes_folder.name),
+                            ('THEME_FILES_WRITE_BEHIND', False)):
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # keep the per request log lines out of the test output
+        patcher = mock.patch.object(performance.logger, 'disabled', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        municipality = Municipality.objects.create(name='Bonn',
+                                                   country='Germany')
+        self.microsite = Microsite.objects.create(name='Bonn',
+                                                  municipality=municipality)
+        theme = Theme.objects.create(name='bonn', microsite=self.microsite)
+        self.microsite.selected_theme = theme
+        self.microsite.save()
+
+    def add_datasets(self, count):
+        start = self.microsite.dataset_set.count()
+        for i in range(start, start + count):
+            Dataset.objects.create(name='Dataset {}'.format(i),
+                                   microsite=self.microsite,
+                                   code='code-{}'.format(i),
+                                   viz_type='Treemap')
+
+    def add_kpis(self, count):
+        start = self.microsite.kpi_set.count()
+        for i in range(start, start + count):
+            kpi = KPI.objects.create(
+                name='KPI {}'.format(i),
+                organization=Organization.objects.create(
+                    name='Organization {}'.format(i),
+                    url='http://example.org/organization/{}'.format(i)),
+                year=Year.objects.create(
+                    name='Year {}'.format(i),
+                    url='http://example.org/year/{}'.format(i)),
+                phase=Phase.objects.create(
+                    name='Phase {}'.format(i),
+                    url='http://example.org/phase/{}'.format(i)))
+            self.microsite.kpi_set.add(kpi)
+
+
+class MicrositeDetailViewTest(MicrositeTestCase):
+
+    def get_page(self):
+        return self.client.get(reverse('vizmanager:microsite-detail',
+                                       kwargs={'pk': self.microsite.pk}))
+
+    def test_query_count_does_not_depend_on_content(self):
+        # version lookup, microsite with its joins, datasets and KPIs
+        self.add_datasets(1)
+        self.add_kpis(1)
+        with self.assertNumQueries(4):
+            self.assertEqual(self.get_page().status_code, 200)
+
+        self.add_datasets(30)
+        self.add_kpis(10)
+        with self.assertNumQueries(4):
+            response = self.get_page()
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'code-30')
+        self.assertContains(response, 'organization%2F10')
+
+    def test_cache_hit_runs_no_queries(self):
+        self.add_datasets(2)
+        response = self.get_page()
+        with self.assertNumQueries(0):
+            cached = self.get_page()
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+        # saving the microsite renders the page again
+        self.microsite.name = 'Bonn am Rhein'
+        self.microsite.save()
+        with self.assertNumQueries(4):
+            self.assertContains(self.get_page(), 'Bonn am Rhein')
+
+    def test_current_etag_is_not_modified(self):
+        self.add_datasets(2)
+        etag = self.get_page()['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                reverse('vizmanager:microsite-detail',
+                        kwargs={'pk': self.microsite.pk}),
+                HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        self.add_datasets(1)
+        response = self.client.get(
+            reverse('vizmanager:microsite-detail',
+                    kwargs={'pk': self.microsite.pk}),
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class MicrositeAPITest(MicrositeTestCase):
+
+    def test_export_matches_pages(self):
+        self.add_datasets(3)
+        self.add_kpis(2)
+        for i in range(4):
+            Microsite.objects.create(name='Other {}'.format(i),
+                                     municipality=self.microsite.municipality)
+
+        paged = []
+        url = reverse('vizmanager:api-microsite-list') + '?limit=2'
+        while url:
+            # page of microsites, their datasets and their KPIs
+            with self.assertNumQueries(3):
+                page = self.client.get(url).json()
+            paged.extend(page['results'])
+            url = page['next']
+        self.assertEqual(
+            [document['id'] for document in paged],
+            sorted(Microsite.objects.values_list('pk', flat=True)))
+        self.assertEqual(len(paged[0]['datasets']), 3)
+        self.assertEqual(paged[0]['theme']['name'], 'bonn')
+
+        response = self.client.get(reverse('vizmanager:api-microsite-export'))
+        exported = [json.loads(line) for line in
+                    b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(exported, paged)
+
+    def test_sparse_fields(self):
+        self.add_datasets(1)
+        url = reverse('vizmanager:api-microsite-detail',
+                      kwargs={'pk': self.microsite.pk})
+        with self.assertNumQueries(1):
+            document = self.client.get(url, {'fields': 'name,version'}).json()
+        self.assertEqual(sorted(document), ['id', 'name', 'version'])
+        self.assertEqual(
+            self.client.get(url, {'fields': 'name,secret'}).status_code, 400)
+
+    def test_invalid_limits(self):
+        url = reverse('vizmanager:api-microsite-list')
+        for limit in ('0', '-1', 'ten'):
+            response = self.client.get(url, {'limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('limit', response.json()['error'])
+
+
+class InvalidationTest(MicrositeTestCase):
+
+    def versions(self):
+        return dict(Microsite.objects.values_list('pk', 'version'))
+
+    def test_only_dependent_microsites_are_bumped(self):
+        self.add_kpis(2)
+        other = Microsite.objects.create(
+            name='Other', municipality=self.microsite.municipality)
+        other.kpi_set.add(KPI.objects.get(name='KPI 1'))
+        before = self.versions()
+
+        organization = Organization.objects.get(name='Organization 0')
+        organization.name = 'Renamed'
+        organization.save()
+        after = self.versions()
+        self.assertEqual(after[self.microsite.pk],
+                         before[self.microsite.pk] + 1)
+        self.assertEqual(after[other.pk], before[other.pk])
+
+        # cascades to the KPI, which may bump again
+        Year.objects.get(name='Year 1').delete()
+        self.assertGreater(self.versions()[other.pk], before[other.pk])
+
+    def test_purges_are_batched_per_transaction(self):
+        with mock.patch('vizmanager.invalidation.purge_now') as purge_now, \
+                transaction.atomic():
+            self.add_datasets(3)
+            self.add_kpis(2)
+            self.assertFalse(purge_now.called)
+        purge_now.assert_called_once_with({self.microsite.pk})
+
+    def test_cdn_purge(self):
+        with mock.patch.object(settings, 'CDN_PURGE_URLS',
+                               ['http://cdn.local']), \
+                mock.patch('vizmanager.upstream.request') as request:
+            self.microsite.save()
+            invalidation._executor.shutdown()
+            invalidation._executor = None
+        self.assertEqual(
+            sorted(call[0] for call in request.call_args_list),
+            sorted([('PURGE', 'http://cdn.local' + reverse(name, kwargs={
+                'pk': self.microsite.pk}))
+             for name in ('vizmanager:microsite-detail',
+                          'vizmanager:api-microsite-detail')]))
+
+
+class PerformanceMiddlewareTest(MicrositeTestCase):
+
+    def test_timings(self):
+        self.add_datasets(2)
+        performance.metrics.reset()
+        url = reverse('vizmanager:microsite-detail',
+                      kwargs={'pk': self.microsite.pk})
+        with mock.patch.object(performance.logger, 'disabled', False), \
+                mock.patch.object(settings, 'PERFORMANCE_DB_QUERIES', True), \
+                self.assertLogs('vizmanager.performance') as logs:
+            response = self.client.get(url)
+        self.assertIn('db;dur=', response['Server-Timing'])
+        self.assertIn('desc="4 queries"', response['Server-Timing'])
+        self.assertIn('desc="1 renders"', response['Server-Timing'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual(line['url_name'], 'vizmanager:microsite-detail')
+        self.assertEqual(line['db_queries'], 4)
+
+        with mock.patch.object(settings, 'METRICS_TOKEN', 'secret'):
+            metrics = self.client.get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer secret')\
+                .content.decode('utf-8')
+        self.assertIn('microsite_request_duration_seconds_count'
+                      '{url_name="vizmanager:microsite-detail"} 1', metrics)
+        self.assertIn('microsite_db_queries_total'
+                      '{url_name="vizmanager:microsite-detail"} 4', metrics)
+
+    def test_metrics_need_the_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with mock.patch.object(settings, 'METRICS_TOKEN', 'secret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            self.assertEqual(self.client.get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer guess').status_code,
+                403)
+            self.assertEqual(self.client.get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code,
+                200)
+
+    def test_queries_are_not_logged_by_default(self):
+        url = reverse('vizmanager:microsite-detail',
+                      kwargs={'pk': self.microsite.pk})
+        with mock.patch.object(performance.logger, 'disabled', False), \
+                self.assertLogs('vizmanager.performance') as logs, \
+                mock.patch.object(connection, 'force_debug_cursor', False):
+            response = self.client.get(url)
+            self.assertEqual(len(connection.queries_log), 0)
+        self.assertNotIn('db;', response['Server-Timing'])
+        self.assertIn('template;', response['Server-Timing'])
+        line = json.loads(logs.records[0].getMessage())
+        self.assertIsNone(line['db_queries'])
+        self.assertEqual(line['template_renders'], 1)
+
+
+class BenchmarkTest(SimpleTestCase):
+
+    def test_compare(self):
+        command = benchmark.Command()
+        results = {
+            'detail': {'queries': 4, 'p95_ms': 12.0, 'alloc_kib': 100},
+            'admin': {'queries': 9, 'p95_ms': 30.0, 'alloc_kib': 500},
+            'new': {'queries': 1, 'p95_ms': 1.0, 'alloc_kib': 1},
+        }
+        baseline = {
+            'detail': {'queries': 3, 'p95_ms': 10.0, 'alloc_kib': 100},
+            # saved before allocations were measured
+            'admin': {'queries': 9, 'p95_ms': 20.0},
+        }
+        self.assertEqual(command.compare(results, baseline, 0.25),
+                         ['detail queries: 4 > 3',
+                          'admin p95_ms: 30.0 > 20.0'])
+        self.assertEqual(command.compare(results, baseline, 0.5),
+                         ['detail queries: 4 > 3'])
+
+
+class ReplayTrafficTest(SimpleTestCase):
+
+    def test_read_log(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as log_file:
+            log_file.write('Starting gunicorn\n'
+                           '{"path": "/a", "timestamp": 2}\n'
+                           '{"broken": \n'
+                           '{"url_name": "no path"}\n'
+                           '  {"path": "/b", "method": "POST"}\n')
+            log_file.flush()
+            self.assertEqual(
+                list(replay_traffic.read_log([log_file.name])),
+                [{'path': '/a', 'timestamp': 2},
+                 {'path': '/b', 'method': 'POST'}])
+
+    def test_arrivals(self):
+        command = replay_traffic.Command()
+        entries = [{'path': '/', 'timestamp': timestamp}
+                   for timestamp in (12, 10, 16)]
+        self.assertEqual(
+            command.arrivals(entries, {'rate': None, 'speed': 2.0}),
+            [1.0, 0.0, 3.0])
+
+        options = {'rate': 50.0, 'seed': 1, 'speed': 1.0}
+        offsets = command.arrivals(entries * 100, options)
+        self.assertEqual(offsets, command.arrivals(entries * 100, options))
+        self.assertEqual(offsets[0], 0.0)
+        self.assertEqual(offsets, sorted(offsets))
+        # 299 gaps of 1/50s on average
+        self.assertAlmostEqual(offsets[-1], 299 / 50.0, delta=1.5)
+
+        with self.assertRaisesRegex(CommandError, 'no timestamps'):
+            command.arrivals([{'path': '/'}], {'rate': None, 'speed': 1.0})
+
+
+class DatabaseHealthCheckTest(MicrositeTestCase):
+
+    def setUp(self):
+        super(DatabaseHealthCheckTest, self).setUp()
+        patcher = mock.patch.object(settings, 'DB_HEALTH_CHECKS', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = connections['default']
+        self.addCleanup(self.connection.__dict__.pop, 'ensure_connection',
+                        None)
+        # the test database is open, as a connection kept from an earlier
+        # request would be
+        self.connection.ensure_connection()
+
+    def test_checked_on_first_use(self):
+        with mock.patch.object(self.connection, 'is_usable',
+                               return_value=False) as is_usable, \
+                mock.patch.object(self.connection, 'close') as close:
+            db.check_connections()
+            self.assertFalse(is_usable.called)
+            Microsite.objects.count()
+            Microsite.objects.count()
+        self.assertEqual(is_usable.call_count, 1)
+        self.assertEqual(close.call_count, 1)
+
+    def test_usable_connection_is_kept(self):
+        with mock.patch.object(self.connection, 'close') as close:
+            db.check_connections()
+            Microsite.objects.count()
+        self.assertFalse(close.called)
+
+    def test_not_checked_in_a_transaction(self):
+        with transaction.atomic(), \
+                mock.patch.object(self.connection, 'is_usable') as is_usable:
+            db.check_connections()
+            Microsite.objects.count()
+        self.assertFalse(is_usable.called)
+
+    def test_cached_page_runs_no_queries(self):
+        url = reverse('vizmanager:microsite-detail',
+                      kwargs={'pk': self.microsite.pk})
+        self.client.get(url)
+        with mock.patch.object(self.connection, 'is_usable') as is_usable, \
+                self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertFalse(is_usable.called)
+        # still armed for the next request using the database
+        self.assertIn('ensure_connection', self.connection.__dict__)
+
+
+class ProductionProfileTest(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in list(os.environ):
+            if name.startswith('GUNICORN_') or \
+                    name in ('PORT', 'WEB_CONCURRENCY'):
+                del os.environ[name]
+
+    def test_gunicorn_config(self):
+        config = runpy.run_path(os.path.join(
+            settings.BASE_DIR, 'microsite_backend', 'gunicorn_config.py'))
+        self.assertEqual(config['bind'], '0.0.0.0:8000')
+        self.assertEqual(config['worker_class'], 'gthread')
+        self.assertTrue(config['preload_app'])
+        self.assertGreater(config['workers'], 1)
+        self.assertGreater(config['timeout'], settings.UPSTREAM_DEADLINE)
+        with mock.patch('django.db.connections.close_all') as close_all:
+            config['post_fork'](None, None)
+        self.assertTrue(close_all.called)
+
+    def test_import_profile(self):
+        out = io.StringIO()
+        # loaded afresh, so that its imports are timed
+        with mock.patch.dict(sys.modules), \
+                mock.patch.object(sys, 'argv', ['import_profile']), \
+                mock.patch.object(sys, 'stdout', out):
+            sys.modules.pop('microsite_backend.wsgi', None)
+            import_profile.main()
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0].split(), ['cumul', 'ms', 'self', 'ms',
+                                            'module'])
+        self.assertEqual(lines[1].split()[-1], 'microsite_backend.wsgi')
+        self.assertIn('application loaded in', lines[-1])
+
+
+class ThemeFilesTest(MicrositeTestCase):
+
+    def test_theme_file_written_on_save(self):
+        theme = self.microsite.selected_theme
+        path = theme_files.theme_file_path(theme.name)
+        with open(path) as theme_file:
+            self.assertEqual(theme_file.read(), theme.json())
+        self.assertFalse(theme.create_theme_file())
+
+    def test_write_compares_with_the_file_on_disk(self):
+        self.assertTrue(theme_files.write_theme_file('shared', 'A'))
+        self.assertFalse(theme_files.write_theme_file('shared', 'A'))
+        # another worker process writes another version
+        with open(theme_files.theme_file_path('shared'), 'w') as theme_file:
+            theme_file.write('B')
+        self.assertTrue(theme_files.write_theme_file('shared', 'A'))
+        with open(theme_files.theme_file_path('shared')) as theme_file:
+            self.assertEqual(theme_file.read(), 'A')
+
+    def test_theme_json_view(self):
+        theme = self.microsite.selected_theme
+        url = theme.json_url()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode('utf-8')),
+                         json.loads(theme.json()))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content).decode('utf-8'),
+                         theme.json())
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+        latest = reverse('vizmanager:theme-json-latest',
+                         kwargs={'pk': theme.pk})
+        response = self.client.get(latest)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertEqual(self.client.get(
+            latest, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        self.assertEqual(self.client.get(reverse(
+            'vizmanager:theme-json',
+            kwargs={'pk': theme.pk, 'digest': '0123456789abcdef'})
+        ).status_code, 404)
+
+    def test_theme_json_of_another_theme(self):
+        digest = self.microsite.selected_theme.publish()
+        other = Theme.objects.create(name='koeln', microsite=self.microsite,
+                                     brand_color='#000000')
+        self.assertEqual(self.client.get(reverse(
+            'vizmanager:theme-json', kwargs={'pk': other.pk, 'digest': digest})
+        ).status_code, 404)
+
+
+class BuildStaticMicrositesTest(MicrositeTestCase):
+
+    def setUp(self):
+        super(BuildStaticMicrositesTest, self).setUp()
+        self.output = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output.cleanup)
+        static_root = tempfile.TemporaryDirectory()
+        self.addCleanup(static_root.cleanup)
+        os.makedirs(os.path.join(static_root.name, 'js'))
+        with open(os.path.join(static_root.name, 'js', 'app.js'), 'w') as f:
+            f.write('// app')
+        patcher = mock.patch.object(settings, 'STATIC_ROOT', static_root.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # the in-memory test database isn't shared with forked processes
+        patcher = mock.patch('vizmanager.management.commands.'
+                             'build_static_microsites.multiprocessing.Pool',
+                             multiprocessing.dummy.Pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def build(self):
+        out = io.StringIO()
+        call_command('build_static_microsites', '--output', self.output.name,
+                     '--workers', '2', stdout=out)
+        return out.getvalue()
+
+    def path(self, *parts):
+        return os.path.join(self.output.name, *parts)
+
+    def test_build(self):
+        self.add_datasets(2)
+        other = Microsite.objects.create(name='Köln', municipality=Municipality
+                                         .objects.create(name='Köln',
+                                                         country='Germany'))
+        out = self.build()
+        self.assertIn('2 microsites rendered, 0 removed, 0 unchanged', out)
+        self.assertIn('1 static files copied', out)
+        with open(self.path(str(self.microsite.pk), 'index.html'),
+                  'rb') as page:
+            content = page.read()
+        self.assertIn(b'code-1', content)
+        with gzip.open(self.path(str(self.microsite.pk),
+                                 'index.html.gz')) as page:
+            self.assertEqual(page.read(), content)
+        self.assertTrue(os.path.exists(self.path(str(other.pk),
+                                                 'index.html')))
+        with open(self.path('microsite', 'static', 'js', 'app.js')) as f:
+            self.assertEqual(f.read(), '// app')
+
+        # only the changed microsite is rendered again, and the static files
+        # are left alone
+        self.add_datasets(1)
+        with mock.patch('vizmanager.management.commands.'
+                        'build_static_microsites.render_microsite',
+                        wraps=build_static_microsites.render_microsite) \
+                as render:
+            out = self.build()
+        self.assertEqual(render.call_args_list,
+                         [mock.call(self.microsite.pk)])
+        self.assertIn('1 microsites rendered, 0 removed, 1 unchanged', out)
+        self.assertIn('0 static files copied', out)
+        with open(self.path(str(self.microsite.pk), 'index.html')) as page:
+            self.assertIn('code-2', page.read())
+
+        other.delete()
+        self.assertIn('0 microsites rendered, 1 removed, 1 unchanged',
+                      self.build())
+        self.assertFalse(os.path.exists(self.path(str(other.pk))))
+
+    def test_absolute_static_url(self):
+        with mock.patch.object(settings, 'STATIC_URL',
+                               'https://cdn.example.org/static/'):
+            self.assertIn('served from STATIC_URL', self.build())
+        self.assertEqual(sorted(os.listdir(self.output.name)),
+                         sorted(['manifest.json', str(self.microsite.pk)]))
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'os_models': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                  'LOCATION': 'drilldown'},
+})
+class FakeUpstreamTestCase(MicrositeTestCase):
+
+    def setUp(self):
+        super(FakeUpstreamTestCase, self).setUp()
+        self.server = FakeUpstream(members=25)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        snapshots_root = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshots_root.cleanup)
+        for name, value in (('OS_API', self.server.os_api),
+                            ('OS_AGGREGATE_PAGE_SIZE', 100),
+                            ('OS_AGGREGATE_WORKERS', 2),
+                            ('SNAPSHOTS_ROOT', snapshots_root.name)):
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.add_datasets(1)
+        self.dataset = self.microsite.dataset_set.get()
+
+
+class OSModelCacheTest(FakeUpstreamTestCase):
+
+    def expire(self):
+        key = cache.OS_MODEL_KEY.format(
+            digest=cache.os_model_digest(self.dataset.code))
+        entry = cache.os_model_cache().get(key)
+        entry['expires'] = 0
+        cache.os_model_cache().set(key, entry)
+
+    def test_stale_model_is_served_while_refreshed(self):
+        model = cache.get_os_model(self.dataset.code,
+                                   self.dataset.fetch_os_model)
+        self.assertEqual(self.server.requests, 1)
+        self.expire()
+        with mock.patch('vizmanager.cache.threading.Thread') as thread:
+            self.assertEqual(cache.get_os_model(
+                self.dataset.code, self.dataset.fetch_os_model), model)
+            # a single refresh at a time
+            cache.get_os_model(self.dataset.code, self.dataset.fetch_os_model)
+        self.assertEqual(thread.call_count, 1)
+        self.assertEqual(self.server.requests, 1)
+        thread.call_args[1]['target'](*thread.call_args[1]['args'])
+        self.assertEqual(self.server.requests, 2)
+
+    def test_failed_refresh_keeps_the_model(self):
+        model = cache.get_os_model(self.dataset.code,
+                                   self.dataset.fetch_os_model)
+        self.expire()
+        failing = mock.Mock(side_effect=RuntimeError('503'))
+        with self.assertLogs('vizmanager.cache', 'WARNING'):
+            self.assertEqual(cache.refresh_os_model(self.dataset.code,
+                                                    failing), model)
+        # and not asked again before OS_MODEL_CACHE_ERROR_TIMEOUT
+        self.assertEqual(cache.get_os_model(self.dataset.code, failing),
+                         model)
+        self.assertEqual(failing.call_count, 1)
+
+    def test_failing_codes_are_remembered(self):
+        failing = mock.Mock(side_effect=RuntimeError('404'))
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                cache.get_os_model('unknown', failing)
+        self.assertEqual(failing.call_count, 1)
+
+    @mock.patch.dict(upstream._breakers, clear=True)
+    def test_unreachable_upstream(self):
+        refused = mock.Mock(
+            side_effect=lambda: upstream.get('http://127.0.0.1:1/model'))
+        # a stale model is kept, and refreshed after a while
+        model = cache.get_os_model(self.dataset.code,
+                                   self.dataset.fetch_os_model)
+        self.expire()
+        with self.assertLogs('vizmanager.cache', 'WARNING'):
+            self.assertEqual(cache.refresh_os_model(self.dataset.code,
+                                                    refused), model)
+        self.assertEqual(cache.get_os_model(self.dataset.code, refused),
+                         model)
+        self.assertEqual(refused.call_count, 1)
+
+        # no model yet: the outage is remembered like an unknown code
+        with mock.patch.object(settings, 'OS_API', 'http://127.0.0.1:1/api'):
+            dataset = Dataset.objects.get(pk=self.dataset.pk)
+            with self.assertRaises(upstream.UpstreamError):
+                dataset.get_os_model()
+            with self.assertRaises(RuntimeError):
+                cache.get_os_model(self.dataset.code, refused)
+        self.assertEqual(refused.call_count, 1)
+
+
+class KPIFilterTermTest(FakeUpstreamTestCase):
+
+    def add_terms(self, *labels):
+        for i, label in enumerate(labels):
+            KPIFilterTerm.objects.create(
+                kind='organizations', label=label,
+                url='http://example.org/organization/{}'.format(i))
+
+    def test_search(self):
+        self.add_terms('Stadt Köln', 'Köln', 'Bonn', 'Landkreis Kölleda',
+                       'Bad Honnef')
+        self.assertEqual(
+            [term.label for term in
+             KPIFilterTerm.objects.search('organizations', 'KOL', 10)],
+            ['Köln', 'Landkreis Kölleda', 'Stadt Köln'])
+        # only word prefixes match, and only within the vocabulary
+        self.assertEqual(
+            KPIFilterTerm.objects.search('organizations', 'onn', 10), [])
+        self.assertEqual(KPIFilterTerm.objects.search('years', 'bonn', 10),
+                         [])
+
+    def test_search_is_limited(self):
+        self.add_terms(*(['Bonn {}'.format(i) for i in range(10)] +
+                         ['Stadt Bonn {}'.format(i) for i in range(10)]))
+        self.assertEqual(
+            [term.label for term in
+             KPIFilterTerm.objects.search('organizations', 'bonn', 12)],
+            ['Bonn {}'.format(i) for i in range(10)] +
+            ['Stadt Bonn 0', 'Stadt Bonn 1'])
+        self.assertEqual(len(
+            KPIFilterTerm.objects.search('organizations', 'bonn', 5)), 5)
+
+    def test_word_index(self):
+        self.add_terms('Stadt Köln')
+        term = KPIFilterTerm.objects.get()
+        self.assertEqual(
+            sorted(term.suffixes.values_list('suffix', flat=True)),
+            ['koln', 'stadt koln'])
+        term.label = 'Bad Honnef'
+        term.save()
+        self.assertEqual(
+            sorted(term.suffixes.values_list('suffix', flat=True)),
+            ['bad honnef', 'honnef'])
+
+    def test_sync(self):
+        with mock.patch.object(settings, 'KPI_API', self.server.kpi_api):
+            out = io.StringIO()
+            call_command('sync_kpi_filters', 'years', stdout=out)
+            self.assertIn('years: 10 new, 0 changed, 0 removed',
+                          out.getvalue())
+            self.assertFalse(KPIFilterTerm.objects
+                             .filter(suffixes__isnull=True).exists())
+            url = 'http://kpi.example.org/years/-3'
+            self.assertEqual(
+                [term.url for term in
+                 KPIFilterTerm.objects.search('years', 'years 3', 10)],
+                [url])
+
+            # changed and removed terms
+            term = KPIFilterTerm.objects.get(url=url)
+            term.label = 'Old label'
+            term.save()
+            KPIFilterTerm.objects.create(kind='years', label='Gone',
+                                         url='http://example.org/gone')
+            out = io.StringIO()
+            call_command('sync_kpi_filters', 'years', stdout=out)
+            self.assertIn('years: 0 new, 1 changed, 1 removed',
+                          out.getvalue())
+        self.assertEqual(KPIFilterTerm.objects.filter(kind='years').count(),
+                         10)
+        self.assertFalse(KPIFilterTerm.objects.exclude(kind='years').exists())
+        self.assertIsNotNone(
+            SyncState.objects.get(name='kpi-filters').finished)
+
+
+class DrilldownTest(FakeUpstreamTestCase):
+
+    def test_drilldown(self):
+        cells = list(self.dataset.drilldown('hierarchy_0'))
+        self.assertEqual([cell['dimension_0.attribute_0'] for cell in cells],
+                         list(range(25)))
+        self.assertEqual(cells[3]['dimension_0.attribute_1'], 'Member 3')
+        self.assertEqual(cells[3]['measure_0.sum'], 4.0)
+
+        cells = list(self.dataset.drilldown(
+            'hierarchy_0', {'dimension_0.attribute_0': 3}, 'measure_1'))
+        self.assertEqual(len(cells), 25)
+        self.assertIn('dimension_1.attribute_0', cells[0])
+        self.assertEqual(cells[1]['measure_1.sum'], 5.0)
+
+        self.assertEqual(list(self.dataset.drilldown('hierarchy_0', {
+            'dimension_{}.attribute_0'.format(i): 0 for i in range(3)})), [])
+
+    def test_paging_and_cache(self):
+        self.assertEqual(len(list(self.dataset.aggregate(
+            ['dimension_0.attribute_0', 'dimension_1.attribute_0']))), 625)
+        # the model, then 7 pages of 100 cells
+        self.assertEqual(self.server.requests, 8)
+
+        cells = self.dataset.aggregate(['dimension_0.attribute_0',
+                                        'dimension_1.attribute_0'])
+        self.assertEqual(next(cells)['dimension_1.attribute_0'], 0)
+        self.assertEqual(len(list(cells)), 624)
+        self.assertEqual(self.server.requests, 8)
+
+    def test_build_tree(self):
+        self.server.members = 5
+        tree = self.dataset.build_tree('hierarchy_1')
+        self.assertEqual([node.key for node in tree.root.children],
+                         list(range(5)))
+        self.assertEqual(tree.root.value, sum(range(1, 6)))
+        requests = self.server.requests
+
+        # the children of all the siblings come in one query
+        children = tree.expand(tree.root.children[2])
+        self.assertEqual([node.label for node in children],
+                         ['Member {}'.format(i) for i in range(5)])
+        self.assertEqual(children[1].value, 2 + 1 + 1)
+        self.assertTrue(all(node.expanded for node in tree.root.children))
+        self.assertEqual(self.server.requests, requests + 1)
+
+        leaf = tree.find([2, 1, 4])
+        self.assertEqual(leaf.value, 2 + 1 + 4 + 1)
+        self.assertEqual(tree.expand(leaf), [])
+        self.assertEqual(self.server.requests, requests + 2)
+        self.assertEqual(
+            len(tree.as_dict()['children'][2]['children'][1]['children']), 5)
+
+        # expanded levels are cached
+        tree = self.dataset.build_tree('hierarchy_1')
+        tree.find([2, 1, 4])
+        self.assertEqual(self.server.requests, requests + 2)
+
+
+class SnapshotTest(FakeUpstreamTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.server.facts = 250
+
+    def expected(self, facts, key, cut, measure):
+        # what the fake upstream's facts sum to, see fake_upstream.facts
+        totals = {}
+        for n in range(facts):
+            if all((n * (i + 1)) % 25 == value for i, value in cut.items()):
+                member = (n * (key + 1)) % 25
+                totals[member] = totals.get(member, 0.0) + n % 7 + measure
+        return totals
+
+    def test_incremental_refresh(self):
+        snapshot, downloaded = snapshots.take_snapshot(self.dataset,
+                                                       page_size=100)
+        self.assertEqual((snapshot.rows, downloaded), (250, 250))
+        requests = self.server.requests
+
+        self.server.facts = 420
+        snapshots.take_snapshot(self.dataset, page_size=100)
+        # the first page, the check of the last stored page, then from the
+        # page holding fact 250 on
+        self.assertEqual(self.server.requests, requests + 1 + 1 + 3)
+
+        snapshot = snapshots.Snapshot.open(self.dataset.code)
+        self.assertEqual(snapshot.rows, 420)
+        dimension = snapshot.dimension_index('dimension_2.attribute_1')
+        self.assertEqual(snapshot.dimensions[dimension]['name'],
+                         'dimension_2')
+        keys = snapshot.dimensions[dimension]['keys']
+        codes = snapshot.codes(dimension)
+        self.assertEqual([keys[code] for code in codes[298:302]],
+                         [(n * 3) % 25 for n in range(298, 302)])
+        values = snapshot.values(snapshot.measure_index('measure_1'))
+        self.assertEqual(values.dtype.name, 'float64')
+        self.assertEqual(list(values[:3]), [1.0, 2.0, 3.0])
+
+    def test_rebuilt_when_facts_disappear(self):
+        snapshots.take_snapshot(self.dataset, page_size=100)
+        self.server.facts = 120
+        snapshot, downloaded = snapshots.take_snapshot(self.dataset,
+                                                       page_size=100)
+        self.assertEqual((snapshot.rows, downloaded), (120, 120))
+        self.assertEqual(snapshot.meta['generation'], 2)
+        self.assertEqual(len(snapshot.codes(0)), 120)
+
+    def test_rebuilt_when_facts_change(self):
+        snapshots.take_snapshot(self.dataset, page_size=100)
+        self.server.revision = 1
+        self.server.facts = 300
+        snapshot, downloaded = snapshots.take_snapshot(self.dataset,
+                                                       page_size=100)
+        self.assertEqual((snapshot.rows, downloaded), (300, 300))
+        self.assertEqual(snapshot.meta['generation'], 2)
+        self.assertEqual(snapshot.values(0)[0], 1.0)
+
+    def test_facts_are_ordered(self):
+        with mock.patch('vizmanager.snapshots.upstream.get',
+                        wraps=snapshots.upstream.get) as get:
+            snapshots.take_snapshot(self.dataset, page_size=100)
+        order = get.call_args[1]['params']['order']
+        self.assertTrue(order.startswith('dimension_0.attribute_0:asc|'))
+
+    def test_snapshot_all_datasets(self):
+        self.add_datasets(2)
+        Dataset.objects.create(name='Empty', microsite=self.microsite,
+                               code='', viz_type='Treemap')
+        for i, dimension in ((1, 6), (2, 7)):
+            Dataset.objects.create(
+                name='Same code {}'.format(i), microsite=self.microsite,
+                code='code-0', viz_type='Treemap',
+                initial_dimension='dimension_{}.attribute_1'
+                .format(dimension))
+        out = io.StringIO()
+        call_command('snapshot_dataset', '--all', '--page-size', '100',
+                     stdout=out)
+        self.assertEqual(out.getvalue().count('250 in the snapshot'), 3)
+        for code in ('code-0', 'code-1', 'code-2'):
+            self.assertTrue(snapshots.Snapshot.open(code).meta['rollups'])
+        # rolled up for the initial dimensions of every dataset of the code
+        rollups = snapshots.Snapshot.open('code-0').meta['rollups']
+        self.assertIn('6', rollups)
+        self.assertIn('7', rollups)
+
+    def test_local_aggregate(self):
+        snapshots.take_snapshot(self.dataset, page_size=100)
+        self.dataset = Dataset.objects.get(pk=self.dataset.pk)
+        requests = self.server.requests
+
+        cells = list(self.dataset.aggregate(
+            ['dimension_0.attribute_0', 'dimension_0.attribute_1'],
+            {'dimension_1.attribute_0': 4}, 'measure_1'))
+        expected = self.expected(250, 0, {1: 4}, 1)
+        self.assertEqual(
+            dict((cell['dimension_0.attribute_0'], cell['measure_1.sum'])
+                 for cell in cells), expected)
+        self.assertEqual(
+            cells[0]['dimension_0.attribute_1'],
+            'Member {}'.format(cells[0]['dimension_0.attribute_0']))
+        self.assertEqual([cell['dimension_0.attribute_0'] for cell in cells],
+                         sorted(expected))
+        self.assertEqual(self.server.requests, requests)
+
+        query = AggregateQuery(self.dataset.get_snapshot(), {
+            'drilldown': 'dimension_2.attribute_1|dimension_1.attribute_0',
+            'aggregates': 'measure_0.sum|_count',
+            'order': 'measure_0.sum:desc|dimension_1.attribute_0:asc'})
+        response = query.response(page=2, pagesize=10)
+        self.assertEqual(response['total_cell_count'], 25)
+        self.assertEqual(len(response['cells']), 10)
+        self.assertEqual(response['summary'], {
+            'measure_0.sum': sum(n % 7 for n in range(250)), '_count': 250})
+        cells = list(query.cells())
+        self.assertEqual(cells[10:20], response['cells'])
+        totals = [cell['measure_0.sum'] for cell in cells]
+        self.assertEqual(totals, sorted(totals, reverse=True))
+        self.assertEqual(sum(cell['_count'] for cell in cells), 250)
+
+        # attributes missing from the snapshot are asked upstream
+        self.assertEqual(len(list(self.dataset.aggregate(['dimension_0.x']))),
+                         25)
+        self.assertEqual(self.server.requests, requests + 1)
+
+    def test_rollups(self):
+        self.dataset.initial_dimension = 'dimension_7.attribute_1'
+        snapshot, _ = snapshots.take_snapshot(self.dataset, page_size=100)
+        self.assertEqual(sorted(snapshot.meta['rollups']),
+                         ['0', '0-1', '0-1-2', '3', '3-4', '3-4-5', '7'])
+        source = snapshot.source(['dimension_4.attribute_1',
+                                  'dimension_3.attribute_0'])
+        self.assertEqual(source.indexes, [3, 4])
+        self.assertEqual(source.rows, 25)
+        self.assertIs(snapshot.source(['dimension_6.attribute_0']), snapshot)
+
+        self.server.facts = 420
+        snapshot, _ = snapshots.take_snapshot(self.dataset, page_size=100)
+        rollup = snapshot.source(['dimension_1.attribute_0'])
+        self.assertEqual(rollup.meta['facts'], 420)
+        # the rollups of the first 250 facts are gone
+        self.assertEqual(sorted(os.listdir(snapshot.column_path(''))), sorted(
+            ['rollup_{}_420'.format(name) for name in snapshot.meta['rollups']]
+            + ['dimension_{}.codes'.format(i) for i in range(8)]
+            + ['measure_{}.values'.format(i) for i in range(2)]))
+        query = AggregateQuery(rollup, {
+            'drilldown': 'dimension_1.attribute_0',
+            'cut': 'dimension_0.attribute_0:4',
+            'aggregates': 'measure_1.sum|_count'})
+        expected = self.expected(420, 1, {0: 4}, 1)
+        self.assertEqual(
+            dict((cell['dimension_1.attribute_0'], cell['measure_1.sum'])
+                 for cell in query.cells()), expected)
+        self.assertEqual(query.summary['_count'], len(
+            [n for n in range(420) if n % 25 == 4]))
+
+        # the trees are served from the rollups
+        self.dataset = Dataset.objects.get(pk=self.dataset.pk)
+        requests = self.server.requests
+        tree = self.dataset.build_tree('hierarchy_0', 'measure_0')
+        self.assertEqual(tree.root.value, sum(n % 7 for n in range(420)))
+        leaf = tree.find([4, 8, 12])
+        self.assertEqual(leaf.value, sum(n % 7 for n in range(420)
+                                         if n % 25 == 4 and (n * 2) % 25 == 8
+                                         and (n * 3) % 25 == 12))
+        self.assertEqual(self.server.requests, requests)
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers 503 to the next `server.failures` requests, 200 afterwards, after
+    `server.delay` seconds
+    """
+
+    def do_GET(self):
+        self.server.requests += 1
+        time.sleep(self.server.delay)
+        status = 503 if self.server.failures else 200
+        self.server.failures = max(self.server.failures - 1, 0)
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UpstreamTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.server.requests = 0
+        self.server.failures = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://{}:{}/'.format(*self.server.server_address)
+        patcher = mock.patch.dict(upstream._breakers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_server_errors_are_retried(self):
+        self.server.failures = settings.UPSTREAM_RETRIES
+        self.assertEqual(upstream.get(self.url).status_code, 200)
+        self.assertEqual(self.server.requests, settings.UPSTREAM_RETRIES + 1)
+
+        self.server.failures = settings.UPSTREAM_RETRIES + 1
+        self.assertEqual(upstream.get(self.url).status_code, 503)
+
+    def test_read_timeouts_are_not_retried(self):
+        self.server.delay = 0.5
+        with mock.patch.object(settings, 'UPSTREAM_READ_TIMEOUT', 0.1), \
+                self.assertRaisesRegex(upstream.UpstreamError, 'failed'):
+            upstream.get(self.url)
+        self.assertEqual(self.server.requests, 1)
+
+    def test_deadline(self):
+        self.assertLessEqual(upstream.worst_case_duration(),
+                             settings.UPSTREAM_DEADLINE)
+        with mock.patch.object(settings, 'UPSTREAM_RETRIES', 3):
+            # 4 * 8.05 + 0.2 * 2 + 0.2 * 4
+            self.assertAlmostEqual(upstream.worst_case_duration(), 33.4)
+
+    def test_deadline_below_worker_timeout(self):
+        config = os.path.join(settings.BASE_DIR, 'microsite_backend',
+                              'gunicorn_config.py')
+        with mock.patch.dict(os.environ, GUNICORN_TIMEOUT='20'), \
+                self.assertRaisesRegex(ValueError, 'UPSTREAM_DEADLINE'):
+            runpy.run_path(config)
+
+    def test_failing_host_is_left_alone(self):
+        self.server.failures = 1000
+        for _ in range(settings.UPSTREAM_CIRCUIT_FAILURES):
+            self.assertEqual(upstream.get(self.url).status_code, 503)
+        requests = self.server.requests
+        with self.assertRaisesRegex(upstream.UpstreamError, 'not calling'):
+            upstream.get(self.url)
+        self.assertEqual(self.server.requests, requests)
+        # other hosts are still called
+        with self.assertRaisesRegex(upstream.UpstreamError, 'failed'):
+            upstream.get('http://127.0.0.1:1/')
+
+    def test_circuit_breaker(self):
+        circuit = upstream.CircuitBreaker(2, 30)
+        with mock.patch('vizmanager.upstream.time.time', return_value=100):
+            circuit.failure()
+            self.assertTrue(circuit.allow())
+            circuit.failure()
+            self.assertFalse(circuit.allow())
+        with mock.patch('vizmanager.upstream.time.time', return_value=131):
+            # a single trial call once the timeout passed
+            self.assertTrue(circuit.allow())
+            self.assertFalse(circuit.allow())
+            circuit.failure()
+            self.assertFalse(circuit.allow())
+        with mock.patch('vizmanager.upstream.time.time', return_value=162):
+            self.assertTrue(circuit.allow())
+            circuit.success()
+            self.assertTrue(circuit.allow())
+            circuit.failure()
+            self.assertTrue(circuit.allow())
+
+
+class AutocompleteTest(SimpleTestCase):
+
+    class Search(UpstreamAutocomplete):
+        def endpoint(self):
+            return 'http://example.org/search'
+
+    def setUp(self):
+        UpstreamAutocomplete.results_cache.clear()
+        self.addCleanup(UpstreamAutocomplete.results_cache.clear)
+        self.view = self.Search()
+        self.view.fetch = self.fetch = mock.Mock(return_value=[
+            {'id': 1, 'text': 'Bonn'}, {'id': 2, 'text': 'Bochum'},
+            {'id': 3, 'text': 'Bad Honnef'}])
+
+    def test_lru_cache(self):
+        lru = LRUCache(2, 10)
+        with mock.patch('vizmanager.cache.time.time', return_value=100):
+            lru.set('a', 1)
+            lru.set('b', 2)
+            self.assertEqual(lru.get('a'), 1)
+            # b is the least recently used
+            lru.set('c', 3)
+            self.assertIsNone(lru.get('b'))
+            self.assertEqual(lru.get('a'), 1)
+            self.assertEqual(lru.get('c'), 3)
+        with mock.patch('vizmanager.cache.time.time', return_value=110):
+            self.assertIsNone(lru.get('a'))
+        self.assertEqual(list(lru.entries), ['c'])
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        waiting = threading.Semaphore(0)
+
+        class Done(threading.Event):
+            def wait(self, timeout=None):
+                waiting.release()
+                return super(Done, self).wait(timeout)
+
+        class Call(SingleFlight.Call):
+            def __init__(self):
+                super(Call, self).__init__()
+                self.done = Done()
+
+        flight.Call = Call
+        release = threading.Event()
+        function = mock.Mock(side_effect=lambda: release.wait() and 'result')
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(flight.do('key', function)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # the first thread runs the function, the three others wait for it
+        for _ in range(3):
+            waiting.acquire()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(function.call_count, 1)
+        self.assertEqual(flight.calls, {})
+
+        # failures are shared, but not remembered
+        with self.assertRaises(RuntimeError):
+            flight.do('key', mock.Mock(side_effect=RuntimeError))
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_results_are_cached(self):
+        results = self.view.get_results('bo')
+        self.assertEqual(self.view.get_results('bo'), results)
+        self.fetch.assert_called_once_with('bo')
+
+    def test_answered_from_a_prefix(self):
+        self.view.get_results('bo')
+        self.assertEqual(self.view.get_results('bon'),
+                         [{'id': 1, 'text': 'Bonn'}])
+        self.assertEqual(self.fetch.call_count, 1)
+
+    def test_truncated_prefix_is_not_used(self):
+        self.view.MAX_COMPLETIONS = 3
+        self.view.get_results('bo')
+        self.view.get_results('bon')
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_prefix_filtering_can_be_disabled(self):
+        self.view.FILTER_FROM_PREFIX = False
+        self.view.get_results('bo')
+        self.view.get_results('bon')
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_failures_are_not_cached(self):
+        self.fetch.side_effect = upstream.UpstreamError('down')
+        self.assertEqual(self.view.get_results('bo'), [])
+        self.fetch.side_effect = None
+        self.assertEqual(len(self.view.get_results('bo')), 3)
+        self.assertEqual(self.fetch.call_count, 2)
+
+
+class OpenSpendingPackageTest(TestCase):
+
+    def catalogue(self, size, fail_on=None):
+        """
+        Stand in for OpenSpending's package search, listing `size` packages
+        and failing on the `fail_on`th call
+        """
+        calls = []
+
+        def get(url, params=None):
+            calls.append(params['from'])
+            if len(calls) == fail_on:
+                raise upstream.UpstreamError('timed out')
+            start = params['from']
+            response = mock.Mock(ok=True, status_code=200)
+            response.json.return_value = [
+                {'id': 'package-{}'.format(i),
+                 'package': {'title': 'Budget of city {}'.format(i)}}
+                for i in range(start, min(start + params['size'], size))]
+            return response
+
+        return mock.patch('vizmanager.upstream.get', side_effect=get), calls
+
+    def sync(self, *args):
+        out = io.StringIO()
+        call_command('sync_os_packages', '--page-size', '40', *args,
+                     stdout=out)
+        return out.getvalue()
+
+    def titles(self, q, limit=100):
+        return [package.title for package in
+                OpenSpendingPackage.objects.search(q, limit)]
+
+    def test_ngrams(self):
+        self.assertEqual(ngrams('budget'), {'bud', 'udg', 'dge', 'get'})
+        self.assertEqual(ngrams('bb bb'), {'bb ', 'b b', ' bb'})
+        self.assertEqual(ngrams('ab'), set())
+
+    def test_search(self):
+        sync_os_packages.Command().store([
+            {'id': code, 'package': {'title': title}} for code, title in
+            (('a', 'Budget of Zons'), ('b', 'Zons budget'), ('c', 'Bonn'),
+             ('d', 'Budget of Zonsbeck'))])
+        self.assertEqual(OpenSpendingPackageGram.objects.filter(
+            package='c').count(), 2)
+        # titles starting with the query first
+        self.assertEqual(self.titles('zons'), ['Zons budget', 'Budget of Zons',
+                                               'Budget of Zonsbeck'])
+        self.assertEqual(self.titles('zons', 2), ['Zons budget',
+                                                  'Budget of Zons'])
+        # too short for the index
+        self.assertEqual(self.titles('zo'), ['Zons budget', 'Budget of Zons',
+                                             'Budget of Zonsbeck'])
+        # all grams have to match, in order
+        self.assertEqual(self.titles('zons budget'), ['Zons budget'])
+        self.assertEqual(self.titles('bonnx'), [])
+
+    def test_sync_is_resumed(self):
+        patcher, calls = self.catalogue(100, fail_on=2)
+        with patcher:
+            with self.assertRaisesRegex(CommandError, 'to resume'):
+                self.sync()
+            self.assertEqual(OpenSpendingPackage.objects.count(), 40)
+            self.assertIn('Resuming at package 40', self.sync())
+        self.assertEqual(calls, [0, 40, 40, 80, 100])
+        self.assertEqual(OpenSpendingPackage.objects.count(), 100)
+        self.assertIsNotNone(
+            SyncState.objects.get(name='os-packages').finished)
+        self.assertEqual(self.titles('city 42'), ['Budget of city 42'])
+
+        # a finished sync starts over, updating changed titles and removing
+        # the packages gone from the catalogue
+        OpenSpendingPackage.objects.filter(code='package-42')\
+            .update(title='Old title')
+        patcher, calls = self.catalogue(90)
+        with patcher:
+            self.assertIn('90 packages, 10 removed', self.sync())
+        self.assertEqual(calls, [0, 40, 80, 90])
+        self.assertEqual(OpenSpendingPackage.objects.get(
+            code='package-42').title, 'Budget of city 42')
+        self.assertEqual(self.titles('city 9'), ['Budget of city 9'])
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'os_models': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                  'LOCATION': 'prefetch'},
+})
+class PrefetchOSModelsTest(TestCase):
+
+    def setUp(self):
+        caches['os_models'].clear()
+        for code in ('code-0', 'code-1', 'code-2', 'code-2', '', 'missing'):
+            Dataset.objects.create(name=code, code=code, viz_type='Treemap')
+
+        def fetch(dataset):
+            if dataset.code == 'missing':
+                raise RuntimeError('Unknown dataset')
+            return {'code': dataset.code}
+
+        patcher = mock.patch.object(Dataset, 'fetch_os_model', autospec=True,
+                                    side_effect=fetch)
+        self.fetch = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_each_code_is_fetched_once(self):
+        datasets = Dataset.objects.prefetch_os_models()
+        self.assertEqual(len(datasets), 6)
+        self.assertEqual(self.fetch.call_count, 4)
+        for dataset in datasets:
+            if dataset.code.startswith('code'):
+                self.assertEqual(dataset.os_model, {'code': dataset.code})
+        same_code = [dataset for dataset in datasets
+                     if dataset.code == 'code-2']
+        self.assertIs(same_code[0].os_model, same_code[1].os_model)
+        self.assertEqual(next(dataset for dataset in datasets
+                              if dataset.code == '').os_model,
+                         {'dimensions': {}, 'measures': {},
+                          'hierarchies': {}})
+        missing = next(dataset for dataset in datasets
+                       if dataset.code == 'missing')
+        self.assertFalse(hasattr(missing, 'os_model'))
+        with self.assertRaises(RuntimeError):
+            missing.get_os_model()
+
+        # the models are shared through the cache, the failure as well
+        Dataset.objects.prefetch_os_models()
+        self.assertEqual(self.fetch.call_count, 4)
+
+    def test_only_missing_models_are_fetched(self):
+        datasets = list(Dataset.objects.exclude(code='missing')
+                        .order_by('pk'))
+        for dataset in datasets[:2]:
+            dataset.os_model = {}
+        self.assertEqual(Dataset.objects.prefetch_os_models(datasets),
+                         datasets)
+        self.assertEqual(self.fetch.call_count, 1)
+        self.assertEqual(datasets[0].os_model, {})
+
+
+class ModelDiffMixinTest(TestCase):
+
+    def setUp(self):
+        municipality = Municipality.objects.create(name='Bonn',
+                                                   country='Germany')
+        self.microsite = Microsite.objects.create(name='Bonn',
+                                                  municipality=municipality)
+        self.other = Microsite.objects.create(name='Köln',
+                                              municipality=municipality)
+        Dataset.objects.create(name='Dataset', microsite=self.microsite,
+                               code='code-0', viz_type='Treemap')
+
+    def test_diff(self):
+        dataset = Dataset.objects.get()
+        self.assertFalse(dataset.has_changed)
+        dataset.code = 'other'
+        dataset.microsite = self.other
+        # only the tracked fields
+        dataset.name = 'Renamed'
+        self.assertEqual(dataset.diff, {
+            'code': ('code-0', 'other'),
+            'microsite': (self.microsite.pk, self.other.pk)})
+        self.assertEqual(set(dataset.changed_fields), {'code', 'microsite'})
+        self.assertEqual(dataset.get_field_diff('code'), ('code-0', 'other'))
+        self.assertIsNone(dataset.get_field_diff('name'))
+        dataset.save()
+        self.assertEqual(dataset.diff, {})
+
+        # a code can't be emptied
+        dataset.code = ''
+        dataset.save()
+        self.assertEqual(Dataset.objects.get().code, 'other')
+
+    def test_deferred_fields_are_not_tracked(self):
+        dataset = Dataset.objects.only('name').get()
+        dataset.code = 'other'
+        self.assertEqual(dataset.diff, {})
+
+    def test_untracked(self):
+        with untracked():
+            with untracked():
+                pass
+            dataset = Dataset.objects.get()
+        dataset.code = 'other'
+        self.assertFalse(dataset.has_changed)
+        # saving starts tracking again
+        dataset.save()
+        dataset.code = 'code-0'
+        self.assertEqual(dataset.diff, {'code': ('other', 'code-0')})
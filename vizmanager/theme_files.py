@@ -0,0 +1,147 @@
+"""
+Materialisation of themes into OS Viewer's themes folder, and into the
+precompressed variants served by the theme JSON endpoint.
+
+Theme files are written behind the request by a background thread: saves are
+queued per theme, so a burst of saves of the same theme (e.g. an admin
+list_editable submit) ends up as a single write of its latest content. Files
+are replaced atomically, and only when their content actually changed.
+"""
+import atexit
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from microsite_backend import settings
+
+try:
+    import brotli
+except ImportError:  # optional, themes are only served gzipped without it
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
+_pending = {}
+_lock = threading.Lock()
+_wakeup = threading.Event()
+_worker = None
+
+
+def theme_file_path(name):
+    """
+    :param name: string, name of the theme
+    :return: string, path of the file of the theme
+    """
+    return os.path.join(settings.OS_VIEWER_THEMES_FOLDER,
+                        '{}.json'.format(name))
+
+
+def content_digest(content):
+    """
+    :param content: string, JSON of a theme
+    :return: string, short hash identifying the content
+    """
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+def encode_variants(content):
+    """
+    Precompress the JSON of a theme in every supported content encoding
+    :param content: string, JSON of a theme
+    :return: dictionary of bytes by content encoding ('identity', 'gzip' and,
+             if the brotli module is installed, 'br')
+    """
+    data = content.encode('utf-8')
+    variants = {
+        'identity': data,
+        'gzip': gzip.compress(data, 9),
+    }
+    if brotli is not None:
+        variants['br'] = brotli.compress(data)
+    return variants
+
+
+def write_theme_file(name, content):
+    """
+    Write the file of a theme, unless it already has this content
+    :param name: string, name of the theme
+    :param content: string, JSON of the theme
+    :return: boolean, whether the file was written
+    """
+    path = theme_file_path(name)
+    digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    # compare with the file on disk, other processes may have written it
+    try:
+        with open(path, 'rb') as theme_file:
+            if hashlib.sha1(theme_file.read()).hexdigest() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+
+    folder = os.path.dirname(path)
+    # create the folder if it doesn't exist to avoid crashing
+    os.makedirs(folder, exist_ok=True)
+    # write next to the destination and rename, so OS Viewer never reads a
+    # partially written file
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(content)
+        os.replace(temp_path, path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+    return True
+
+
+def enqueue(key, name, content):
+    """
+    Queue the file of a theme to be written by the background thread,
+    replacing any write of the same theme still waiting
+    :param key: hashable identifying the theme, usually its primary key
+    :param name: string, name of the theme
+    :param content: string, JSON of the theme
+    :return: None
+    """
+    global _worker
+    with _lock:
+        _pending[key] = (name, content)
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name='theme-files',
+                                       daemon=True)
+            _worker.start()
+    _wakeup.set()
+
+
+def flush():
+    """
+    Write all queued theme files now
+    :return: None
+    """
+    with _lock:
+        pending = list(_pending.values())
+        _pending.clear()
+    for name, content in pending:
+        try:
+            write_theme_file(name, content)
+        except OSError:
+            logger.exception('Could not write the file of theme %s', name)
+
+
+def _run():
+    while True:
+        _wakeup.wait()
+        _wakeup.clear()
+        # give further saves of the same themes a chance to be coalesced
+        time.sleep(settings.THEME_FILES_WRITE_DELAY)
+        flush()
+
+
+# don't lose queued writes when the process exits
+atexit.register(flush)
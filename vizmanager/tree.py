@@ -0,0 +1,135 @@
+"""
+Lazily expanded trees of the members of an OpenSpending hierarchy, see
+Dataset.build_tree.
+Only the first level is fetched up front. Expanding a node fetches the next
+level under the node and all its siblings in a single aggregate query, so
+walking down a tree costs one query per level however wide it is, and the
+pages of every query are cached by Dataset.aggregate.
+"""
+
+
+class TreeNode(object):
+    """
+    Member of a hierarchy level. `children` is None until the node is
+    expanded, an empty list for the leaves.
+    """
+    __slots__ = ('key', 'label', 'value', 'depth', 'parent', 'children')
+
+    def __init__(self, key, label, value, depth, parent):
+        self.key = key
+        self.label = label
+        self.value = value
+        self.depth = depth
+        self.parent = parent
+        self.children = None
+
+    @property
+    def expanded(self):
+        return self.children is not None
+
+    def __repr__(self):
+        return '<TreeNode {} {}>'.format(self.depth, self.key)
+
+
+class HierarchyTree(object):
+
+    def __init__(self, dataset, hierarchy, measure=None):
+        """
+        :param dataset: Dataset
+        :param hierarchy: string, name of a hierarchy of the dataset's model
+        :param measure: string, name of a measure, see
+                        Dataset.default_measure
+        """
+        self.dataset = dataset
+        self.hierarchy = hierarchy
+        self.measure = measure or dataset.default_measure()
+        self.aggregate = '{}.sum'.format(self.measure)
+        # key and label refs of each level
+        self.levels = [dataset.level_refs(level) for level in
+                       dataset.get_hierarchies()[hierarchy]['levels']]
+        self.root = TreeNode(None, hierarchy, None, 0, None)
+
+    def cut(self, node):
+        """
+        :param node: TreeNode
+        :return: dictionary of the key refs of the node and its ancestors'
+                 levels to their keys
+        """
+        cut = {}
+        while node is not None and node.parent is not None:
+            cut[self.levels[node.depth - 1][0]] = node.key
+            node = node.parent
+        return cut
+
+    def expand(self, node=None):
+        """
+        Fetch the children of a node, and those of its siblings in the same
+        query, unless they were fetched already
+        :param node: TreeNode, the root by default
+        :return: list of the children of the node
+        """
+        node = node or self.root
+        if node.expanded:
+            return node.children
+        if node.depth == len(self.levels):
+            node.children = []
+            return node.children
+
+        # children are only set once their whole level arrived, a failing
+        # query leaves the nodes unexpanded
+        level = self.levels[node.depth]
+        if node.parent is None:
+            children = [self.child(node, level, cell) for cell in
+                        self.dataset.aggregate(level, measure=self.measure)]
+            node.value = sum(child.value for child in children)
+            node.children = children
+            return node.children
+
+        siblings = dict((sibling.key, (sibling, []))
+                        for sibling in node.parent.children
+                        if not sibling.expanded)
+        parent_level = self.levels[node.depth - 1]
+        for cell in self.dataset.aggregate(parent_level + level,
+                                           self.cut(node.parent),
+                                           self.measure):
+            sibling, children = siblings.get(cell[parent_level[0]],
+                                             (None, None))
+            if sibling is not None:
+                children.append(self.child(sibling, level, cell))
+        for sibling, children in siblings.values():
+            sibling.children = children
+        return node.children
+
+    def child(self, node, level, cell):
+        """
+        :return: TreeNode of the member of `level` in `cell`, under `node`
+        """
+        return TreeNode(cell[level[0]], cell[level[-1]],
+                        cell.get(self.aggregate, 0), node.depth + 1, node)
+
+    def find(self, path):
+        """
+        Expand the tree down a path of keys
+        :param path: list of keys, from the first level down
+        :return: TreeNode, None if a key is not a member of its level
+        """
+        node = self.root
+        for key in path:
+            node = next((child for child in self.expand(node)
+                         if child.key == key), None)
+            if node is None:
+                return None
+        return node
+
+    def as_dict(self, node=None):
+        """
+        :param node: TreeNode, the root by default
+        :return: dictionary of the node and its expanded descendants, the
+                 shape of the trees of the treemap and bubbletree
+                 visualisations
+        """
+        node = node or self.root
+        data = {'key': node.key, 'label': node.label, 'value': node.value}
+        if node.expanded:
+            data['children'] = [self.as_dict(child) for child in node.children]
+        return data
@@ -0,0 +1,162 @@
+"""
+HTTP client for the upstream APIs (OS_API, KPI_API) and the CDN.
+
+All requests go through one session, which keeps a pool of keep-alive
+connections per host, applies timeouts and retries, and stops calling a host
+for a while once it keeps failing. The session, and requests with it, are only
+loaded on the first call.
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+from microsite_backend import settings
+from vizmanager import performance
+
+
+class UpstreamError(IOError):
+    """
+    An upstream API could not be reached, failed, or is being left alone
+    because it kept failing
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Counts consecutive failures of a host. Once `threshold` is reached the
+    circuit opens and calls are refused for `reset_timeout` seconds, after
+    which a single trial call is let through to probe the host again.
+    """
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            # half open: restart the timeout so only this call probes the host
+            self.opened_at = time.time()
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+_session = None
+_session_lock = threading.Lock()
+_breakers = {}
+
+
+def session():
+    """
+    The shared session, created on first use
+    :return: requests.Session
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests is imported on first use only, it is a large part of
+            # the start up time of the processes that never need it
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            # a read timeout already took UPSTREAM_READ_TIMEOUT, don't wait
+            # that long again, nor for as long as a Retry-After asks
+            retry = Retry(total=settings.UPSTREAM_RETRIES, read=0,
+                          backoff_factor=settings.UPSTREAM_RETRY_BACKOFF,
+                          status_forcelist=(502, 503, 504),
+                          raise_on_status=False,
+                          respect_retry_after_header=False)
+            adapter = HTTPAdapter(
+                pool_connections=settings.UPSTREAM_POOL_CONNECTIONS,
+                pool_maxsize=settings.UPSTREAM_POOL_MAXSIZE,
+                max_retries=retry)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def worst_case_duration():
+    """
+    Longest time a call can take with the configured timeouts and retries:
+    every attempt waits for both timeouts, and urllib3 sleeps
+    UPSTREAM_RETRY_BACKOFF * 2 ** (n - 1) before the (n + 1)th attempt from
+    the third one on
+    :return: float, seconds
+    """
+    attempts = settings.UPSTREAM_RETRIES + 1
+    backoff = sum(settings.UPSTREAM_RETRY_BACKOFF * 2 ** (n - 1)
+                  for n in range(2, attempts))
+    return attempts * (settings.UPSTREAM_CONNECT_TIMEOUT +
+                       settings.UPSTREAM_READ_TIMEOUT) + backoff
+
+
+def breaker(url):
+    """
+    The circuit breaker of the host of `url`
+    :param url: string, URL about to be requested
+    :return: CircuitBreaker
+    """
+    host = urlsplit(url).netloc
+    with _session_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(
+                settings.UPSTREAM_CIRCUIT_FAILURES,
+                settings.UPSTREAM_CIRCUIT_RESET_TIMEOUT)
+        return _breakers[host]
+
+
+def request(method, url, params=None):
+    """
+    Request `url` through the shared session
+    :param method: string, HTTP method
+    :param url: string, URL to request
+    :param params: dictionary of query string parameters
+    :return: requests.Response, possibly with an error status code
+    :raises UpstreamError: if the host can't be reached, times out, keeps
+                           answering with server errors or its circuit is open
+    """
+    import requests
+
+    circuit = breaker(url)
+    if not circuit.allow():
+        raise UpstreamError('{} is failing, not calling it for now'
+                            .format(urlsplit(url).netloc))
+    try:
+        with performance.timer('upstream'):
+            response = session().request(
+                method, url, params=params,
+                timeout=(settings.UPSTREAM_CONNECT_TIMEOUT,
+                         settings.UPSTREAM_READ_TIMEOUT))
+    except requests.RequestException as e:
+        circuit.failure()
+        raise UpstreamError('{} failed: {}'.format(url, e))
+
+    if response.status_code >= 500:
+        circuit.failure()
+    else:
+        circuit.success()
+    return response
+
+
+def get(url, params=None):
+    """
+    GET `url` through the shared session, see request
+    """
+    return request('GET', url, params=params)
@@ -4,6 +4,10 @@ from vizmanager.views import DatasetAutocomplete
 from vizmanager.views import OrganizationAutocomplete
 from vizmanager.views import YearAutocomplete
 from vizmanager.views import PhaseAutocomplete
+from vizmanager.views import ThemeJSONView
+from vizmanager.views import MicrositeAPIView
+from vizmanager.views import MicrositeListAPIView
+from vizmanager.views import MicrositeExportView
 
 urlpatterns = [
     url(r'^(?P<pk>[0-9]+)/$', MicrositeDetailView.as_view(),
@@ -28,4 +32,14 @@ urlpatterns = [
         PhaseAutocomplete.as_view(),
         name='phase-autocomplete',
     ),
+    url(r'^themes/(?P<pk>[0-9]+)\.json$', ThemeJSONView.as_view(),
+        name='theme-json-latest'),
+    url(r'^themes/(?P<pk>[0-9]+)-(?P<digest>[0-9a-f]+)\.json$',
+        ThemeJSONView.as_view(), name='theme-json'),
+    url(r'^api/microsites/$', MicrositeListAPIView.as_view(),
+        name='api-microsite-list'),
+    url(r'^api/microsites/(?P<pk>[0-9]+)/$', MicrositeAPIView.as_view(),
+        name='api-microsite-detail'),
+    url(r'^api/microsites\.ndjson$', MicrositeExportView.as_view(),
+        name='api-microsite-export'),
 ]
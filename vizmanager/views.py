@@ -1,17 +1,64 @@
+import hashlib
+import hmac
 import json
-import requests
 
-from django.views.generic import DetailView
+from django.core.serializers.json import DjangoJSONEncoder
+from django.shortcuts import get_object_or_404
+from django.views.generic import DetailView, View
 from django import http
+from django.utils.cache import get_conditional_response, \
+    patch_cache_control, patch_vary_headers
 from dal import autocomplete
 
-from vizmanager.models import Microsite
+from vizmanager import cache, performance, upstream
+from vizmanager.models import Microsite, KPIFilterTerm, \
+    OpenSpendingPackage, Theme, fold
 from microsite_backend import settings
 
 
 class MicrositeDetailView(DetailView):
     model = Microsite
 
+    def get(self, request, *args, **kwargs):
+        """
+        Serve the rendered page from the cache, keyed by the microsite version,
+        and render it only when the microsite changed since the last render
+        :return: HttpResponse, or HttpResponseNotModified if the client's
+                 ETag is still current
+        """
+        pk = self.kwargs.get(self.pk_url_kwarg)
+        version = Microsite.current_version(pk)
+        if version is None:
+            raise http.Http404('No microsite found matching the query')
+
+        page = cache.get_microsite_page(pk, version)
+        if page is None:
+            response = super(MicrositeDetailView, self)\
+                .get(request, *args, **kwargs)
+            with performance.timer('template'):
+                content = response.render().content
+            etag = '"{}"'.format(hashlib.md5(content).hexdigest())
+            page = (etag, content)
+            cache.set_microsite_page(pk, version, etag, content)
+        etag, content = page
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = http.HttpResponse(content)
+        response['ETag'] = etag
+        # let browsers and proxies keep the page, but revalidate it every time
+        patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+    def get_queryset(self):
+        """
+        Fetch everything the templates need up front, so rendering a microsite
+        costs the same number of queries no matter how many datasets and KPIs
+        it has
+        :return: QuerySet of microsites
+        """
+        return Microsite.objects.with_content()
+
     def get_context_data(self, **kwargs):
         """
         Add custom data to be passed to the template, anything you put inside
@@ -21,122 +68,408 @@ class MicrositeDetailView(DetailView):
         """
         context = super(MicrositeDetailView, self).get_context_data(**kwargs)
         context['OS_API'] = settings.OS_API
+        context['datasets'] = list(self.object.dataset_set.all())
+        context['kpis'] = list(self.object.kpi_set.all())
         return context
 
 
-class DatasetAutocomplete(autocomplete.Select2ListView):
+class ThemeJSONView(View):
     """
-    Renders a json list of dataset name/description pairs in Select2ListView format
+    Serves the JSON of a theme, precompressed at save time.
+    Under its content addressed URL (with the digest) it can be cached forever;
+    under the plain URL it is revalidated with its digest as ETag.
+    """
+    # preferred encodings first
+    ENCODINGS = ('br', 'gzip')
+    IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+    def get(self, request, pk, digest=None):
+        current = digest or cache.get_theme_digest(pk)
+        variants = cache.get_theme_asset(pk, current) if current else None
+        if variants is None:
+            theme = get_object_or_404(Theme, pk=pk)
+            current = theme.publish()
+            if digest is not None and digest != current:
+                # an outdated version of the theme, which is not kept
+                raise http.Http404('No such version of this theme')
+            variants = cache.get_theme_asset(pk, current)
+
+        encoding = self.negotiate_encoding(request, variants)
+        etag = '"{}"'.format(current if encoding == 'identity'
+                             else '{}-{}'.format(current, encoding))
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = http.HttpResponse(variants[encoding],
+                                         content_type='application/json')
+            if encoding != 'identity':
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if digest is not None:
+            patch_cache_control(response, public=True, immutable=True,
+                                max_age=self.IMMUTABLE_MAX_AGE)
+        else:
+            patch_cache_control(response, public=True, no_cache=True)
+        return response
+
+    def negotiate_encoding(self, request, variants):
+        """
+        Pick the best precompressed variant the client accepts
+        :return: string, content encoding
+        """
+        accepted = set()
+        for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+            name, _, params = coding.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00',
+                                               'q=0.000'):
+                accepted.add(name.strip().lower())
+        for encoding in self.ENCODINGS:
+            if encoding in variants and \
+                    (encoding in accepted or '*' in accepted):
+                return encoding
+        return 'identity'
+
+
+class BadRequest(ValueError):
+    """
+    Invalid API query parameter, answered with a 400 response
     """
-    MAX_COMPLETIONS = 100
 
-    def get(self, request, *args, **kwargs):
+
+class MicrositeAPIMixin(object):
+    """
+    Shared parsing of the API query parameters.
+    `fields` selects the top level fields of the documents (sparse fieldsets),
+    `after` and `limit` page through microsites by primary key (keyset
+    pagination), which costs the same for the last page as for the first.
+    """
+    DEFAULT_LIMIT = 20
+    MAX_LIMIT = 100
+
+    def get_fields(self, request):
         """
-        Renders a json list of dataset name/description pairs
-        :param q: string, a search query that is wrapped in double quotes and forwarded to the OS_API
-        :returns [ {"id" : "dataset code", "title" : "dataset description as in OpenSpending" }, {...} ]
+        :return: list of the requested Microsite.DOCUMENT_FIELDS, None for all
         """
-        datasets = []
+        fields = request.GET.get('fields')
+        if not fields:
+            return None
+        fields = [field.strip() for field in fields.split(',')
+                  if field.strip() and field.strip() != 'id']
+        unknown = set(fields) - set(Microsite.DOCUMENT_FIELDS)
+        if unknown:
+            raise BadRequest('Unknown fields: {}'.format(
+                ', '.join(sorted(unknown))))
+        return fields
+
+    def get_queryset(self, fields):
+        """
+        Fetch only the relations the requested fields need
+        :param fields: list of the requested fields, None for all
+        :return: QuerySet of microsites ordered by primary key
+        """
+        queryset = Microsite.objects.with_content() if fields is None or \
+            set(fields) & {'theme', 'datasets', 'kpis'} \
+            else Microsite.objects.select_related('municipality')
+        return queryset.order_by('pk')
+
+    def get_integer(self, request, name, default=None, minimum=0):
+        value = request.GET.get(name)
+        if value in (None, ''):
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise BadRequest('{} must be an integer'.format(name))
+        if value < minimum:
+            raise BadRequest('{} must be at least {}'.format(name, minimum))
+        return value
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(MicrositeAPIMixin, self)\
+                .dispatch(request, *args, **kwargs)
+        except BadRequest as e:
+            return http.JsonResponse({'error': str(e)}, status=400)
+
+
+class MicrositeListAPIView(MicrositeAPIMixin, View):
+    """
+    Page of microsite documents, ordered by id. `next` is the URL of the next
+    page, null on the last one.
+    """
 
-        if self.q:
-            os_api = settings.OS_API
-            # TODO: they really use a different base URL for search.
-            # This is a stupid hack to mimic this change without defining additional API URLs
-            os_api = os_api.replace("api/3", "/search/package")
-            r = requests.get(os_api, params={'q': '"' + self.q + '"', 'size': self.MAX_COMPLETIONS})
+    def get(self, request):
+        fields = self.get_fields(request)
+        after = self.get_integer(request, 'after')
+        limit = min(self.get_integer(request, 'limit', self.DEFAULT_LIMIT,
+                                     minimum=1),
+                    self.MAX_LIMIT)
+
+        queryset = self.get_queryset(fields)
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        # one more than asked for tells whether there is a next page
+        microsites = list(queryset[:limit + 1])
+
+        next_url = None
+        if len(microsites) > limit:
+            microsites = microsites[:limit]
+            params = request.GET.copy()
+            params['after'] = microsites[-1].pk
+            next_url = request.build_absolute_uri(
+                '{}?{}'.format(request.path, params.urlencode()))
+
+        return http.JsonResponse({
+            'results': [microsite.as_document(fields)
+                        for microsite in microsites],
+            'next': next_url,
+        })
+
+
+class MicrositeAPIView(MicrositeAPIMixin, View):
+    """
+    Document of a single microsite
+    """
 
-            for dataset in r.json():
-                title = dataset['package']['title']
-                id = dataset['id']
-                datasets.append(dict(id=id, text=title))
+    def get(self, request, pk):
+        fields = self.get_fields(request)
+        microsite = get_object_or_404(self.get_queryset(fields), pk=pk)
+        return http.JsonResponse(microsite.as_document(fields))
 
-        return http.HttpResponse(json.dumps({
-            'results': datasets
-        }))
 
+class MicrositeExportView(MicrositeAPIMixin, View):
+    """
+    Streams the documents of all microsites as newline delimited JSON.
+    Microsites are fetched by keyset chunks so memory use stays flat however
+    many there are.
+    """
+    CHUNK_SIZE = 100
+
+    def get(self, request):
+        fields = self.get_fields(request)
+        response = http.StreamingHttpResponse(
+            self.stream(fields), content_type='application/x-ndjson')
+        response['Content-Disposition'] = \
+            'attachment; filename="microsites.ndjson"'
+        return response
 
-class OrganizationAutocomplete(autocomplete.Select2ListView):
+    def stream(self, fields):
+        """
+        :param fields: list of the requested fields, None for all
+        :return: generator of lines of JSON
+        """
+        after = 0
+        while True:
+            microsites = list(self.get_queryset(fields)
+                              .filter(pk__gt=after)[:self.CHUNK_SIZE])
+            for microsite in microsites:
+                yield json.dumps(microsite.as_document(fields),
+                                 cls=DjangoJSONEncoder) + '\n'
+            if len(microsites) < self.CHUNK_SIZE:
+                return
+            after = microsites[-1].pk
+
+
+class MetricsView(View):
     """
-    Renders a json list of organization name/description pairs in Select2ListView format
+    Request metrics of this process, for Prometheus to scrape.
+    Only served with METRICS_TOKEN set, to requests bearing it.
+    """
+
+    def get(self, request):
+        if not settings.METRICS_TOKEN:
+            raise http.Http404('Metrics are not enabled')
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if not hmac.compare_digest(
+                authorization.encode('utf-8'),
+                'Bearer {}'.format(settings.METRICS_TOKEN).encode('utf-8')):
+            return http.HttpResponseForbidden()
+        return http.HttpResponse(performance.metrics.exposition(),
+                                 content_type='text/plain; version=0.0.4')
+
+
+class UpstreamAutocomplete(autocomplete.Select2ListView):
+    """
+    Base for the autocompletes answered by an upstream API.
+    Results are kept in a per-process LRU cache keyed by endpoint and
+    normalised query, identical queries running at the same time share one
+    upstream request, and when a shorter prefix of the query is cached with
+    complete (not truncated) results, the query is answered by filtering those.
     """
     MAX_COMPLETIONS = 100
+    # whether every result of a query also is a result of its prefixes, so
+    # that it can be answered from the results of a prefix
+    FILTER_FROM_PREFIX = True
 
-    def get(self, request, *args, **kwargs):
+    results_cache = cache.LRUCache(settings.AUTOCOMPLETE_CACHE_SIZE,
+                                   settings.AUTOCOMPLETE_CACHE_TIMEOUT)
+    in_flight = cache.SingleFlight()
+
+    def endpoint(self):
         """
-        Renders a json list of dataset name/description pairs
-        :param q: string, a search query that is wrapped in double quotes and forwarded to the OS_API
-        :returns [ {"id" : "dataset code", "title" : "dataset description as in OpenSpending" }, {...} ]
+        :return: string, URL of the upstream search endpoint
         """
-        organizations = []
+        raise NotImplementedError
 
-        if self.q:
-            kpi_api = settings.KPI_API
+    def fetch(self, q):
+        """
+        Query the upstream endpoint
+        :param q: string, normalised search query
+        :return: list of {"id": ..., "text": ...} dictionaries
+        :raises upstream.UpstreamError: if the upstream API can't answer
+        """
+        raise NotImplementedError
 
-            r = requests.get(kpi_api + "/filters/organizations", params={'q': self.q, })
+    def get(self, request, *args, **kwargs):
+        """
+        Renders a json list of id/text pairs matching the `q` query parameter
+        :returns {"results": [{"id": "...", "text": "..."}, {...}]}
+        """
+        results = []
 
-            for organization in r.json():
-                title = organization["label"]
-                id = organization['url']
-                organizations.append(dict(id=id, text=title))
+        if self.q:
+            results = self.get_results(cache.normalise_query(self.q))
 
         return http.HttpResponse(json.dumps({
-            'results': organizations
+            'results': results
         }))
 
+    def get_results(self, q):
+        """
+        Answer a query from the cache, from the cached results of one of its
+        prefixes, or from the upstream API, in that order
+        :param q: string, normalised search query
+        :return: list of {"id": ..., "text": ...} dictionaries
+        """
+        endpoint = self.endpoint()
+        results = self.results_cache.get((endpoint, q))
+        if results is not None:
+            return results
+
+        if self.FILTER_FROM_PREFIX:
+            for end in range(len(q) - 1, 0, -1):
+                prefix_results = self.results_cache.get((endpoint, q[:end]))
+                if prefix_results is not None and \
+                        len(prefix_results) < self.MAX_COMPLETIONS:
+                    results = [result for result in prefix_results
+                               if self.matches(q, result['text'])]
+                    self.results_cache.set((endpoint, q), results)
+                    return results
+
+        try:
+            results = self.in_flight.do((endpoint, q), lambda: self.fetch(q))
+        except upstream.UpstreamError:
+            # don't cache failures, the next keystroke tries again
+            return []
+        self.results_cache.set((endpoint, q), results)
+        return results
+
+    def matches(self, q, text):
+        """
+        Whether a result of a prefix of `q` also is a result of `q`
+        :param q: string, normalised search query
+        :param text: string, text of the result
+        :return: boolean
+        """
+        return q in cache.normalise_query(text)
+
 
-class YearAutocomplete(autocomplete.Select2ListView):
+class DatasetAutocomplete(UpstreamAutocomplete):
     """
-    Renders a json list of organization name/description pairs in Select2ListView format
+    Renders a json list of dataset name/description pairs in Select2ListView
+    format
     """
-    MAX_COMPLETIONS = 100
+    # OpenSpending matches whole words anywhere in a package, not title
+    # prefixes, so longer queries can't be answered from shorter ones
+    FILTER_FROM_PREFIX = False
 
-    def get(self, request, *args, **kwargs):
+    def endpoint(self):
+        # TODO: they really use a different base URL for search.
+        # This is a stupid hack to mimic this change without defining
+        # additional API URLs
+        return settings.OS_API.replace("api/3", "/search/package")
+
+    def fetch(self, q):
         """
-        Renders a json list of dataset name/description pairs
-        :param q: string, a search query that is wrapped in double quotes and forwarded to the OS_API
-        :returns [ {"id" : "dataset code", "title" : "dataset description as in OpenSpending" }, {...} ]
+        Get dataset code/title pairs from the local catalogue (see the
+        sync_os_packages command), or from OS_API if nothing matches locally
+        :param q: string, a search query that is wrapped in double quotes and
+                  forwarded to the OS_API
+        :returns [ {"id" : "dataset code",
+                    "text" : "dataset description as in OpenSpending" },
+                   {...} ]
         """
-        years = []
+        packages = OpenSpendingPackage.objects.search(q, self.MAX_COMPLETIONS)
+        if packages:
+            return [dict(id=package.code, text=package.title)
+                    for package in packages]
 
-        if self.q:
-            kpi_api = settings.KPI_API
-
-            r = requests.get(kpi_api + "/filters/years", params={'q': self.q, })
+        r = upstream.get(self.endpoint(), params={
+            'q': '"' + q + '"', 'size': self.MAX_COMPLETIONS})
 
-            for year in r.json():
-                title = year["label"]
-                id = year['url']
-                years.append(dict(id=id, text=title))
-
-        return http.HttpResponse(json.dumps({
-            'results': years
-        }))
+        datasets = []
+        for dataset in r.json() if r.ok else []:
+            title = dataset['package']['title']
+            id = dataset['id']
+            datasets.append(dict(id=id, text=title))
+        return datasets
 
 
-class PhaseAutocomplete(autocomplete.Select2ListView):
+class KPIFilterAutocomplete(UpstreamAutocomplete):
     """
-    Renders a json list of organization name/description pairs in Select2ListView format
+    Base for the autocompletes of the KPI_API filters
     """
-    MAX_COMPLETIONS = 100
+    FILTER = None
 
-    def get(self, request, *args, **kwargs):
+    def endpoint(self):
+        return '{}/filters/{}'.format(settings.KPI_API, self.FILTER)
+
+    def fetch(self, q):
         """
-        Renders a json list of dataset name/description pairs
-        :param q: string, a search query that is wrapped in double quotes and forwarded to the OS_API
-        :returns [ {"id" : "dataset code", "title" : "dataset description as in OpenSpending" }, {...} ]
+        Get filter url/label pairs from the local copy of the vocabulary (see
+        the sync_kpi_filters command), or from the KPI_API if nothing matches
+        locally
+        :param q: string, a search query that is forwarded to the KPI_API
+        :returns [ {"id" : "filter url", "text" : "filter label" }, {...} ]
         """
-        phases = []
+        terms = KPIFilterTerm.objects.search(self.FILTER, q,
+                                             self.MAX_COMPLETIONS)
+        if terms:
+            return [dict(id=term.url, text=term.label) for term in terms]
 
-        if self.q:
-            kpi_api = settings.KPI_API
+        r = upstream.get(self.endpoint(), params={'q': q, })
 
-            r = requests.get(kpi_api + "/filters/phases", params={'q': self.q, })
+        values = []
+        for value in r.json() if r.ok else []:
+            title = value["label"]
+            id = value['url']
+            values.append(dict(id=id, text=title))
+        return values
 
-            for year in r.json():
-                title = year["label"]
-                id = year['url']
-                phases.append(dict(id=id, text=title))
+    def matches(self, q, text):
+        q, text = fold(q), fold(text)
+        return text.startswith(q) or ' ' + q in text
 
-        return http.HttpResponse(json.dumps({
-            'results': phases
-        }))
+
+class OrganizationAutocomplete(KPIFilterAutocomplete):
+    """
+    Renders a json list of organization url/name pairs in Select2ListView
+    format
+    """
+    FILTER = 'organizations'
+
+
+class YearAutocomplete(KPIFilterAutocomplete):
+    """
+    Renders a json list of year url/name pairs in Select2ListView format
+    """
+    FILTER = 'years'
+
+
+class PhaseAutocomplete(KPIFilterAutocomplete):
+    """
+    Renders a json list of budget phase url/name pairs in Select2ListView
+    format
+    """
+    FILTER = 'phases'